@@ -0,0 +1,5 @@
+# .env загружается один раз на процесс, до модулей, которые читают настройки
+# из окружения при импорте. Уже заданные переменные не перезаписываются.
+from dotenv import load_dotenv
+
+load_dotenv()
@@ -0,0 +1,621 @@
+import asyncio
+import contextlib
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+import zlib
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Iterator, List, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from sqlalchemy import delete, func, select
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+from . import codecs, database, models, search
+
+logger = logging.getLogger(__name__)
+
+# Архив сообщений по месяцам.
+#
+# Горячая таблица messages хранит последние MESSAGE_HOT_MONTHS месяцев.
+# Более старые месяцы фоновая задача переносит в отдельные файлы SQLite
+# MESSAGE_ARCHIVE_DIR/messages-YYYY-MM.db: сообщения диалога лежат там
+# блоками по ARCHIVE_BLOCK_MESSAGES, каждый блок - JSON, сжатый zlib.
+# Файл месяца пишется целиком один раз и дальше открывается только на
+# чтение (immutable), поэтому индексы и VACUUM горячей таблицы не растут
+# вместе с историей.
+#
+# Переносятся целые месяцы по времени, поэтому любое сообщение архива
+# старше любого сообщения горячей таблицы. История читается из messages,
+# а когда там кончается - из месяцев архива от новых к старым.
+# Полнотекстовый поиск покрывает только горячую таблицу.
+#
+# MESSAGE_RETENTION_MONTHS > 0 - месяцы архива старше этого срока удаляются.
+
+ARCHIVE_DIR = os.getenv("MESSAGE_ARCHIVE_DIR", "./archive")
+BLOCK_MESSAGES = int(os.getenv("ARCHIVE_BLOCK_MESSAGES", 128))
+# Строк горячей таблицы на одну транзакцию удаления после переноса
+DELETE_BATCH = 900
+# Каталог перечитывается не реже, чем раз в столько секунд (mtime
+# директории на части файловых систем грубее, чем интервал между записями)
+RESCAN_INTERVAL = 1.0
+
+PARTITION_NAME = re.compile(r"^messages-(\d{4})-(\d{2})\.db$")
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+
+# Строка сообщения - в порядке crud._MESSAGE_COLUMNS
+MessageRow = Tuple[int, int, int, Optional[int], str, datetime]
+
+def _naive_utc(value: datetime) -> datetime:
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+def _time_text(value: datetime) -> str:
+    # Фиксированная ширина: строки сравниваются в SQL так же, как время
+    return _naive_utc(value).strftime(TIME_FORMAT)
+
+def month_start(value: datetime) -> datetime:
+    return datetime(value.year, value.month, 1)
+
+def add_months(month: datetime, months: int) -> datetime:
+    index = month.year * 12 + month.month - 1 + months
+    return datetime(index // 12, index % 12 + 1, 1)
+
+def partition_path(directory: str, month: datetime) -> str:
+    return os.path.join(directory, f"messages-{month:%Y-%m}.db")
+
+def _encode_block(entries: list) -> bytes:
+    return zlib.compress(codecs.dumps_bytes(entries), 9)
+
+def _decode_block(data: bytes) -> list:
+    # [id, sender_id, receiver_id, content, created_at]
+    return codecs.loads_bytes(zlib.decompress(data))
+
+class Partition:
+    """Один месяц архива: файл только для чтения и соединение с ним"""
+
+    def __init__(self, path: str, month: datetime):
+        self.path = path
+        self.month = month
+        self.end = add_months(month, 1)
+        stat = os.stat(path)
+        self.version = (stat.st_ino, stat.st_mtime_ns)
+        self.size = stat.st_size
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(
+            Path(path).absolute().as_uri() + "?mode=ro&immutable=1", uri=True, check_same_thread=False
+        )
+        meta = dict(self._connection.execute("SELECT key, value FROM meta"))
+        self.messages = int(meta["messages"])
+        self.min_id = int(meta["min_id"])
+        self.max_id = int(meta["max_id"])
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    def message_key(self, message_id: int) -> Optional[Tuple[int, datetime]]:
+        """(conversation_id, created_at) сообщения, если оно в этом месяце"""
+        if not self.min_id <= message_id <= self.max_id:
+            return None
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT conversation_id, created_at FROM message_index WHERE id = ?", (message_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        return row[0], datetime.fromisoformat(row[1])
+
+    def read(
+        self, conversation_id: int, key: Optional[Tuple[datetime, int]], limit: int, newer: bool
+    ) -> List[MessageRow]:
+        """До limit сообщений диалога после key по возрастанию или до key от новых к старым"""
+        if newer:
+            sql = (
+                "SELECT data FROM blocks WHERE conversation_id = ? AND (last_at, last_id) > (?, ?) "
+                "ORDER BY last_at, last_id"
+            )
+        elif key is None:
+            sql = "SELECT data FROM blocks WHERE conversation_id = ? ORDER BY first_at DESC, first_id DESC"
+        else:
+            sql = (
+                "SELECT data FROM blocks WHERE conversation_id = ? AND (first_at, first_id) < (?, ?) "
+                "ORDER BY first_at DESC, first_id DESC"
+            )
+        anchor = (_time_text(key[0]), key[1]) if key is not None else None
+        params = (conversation_id,) + anchor if anchor is not None else (conversation_id,)
+
+        rows: List[MessageRow] = []
+        with self._lock:
+            cursor = self._connection.execute(sql, params)
+            try:
+                # Блоки диалога не пересекаются: нужны первые несколько по порядку
+                for (data,) in cursor:
+                    entries = _decode_block(data)
+                    if not newer:
+                        entries.reverse()
+                    for message_id, sender_id, receiver_id, content, created_at in entries:
+                        if anchor is not None and (
+                            (created_at, message_id) <= anchor if newer else (created_at, message_id) >= anchor
+                        ):
+                            continue
+                        rows.append((
+                            message_id, conversation_id, sender_id, receiver_id,
+                            content, datetime.fromisoformat(created_at)
+                        ))
+                        if len(rows) >= limit:
+                            return rows
+            finally:
+                cursor.close()
+        return rows
+
+    def blocks(self) -> Iterator[Tuple[int, list]]:
+        """Все блоки по диалогам, внутри диалога - по времени"""
+        after = (-1, "", 0)
+        while True:
+            with self._lock:
+                batch = self._connection.execute(
+                    "SELECT conversation_id, first_at, first_id, data FROM blocks "
+                    "WHERE (conversation_id, first_at, first_id) > (?, ?, ?) "
+                    "ORDER BY conversation_id, first_at, first_id LIMIT 64",
+                    after
+                ).fetchall()
+            if not batch:
+                return
+            for conversation_id, first_at, first_id, data in batch:
+                yield conversation_id, _decode_block(data)
+            after = batch[-1][:3]
+
+class MessageArchive:
+    """Каталог месяцев архива.
+
+    Каталог перечитывается, когда меняется mtime директории, и не реже
+    RESCAN_INTERVAL, так что месяц, перенесенный другим воркером, виден
+    до того, как его строки удаляются из горячей таблицы.
+    """
+
+    def __init__(self, directory: Optional[str] = None):
+        self.directory = directory or ARCHIVE_DIR
+        self.reads = 0
+        self._partitions: List[Partition] = []
+        self._version: Optional[int] = None
+        self._scanned_at = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def partitions(self) -> List[Partition]:
+        try:
+            version = os.stat(self.directory).st_mtime_ns
+        except FileNotFoundError:
+            version = None
+        if version != self._version or time.monotonic() - self._scanned_at > RESCAN_INTERVAL:
+            self.refresh()
+        return self._partitions
+
+    def refresh(self):
+        with self._lock:
+            try:
+                version = os.stat(self.directory).st_mtime_ns
+                names = os.listdir(self.directory)
+            except FileNotFoundError:
+                version, names = None, []
+            self._rescan(version, names)
+
+    def _rescan(self, version: Optional[int], names: List[str]):
+        current = {partition.path: partition for partition in self._partitions}
+        partitions = []
+        for name in names:
+            match = PARTITION_NAME.match(name)
+            if match is None:
+                continue
+            path = os.path.join(self.directory, name)
+            partition = current.pop(path, None)
+            try:
+                stat = os.stat(path)
+                if partition is None or partition.version != (stat.st_ino, stat.st_mtime_ns):
+                    if partition is not None:
+                        partition.close()
+                    partition = Partition(path, datetime(int(match.group(1)), int(match.group(2)), 1))
+            except (OSError, sqlite3.Error, KeyError):
+                logger.exception("archive partition unreadable", extra={"path": path})
+                continue
+            partitions.append(partition)
+        for partition in current.values():
+            partition.close()
+        self._partitions = sorted(partitions, key=lambda partition: partition.month)
+        self._version = version
+        self._scanned_at = time.monotonic()
+
+    def message_key(self, message_id: int) -> Optional[Tuple[int, datetime]]:
+        for partition in reversed(self.partitions):
+            found = partition.message_key(message_id)
+            if found is not None:
+                return found
+        return None
+
+    def max_id(self) -> int:
+        return max((partition.max_id for partition in self.partitions), default=0)
+
+    def read_before(
+        self, conversation_id: int, key: Optional[Tuple[datetime, int]], limit: int
+    ) -> List[MessageRow]:
+        """Сообщения диалога старше key (или самые свежие в архиве), от новых к старым"""
+        rows: List[MessageRow] = []
+        for partition in reversed(self.partitions):
+            if len(rows) >= limit:
+                break
+            if key is not None and partition.month > _naive_utc(key[0]):
+                continue
+            rows += partition.read(conversation_id, key, limit - len(rows), newer=False)
+        if rows:
+            self.reads += 1
+        return rows
+
+    def read_after(self, conversation_id: int, key: Tuple[datetime, int], limit: int) -> List[MessageRow]:
+        """Сообщения диалога новее key по возрастанию"""
+        rows: List[MessageRow] = []
+        for partition in self.partitions:
+            if len(rows) >= limit:
+                break
+            if partition.end <= _naive_utc(key[0]):
+                continue
+            rows += partition.read(conversation_id, key, limit - len(rows), newer=True)
+        if rows:
+            self.reads += 1
+        return rows
+
+    def stats(self) -> dict:
+        partitions = self.partitions
+        return {
+            "partitions": len(partitions),
+            "messages": sum(partition.messages for partition in partitions),
+            "bytes": sum(partition.size for partition in partitions),
+            "reads": self.reads,
+        }
+
+_MESSAGE_COLUMNS = (
+    models.Message.id, models.Message.conversation_id, models.Message.sender_id,
+    models.Message.receiver_id, models.Message.content, models.Message.created_at
+)
+
+def _write_blocks(target: sqlite3.Connection) -> int:
+    rows = target.execute(
+        "SELECT id, conversation_id, sender_id, receiver_id, content, created_at FROM staging "
+        "ORDER BY conversation_id, created_at, id"
+    )
+    block: list = []
+    block_conversation = None
+    count = 0
+
+    def flush():
+        target.execute(
+            "INSERT INTO blocks (conversation_id, first_at, first_id, last_at, last_id, messages, data) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                block_conversation, block[0][4], block[0][0], block[-1][4], block[-1][0],
+                len(block), _encode_block(block)
+            )
+        )
+        target.executemany(
+            "INSERT INTO message_index (id, conversation_id, created_at) VALUES (?, ?, ?)",
+            [(entry[0], block_conversation, entry[4]) for entry in block]
+        )
+
+    while True:
+        batch = rows.fetchmany(1000)
+        if not batch:
+            break
+        for message_id, conversation_id, sender_id, receiver_id, content, created_at in batch:
+            if block and (conversation_id != block_conversation or len(block) >= BLOCK_MESSAGES):
+                flush()
+                block = []
+            block_conversation = conversation_id
+            block.append([message_id, sender_id, receiver_id, content, created_at])
+            count += 1
+    if block:
+        flush()
+    return count
+
+def _stage(target: sqlite3.Connection, engine: Engine, path: str, month: datetime) -> int:
+    """Строки месяца во временную таблицу: прежний файл месяца и горячая таблица.
+
+    Возвращает число строк из горячей таблицы.
+    """
+    target.execute(
+        "CREATE TABLE staging (id INTEGER PRIMARY KEY, conversation_id INTEGER, sender_id INTEGER, "
+        "receiver_id INTEGER, content TEXT, created_at TEXT)"
+    )
+    insert = "INSERT OR REPLACE INTO staging VALUES (?, ?, ?, ?, ?, ?)"
+    if os.path.exists(path):
+        previous = Partition(path, month)
+        try:
+            for conversation_id, entries in previous.blocks():
+                target.executemany(insert, [
+                    (entry[0], conversation_id, entry[1], entry[2], entry[3], entry[4]) for entry in entries
+                ])
+        finally:
+            previous.close()
+
+    hot_rows = 0
+    with engine.connect() as connection:
+        result = connection.execution_options(yield_per=5000).execute(
+            select(*_MESSAGE_COLUMNS).where(
+                models.Message.created_at >= month,
+                models.Message.created_at < add_months(month, 1)
+            )
+        )
+        for batch in result.partitions():
+            target.executemany(insert, [row[:5] + (_time_text(row[5]),) for row in batch])
+            hot_rows += len(batch)
+    return hot_rows
+
+def _write_partition(target: sqlite3.Connection, month: datetime) -> int:
+    target.executescript("""
+        CREATE TABLE blocks (
+            conversation_id INTEGER NOT NULL,
+            first_at TEXT NOT NULL,
+            first_id INTEGER NOT NULL,
+            last_at TEXT NOT NULL,
+            last_id INTEGER NOT NULL,
+            messages INTEGER NOT NULL,
+            data BLOB NOT NULL
+        );
+        CREATE UNIQUE INDEX ix_blocks_first ON blocks (conversation_id, first_at, first_id);
+        CREATE INDEX ix_blocks_last ON blocks (conversation_id, last_at, last_id);
+        CREATE TABLE message_index (
+            id INTEGER PRIMARY KEY,
+            conversation_id INTEGER NOT NULL,
+            created_at TEXT NOT NULL
+        );
+        CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+    """)
+    count = _write_blocks(target)
+    min_id, max_id = target.execute("SELECT MIN(id), MAX(id) FROM staging").fetchone()
+    target.executemany("INSERT INTO meta (key, value) VALUES (?, ?)", [
+        ("month", f"{month:%Y-%m}"),
+        ("messages", str(count)),
+        ("min_id", str(min_id or 0)),
+        ("max_id", str(max_id or 0)),
+        ("block_messages", str(BLOCK_MESSAGES)),
+    ])
+    target.execute("DROP TABLE staging")
+    target.commit()
+    target.execute("VACUUM")
+    return count
+
+def build_partition(engine: Engine, directory: str, month: datetime) -> int:
+    """Собрать файл месяца из горячей таблицы и прежнего файла этого месяца, если он есть.
+
+    Пишется во временный файл и заменяет прежний одним rename, поэтому
+    читатели видят либо старую версию месяца, либо новую. Возвращает
+    число сообщений в файле; 0 - в горячей таблице нет строк этого
+    месяца, и прежний файл не трогается.
+    """
+    path = partition_path(directory, month)
+    tmp = path + ".tmp"
+    if os.path.exists(tmp):
+        os.remove(tmp)
+
+    target = sqlite3.connect(tmp)
+    try:
+        target.execute("PRAGMA journal_mode=OFF")
+        target.execute("PRAGMA synchronous=OFF")
+        count = _write_partition(target, month) if _stage(target, engine, path, month) else 0
+    finally:
+        target.close()
+
+    if count == 0:
+        os.remove(tmp)
+        return 0
+    # Строки удаляются из горячей таблицы только после того, как файл на диске
+    with open(tmp, "rb") as file:
+        os.fsync(file.fileno())
+    os.replace(tmp, path)
+    if hasattr(os, "O_DIRECTORY"):
+        descriptor = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(descriptor)
+        finally:
+            os.close(descriptor)
+    return count
+
+def oldest_message_before(engine: Engine, cutoff: datetime) -> Optional[datetime]:
+    with engine.connect() as connection:
+        oldest = connection.execute(
+            select(func.min(models.Message.created_at)).where(models.Message.created_at < cutoff)
+        ).scalar()
+    return _naive_utc(oldest) if oldest is not None else None
+
+def delete_archived(db: Session, message_ids: List[int]) -> int:
+    """Удалить из горячей таблицы сообщения, уже лежащие в файле месяца"""
+    message = models.Message
+    rows = db.execute(select(message.id, message.content).where(message.id.in_(message_ids))).all()
+    if rows:
+        search.backend.unindex_messages(db, rows)
+        db.execute(delete(message.__table__).where(message.__table__.c.id.in_([row.id for row in rows])))
+    db.commit()
+    return len(rows)
+
+@contextlib.contextmanager
+def _exclusive(directory: str):
+    """Архивирует один процесс: остальные воркеры пропускают проход"""
+    if fcntl is None:
+        yield True
+        return
+    with open(os.path.join(directory, ".lock"), "a") as lock_file:
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+class MessageArchiver:
+    """Фоновый перенос старых месяцев в архив и удаление просроченных"""
+
+    def __init__(
+        self,
+        archive: MessageArchive,
+        hot_months: Optional[int] = None,
+        retention_months: Optional[int] = None,
+        interval: Optional[float] = None
+    ):
+        self.archive = archive
+        # 0 - архивирование выключено, вся история в горячей таблице
+        self.hot_months = hot_months if hot_months is not None else int(os.getenv("MESSAGE_HOT_MONTHS", 6))
+        self.retention_months = (
+            retention_months if retention_months is not None else int(os.getenv("MESSAGE_RETENTION_MONTHS", 0))
+        )
+        if self.retention_months and self.retention_months < self.hot_months:
+            raise ValueError("MESSAGE_RETENTION_MONTHS must not be less than MESSAGE_HOT_MONTHS")
+        self.interval = interval or float(os.getenv("MESSAGE_ARCHIVE_INTERVAL", 3600))
+
+        self.runs = 0
+        self.archived_messages = 0
+        self.expired_partitions = 0
+        self.last_run_seconds = 0.0
+        # Граница, до которой горячая таблица уже очищена: она сдвигается раз
+        # в месяц, и только тогда есть смысл искать старые строки
+        self._done_cutoff: Optional[datetime] = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        if self._task is None and self.hot_months > 0:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        # Первый проход вскоре после старта, но не во время прогрева
+        delay = min(self.interval, 60)
+        while True:
+            await asyncio.sleep(delay)
+            delay = self.interval
+            try:
+                await self.run_once()
+            except Exception:
+                logger.exception("message archival failed")
+
+    def cutoff(self, now: Optional[datetime] = None) -> datetime:
+        return add_months(month_start(now or datetime.utcnow()), -self.hot_months)
+
+    async def run_once(self, now: Optional[datetime] = None) -> int:
+        """Перенести месяцы старше горячего окна; возвращает число перенесенных сообщений"""
+        if self.hot_months <= 0:
+            return 0
+        cutoff = self.cutoff(now)
+        os.makedirs(self.archive.directory, exist_ok=True)
+        with _exclusive(self.archive.directory) as acquired:
+            if not acquired:
+                return 0
+            began = time.perf_counter()
+            archived = 0
+            if cutoff != self._done_cutoff:
+                oldest = await asyncio.to_thread(oldest_message_before, database.engine, cutoff)
+                month = month_start(oldest) if oldest is not None else cutoff
+                while month < cutoff:
+                    archived += await self._archive_month(month)
+                    month = add_months(month, 1)
+                self._done_cutoff = cutoff
+            self._expire(now)
+            self.runs += 1
+            self.archived_messages += archived
+            self.last_run_seconds = time.perf_counter() - began
+        return archived
+
+    async def _archive_month(self, month: datetime) -> int:
+        count = await asyncio.to_thread(build_partition, database.engine, self.archive.directory, month)
+        if count == 0:
+            return 0
+        self.archive.refresh()
+        partition = next(
+            (partition for partition in self.archive.partitions if partition.month == month), None
+        )
+        if partition is None:
+            raise RuntimeError(f"Archive partition {month:%Y-%m} is not readable after build")
+        # Другие воркеры должны увидеть файл до удаления строк из горячей таблицы
+        await asyncio.sleep(RESCAN_INTERVAL * 2)
+
+        # Диалог за диалогом от старых сообщений к новым: если процесс
+        # прервется, в горячей таблице останется более новая часть месяца,
+        # а архив - целиком старше нее, как и должно быть
+        deleted = 0
+        batch: List[int] = []
+        for _, entries in partition.blocks():
+            batch.extend(entry[0] for entry in entries)
+            if len(batch) >= DELETE_BATCH:
+                deleted += await self._delete(batch)
+                batch = []
+        if batch:
+            deleted += await self._delete(batch)
+        logger.info("archived month", extra={"month": f"{month:%Y-%m}", "messages": count, "deleted": deleted})
+        return deleted
+
+    async def _delete(self, message_ids: List[int]) -> int:
+        async with database.AsyncSessionLocal() as db, database.write_lock():
+            return await db.run_sync(delete_archived, message_ids)
+
+    def _expire(self, now: Optional[datetime] = None):
+        if not self.retention_months:
+            return
+        keep_from = add_months(month_start(now or datetime.utcnow()), -self.retention_months)
+        for partition in self.archive.partitions:
+            if partition.end <= keep_from:
+                os.remove(partition.path)
+                self.expired_partitions += 1
+                logger.info("archive partition expired", extra={"month": f"{partition.month:%Y-%m}"})
+
+    def stats(self) -> dict:
+        return dict(
+            self.archive.stats(),
+            hot_months=self.hot_months,
+            runs=self.runs,
+            archived_messages=self.archived_messages,
+            expired_partitions=self.expired_partitions,
+            last_run_seconds=self.last_run_seconds,
+        )
+
+message_archive = MessageArchive()
+message_archiver = MessageArchiver(message_archive)
+
+if __name__ == "__main__":
+    import sys
+
+    from . import logs
+
+    if sys.argv[1:] != ["run"]:
+        print("Usage: python -m app.archive run")
+        sys.exit(1)
+
+    async def main():
+        # Разовый перенос без ожидания фоновой задачи (например, из cron)
+        database.init_engines()
+        try:
+            archived = await message_archiver.run_once()
+        finally:
+            await database.dispose_engines()
+        print(f"Archived {archived} messages")
+        print(message_archiver.stats())
+
+    logs.configure()
+    asyncio.run(main())
@@ -2,21 +2,30 @@ from datetime import datetime, timedelta
 from typing import Optional
 from jose import JWTError, jwt
 from passlib.context import CryptContext
-from dotenv import load_dotenv
 import os
 
-load_dotenv()
-
 # Используем дефолтное значение если SECRET_KEY не установлена
 SECRET_KEY = os.getenv("SECRET_KEY", "ваш-секретный-ключ-по-умолчанию-из-32-символов")
 ALGORITHM = os.getenv("ALGORITHM", "HS256")
 ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", 30))
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Стоимость bcrypt: каждая единица удваивает время хеширования. Хеши со
+# старой стоимостью пересчитываются при следующем входе пользователя
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", 12))
+
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
+
+def load_backend():
+    """Загрузить бэкенд bcrypt заранее: passlib делает это при первом хеше"""
+    pwd_context.handler().get_backend()
 
 def verify_password(plain_password, hashed_password):
     return pwd_context.verify(plain_password, hashed_password)
 
+def verify_and_update_password(plain_password, hashed_password):
+    """(верен ли пароль, новый хеш или None, если текущий соответствует настройкам)"""
+    return pwd_context.verify_and_update(plain_password, hashed_password)
+
 def get_password_hash(password):
     return pwd_context.hash(password)
 
@@ -32,12 +41,17 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-def decode_access_token(token: str):
+def decode_access_token_payload(token: str):
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        user_id: int = payload.get("sub")
-        if user_id is None:
+        if payload.get("sub") is None:
             return None
-        return int(user_id)
+        return payload
     except JWTError:
-        return None
\ No newline at end of file
+        return None
+
+def decode_access_token(token: str):
+    payload = decode_access_token_payload(token)
+    if payload is None:
+        return None
+    return int(payload["sub"])
@@ -0,0 +1,160 @@
+import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, FrozenSet, Hashable, Optional
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from . import auth, models
+
+_MISSING = object()
+
+class TTLCache:
+    """Ограниченный LRU-кэш с временем жизни записей и счетчиками попаданий"""
+
+    def __init__(self, name: str, maxsize: int, ttl: float):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._data.get(key, _MISSING)
+        if entry is _MISSING or entry[0] <= time.monotonic():
+            if entry is not _MISSING:
+                del self._data[key]
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if ttl <= 0:
+            return
+        self._data[key] = (time.monotonic() + ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key: Hashable):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+@dataclass(frozen=True)
+class CachedUser:
+    """Легкая копия пользователя для авторизации, без ORM-состояния"""
+    __slots__ = ("id", "username", "email", "first_name", "last_name", "is_active")
+
+    id: int
+    username: str
+    email: str
+    first_name: Optional[str]
+    last_name: Optional[str]
+    is_active: bool
+
+    @classmethod
+    def from_model(cls, user) -> "CachedUser":
+        return cls(
+            id=user.id,
+            username=user.username,
+            email=user.email,
+            first_name=user.first_name,
+            last_name=user.last_name,
+            is_active=user.is_active is not False,
+        )
+
+    def get_full_name(self):
+        return f"{self.first_name or ''} {self.last_name or ''}".strip() or self.username
+
+# Кэши живут в процессе воркера: invalidate_user действует локально,
+# а в остальных воркерах запись устаревает не позже USER_CACHE_TTL
+token_cache = TTLCache(
+    "auth_tokens",
+    maxsize=int(os.getenv("TOKEN_CACHE_SIZE", 50000)),
+    ttl=float(os.getenv("TOKEN_CACHE_TTL", 300)),
+)
+user_cache = TTLCache(
+    "auth_users",
+    maxsize=int(os.getenv("USER_CACHE_SIZE", 50000)),
+    ttl=float(os.getenv("USER_CACHE_TTL", 30)),
+)
+
+# Состав групп для проверки отправителя и рассылки. Изменение состава
+# сбрасывает запись в своем воркере, в остальных - не позже GROUP_CACHE_TTL
+group_cache = TTLCache(
+    "group_members",
+    maxsize=int(os.getenv("GROUP_CACHE_SIZE", 10000)),
+    ttl=float(os.getenv("GROUP_CACHE_TTL", 5)),
+)
+
+def decode_access_token(token: str) -> Optional[int]:
+    user_id = token_cache.get(token)
+    if user_id is not None:
+        return user_id
+
+    payload = auth.decode_access_token_payload(token)
+    if payload is None:
+        return None
+    user_id = int(payload["sub"])
+    # Запись не переживает срок действия самого токена
+    expires_in = payload["exp"] - time.time() if "exp" in payload else None
+    token_cache.set(token, user_id, ttl=expires_in)
+    return user_id
+
+async def get_user(db: AsyncSession, user_id: int) -> Optional[CachedUser]:
+    user = user_cache.get(user_id)
+    if user is not None:
+        return user
+
+    db_user = await db.get(models.User, user_id)
+    if db_user is None:
+        return None
+    user = CachedUser.from_model(db_user)
+    user_cache.set(user_id, user)
+    return user
+
+def invalidate_user(user_id: int):
+    user_cache.invalidate(user_id)
+
+async def get_group_members(db: AsyncSession, conversation_id: int) -> FrozenSet[int]:
+    """id участников группы; пустое множество - группы нет"""
+    members = group_cache.get(conversation_id)
+    if members is not None:
+        return members
+
+    member = models.ConversationMember
+    result = await db.execute(
+        select(member.user_id).join(
+            models.Conversation, models.Conversation.id == member.conversation_id
+        ).where(member.conversation_id == conversation_id, models.Conversation.is_group)
+    )
+    members = frozenset(result.scalars().all())
+    group_cache.set(conversation_id, members)
+    return members
+
+def invalidate_group(conversation_id: int):
+    group_cache.invalidate(conversation_id)
+
+def stats() -> dict:
+    return {cache.name: cache.stats() for cache in (token_cache, user_cache, group_cache)}
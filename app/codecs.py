@@ -0,0 +1,163 @@
+import json
+from abc import ABC, abstractmethod
+from typing import Dict, List, Optional, Union
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Кодеки WebSocket-кадров. Клиент перечисляет поддерживаемые в заголовке
+# Sec-WebSocket-Protocol, сервер выбирает первый известный ему. Без
+# заголовка (браузерная страница) остается обычный JSON с полными именами.
+#
+#   void.json    - JSON с полными именами полей (по умолчанию)
+#   void.cjson   - JSON с короткими кодами полей
+#   void.msgpack - MessagePack с короткими кодами полей, бинарные кадры
+#
+# orjson и msgpack необязательны: без orjson используется stdlib json,
+# без msgpack кодек void.msgpack не предлагается.
+
+Frame = Union[str, bytes]
+
+FIELD_CODES = {
+    "type": "t",
+    "message_id": "i",
+    "sender_id": "s",
+    "receiver_id": "r",
+    "content": "c",
+    "timestamp": "ts",
+    "detail": "d",
+    "conversations": "cv",
+    "conversation_id": "ci",
+    "user_id": "u",
+    "username": "un",
+    "unread_count": "uc",
+    "peer_unread_count": "pu",
+    "last_message_id": "li",
+    "preview": "p",
+    "messages": "m",
+    "next_cursor": "nc",
+    "truncated": "tr",
+    "since": "sn",
+    "id": "id",
+    "created_at": "ca",
+    "is_sent": "is",
+    "peer_last_read_id": "pl",
+    "reader_id": "rd",
+    "last_read_message_id": "lr",
+    "is_typing": "ty",
+    "code": "co",
+    "frame": "fr",
+    "retry_after": "ra",
+    "groups": "gr",
+    "is_group": "ig",
+    "title": "tl",
+    "origin": "o",
+}
+FIELD_NAMES = {code: name for name, code in FIELD_CODES.items()}
+
+# Ключи этих словарей - id собеседников и групп, а не имена полей
+_ID_MAPS = {"conversations", FIELD_CODES["conversations"], "groups", FIELD_CODES["groups"]}
+
+_CONTAINERS = (dict, list)
+
+def _rename(value, names: Dict[str, str], keys: bool = True):
+    # Горячий путь кодека: скаляры не проходят через рекурсивный вызов
+    if value.__class__ is list:
+        return [_rename(item, names) if item.__class__ in _CONTAINERS else item for item in value]
+    get = names.get
+    if not keys:
+        return {key: _rename(item, names) if item.__class__ in _CONTAINERS else item for key, item in value.items()}
+    return {
+        get(key, key): _rename(item, names, key not in _ID_MAPS) if item.__class__ in _CONTAINERS else item
+        for key, item in value.items()
+    }
+
+def compact(event: dict) -> dict:
+    return _rename(event, FIELD_CODES)
+
+def expand(event: dict) -> dict:
+    return _rename(event, FIELD_NAMES)
+
+def _dumps(event: dict) -> str:
+    if orjson is not None:
+        return orjson.dumps(event).decode()
+    return json.dumps(event, ensure_ascii=False, separators=(",", ":"))
+
+def dumps_bytes(value) -> bytes:
+    """JSON для HTTP-ответов, которые собираются вручную (потоковая история)"""
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode()
+
+def loads_bytes(data: bytes):
+    """Обратно к dumps_bytes (блоки архива сообщений)"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def _loads(data: Frame) -> dict:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+class Codec(ABC):
+    name = ""
+    binary = False
+
+    @abstractmethod
+    def encode(self, event: dict) -> Frame:
+        """Событие -> кадр WebSocket"""
+
+    @abstractmethod
+    def decode(self, data: Frame) -> dict:
+        """Кадр WebSocket -> событие с полными именами полей"""
+
+class JsonCodec(Codec):
+    name = "void.json"
+
+    def encode(self, event: dict) -> Frame:
+        return _dumps(event)
+
+    def decode(self, data: Frame) -> dict:
+        return _loads(data)
+
+class CompactJsonCodec(Codec):
+    name = "void.cjson"
+
+    def encode(self, event: dict) -> Frame:
+        return _dumps(compact(event))
+
+    def decode(self, data: Frame) -> dict:
+        return expand(_loads(data))
+
+class MsgpackCodec(Codec):
+    name = "void.msgpack"
+    binary = True
+
+    def encode(self, event: dict) -> Frame:
+        return msgpack.packb(compact(event))
+
+    def decode(self, data: Frame) -> dict:
+        # strict_map_key=False: в sync ключи conversations - числа
+        return expand(msgpack.unpackb(data, strict_map_key=False))
+
+DEFAULT_CODEC = JsonCodec()
+
+CODECS: Dict[str, Codec] = {codec.name: codec for codec in (DEFAULT_CODEC, CompactJsonCodec())}
+if msgpack is not None:
+    CODECS[MsgpackCodec.name] = MsgpackCodec()
+
+def negotiate(subprotocols: List[str]) -> Optional[Codec]:
+    """Первый из предложенных клиентом кодеков, который знает сервер"""
+    for subprotocol in subprotocols:
+        codec = CODECS.get(subprotocol)
+        if codec is not None:
+            return codec
+    return None
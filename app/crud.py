@@ -1,6 +1,34 @@
-from sqlalchemy.orm import Session
-from sqlalchemy import or_, and_
-from . import models, schemas, auth
+import base64
+import os
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+from sqlalchemy.orm import Session, aliased
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy import and_, bindparam, case, exists, func, or_, select, tuple_, update
+from . import models, schemas, auth, search
+from .archive import message_archive
+from .message_cache import CachedMessage, recent_messages
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+CHAT_PREVIEW_LENGTH = 100
+GROUP_MAX_MEMBERS = int(os.getenv("GROUP_MAX_MEMBERS", 10000))
+# Параметров в одном IN (...): SQLite ограничивает их число на запрос
+IN_CHUNK_SIZE = 900
+
+# Курсоры: "m" - сообщение (история), "c" - диалог (список чатов)
+def encode_cursor(row_id: int, kind: str = "m") -> str:
+    return base64.urlsafe_b64encode(f"{kind}:{row_id}".encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str, kind: str = "m") -> Optional[int]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        prefix, _, row_id = raw.partition(":")
+        if prefix != kind:
+            return None
+        return int(row_id)
+    except (ValueError, UnicodeDecodeError):
+        return None
 
 def get_user_by_email(db: Session, email: str):
     return db.query(models.User).filter(models.User.email == email).first()
@@ -14,8 +42,9 @@ def get_user_by_id(db: Session, user_id: int):
 def get_all_users(db: Session):
     return db.query(models.User).all()
 
-def create_user(db: Session, user: schemas.UserCreate):
-    hashed_password = auth.get_password_hash(user.password)
+def create_user(db: Session, user: schemas.UserCreate, hashed_password: Optional[str] = None):
+    if hashed_password is None:
+        hashed_password = auth.get_password_hash(user.password)
     db_user = models.User(
         username=user.username,
         email=user.email,
@@ -26,6 +55,14 @@ def create_user(db: Session, user: schemas.UserCreate):
     db.refresh(db_user)
     return db_user
 
+def deactivate_user(db: Session, user_id: int):
+    user = get_user_by_id(db, user_id)
+    if user is None:
+        return None
+    user.is_active = False
+    db.commit()
+    return user
+
 def authenticate_user(db: Session, email: str, password: str):
     user = get_user_by_email(db, email)
     if not user:
@@ -34,21 +71,708 @@ def authenticate_user(db: Session, email: str, password: str):
         return None
     return user
 
-def create_message(db: Session, message: schemas.MessageCreate, sender_id: int):
-    db_message = models.Message(
-        sender_id=sender_id,
-        receiver_id=message.receiver_id,
-        content=message.content
+def update_last_seen(db: Session, last_seen: Dict[int, datetime]):
+    """Пакетная запись last_seen: один executemany вместо записи на каждое событие"""
+    users = models.User.__table__
+    db.execute(
+        update(users).where(users.c.id == bindparam("b_user_id")).values(last_seen=bindparam("b_last_seen")),
+        [{"b_user_id": user_id, "b_last_seen": seen} for user_id, seen in last_seen.items()]
     )
-    db.add(db_message)
     db.commit()
-    db.refresh(db_message)
-    return db_message
 
-def get_messages_between_users(db: Session, user1_id: int, user2_id: int):
-    return db.query(models.Message).filter(
+def get_last_seen(db: Session, user_ids: List[int]) -> Dict[int, datetime]:
+    if not user_ids:
+        return {}
+    return dict(db.query(models.User.id, models.User.last_seen).filter(models.User.id.in_(user_ids)).all())
+
+def get_conversation(db: Session, user1_id: int, user2_id: int):
+    user_low_id, user_high_id = sorted((user1_id, user2_id))
+    return db.query(models.Conversation).filter(
+        models.Conversation.user_low_id == user_low_id,
+        models.Conversation.user_high_id == user_high_id
+    ).first()
+
+def new_conversation(user1_id: int, user2_id: int):
+    user_low_id, user_high_id = sorted((user1_id, user2_id))
+    return models.Conversation(
+        user_low_id=user_low_id,
+        user_high_id=user_high_id,
+        members=[
+            models.ConversationMember(user_id=user_id, unread_count=0)
+            for user_id in {user_low_id, user_high_id}
+        ]
+    )
+
+def get_or_create_conversation(db: Session, user1_id: int, user2_id: int):
+    conversation = get_conversation(db, user1_id, user2_id)
+    if conversation:
+        return conversation
+
+    conversation = new_conversation(user1_id, user2_id)
+    db.add(conversation)
+    # Отдельная короткая транзакция: откат при гонке не задевает остальное
+    try:
+        db.commit()
+    except IntegrityError:
+        # Диалог успели создать параллельно
+        db.rollback()
+        conversation = get_conversation(db, user1_id, user2_id)
+    return conversation
+
+def get_or_create_conversations(db: Session, pairs) -> Dict[Tuple[int, int], int]:
+    """id диалогов для набора пар собеседников: один SELECT и один INSERT на пакет"""
+    pairs = {tuple(sorted(pair)) for pair in pairs}
+    if not pairs:
+        return {}
+    conversation = models.Conversation
+    key = tuple_(conversation.user_low_id, conversation.user_high_id)
+
+    def load():
+        rows = db.query(conversation.id, conversation.user_low_id, conversation.user_high_id).filter(
+            key.in_(list(pairs))
+        ).all()
+        return {(low, high): conversation_id for conversation_id, low, high in rows}
+
+    found = load()
+    missing = pairs - found.keys()
+    if missing:
+        db.add_all([new_conversation(low, high) for low, high in missing])
+        try:
+            db.commit()
+        except IntegrityError:
+            # Часть диалогов успели создать параллельно - создаем остальные по одному
+            db.rollback()
+            for pair in missing:
+                get_or_create_conversation(db, *pair)
+        found = load()
+    return found
+
+def get_group(db: Session, conversation_id: int, user_id: int) -> Optional[models.Conversation]:
+    """Группа, если пользователь в ней состоит"""
+    member = models.ConversationMember
+    return db.query(models.Conversation).join(
+        member, and_(member.conversation_id == models.Conversation.id, member.user_id == user_id)
+    ).filter(
+        models.Conversation.id == conversation_id,
+        models.Conversation.is_group
+    ).first()
+
+def get_group_member_ids(db: Session, conversation_id: int) -> List[int]:
+    member = models.ConversationMember
+    return [
+        user_id for (user_id,) in db.query(member.user_id).join(
+            models.Conversation, models.Conversation.id == member.conversation_id
+        ).filter(
+            member.conversation_id == conversation_id,
+            models.Conversation.is_group
+        )
+    ]
+
+def _active_user_ids(db: Session, user_ids) -> set:
+    user_ids = list(user_ids)
+    found = set()
+    for start in range(0, len(user_ids), IN_CHUNK_SIZE):
+        found.update(user_id for (user_id,) in db.query(models.User.id).filter(
+            models.User.id.in_(user_ids[start:start + IN_CHUNK_SIZE]),
+            models.User.is_active != False
+        ))
+    return found
+
+def create_group(db: Session, title: str, creator_id: int, member_ids: List[int]) -> models.Conversation:
+    """Группа из создателя и member_ids; неизвестные и неактивные пользователи - ValueError"""
+    member_ids = set(member_ids) | {creator_id}
+    if len(member_ids) > GROUP_MAX_MEMBERS:
+        raise ValueError(f"Too many members, max {GROUP_MAX_MEMBERS}")
+    missing = member_ids - _active_user_ids(db, member_ids)
+    if missing:
+        raise ValueError(f"Unknown users: {', '.join(map(str, sorted(missing)[:10]))}")
+
+    conversation = models.Conversation(is_group=True, title=title, created_by=creator_id)
+    db.add(conversation)
+    db.flush()
+    # Тысячи участников - одним executemany, без ORM-объекта на каждого
+    db.execute(models.ConversationMember.__table__.insert(), [
+        {"conversation_id": conversation.id, "user_id": user_id, "unread_count": 0}
+        for user_id in member_ids
+    ])
+    db.commit()
+    return conversation
+
+def add_group_members(db: Session, conversation_id: int, actor_id: int, user_ids: List[int]) -> Optional[int]:
+    """Добавить участников (может любой участник); None, если actor не в группе.
+
+    Новые участники начинают с прочитанной историей: курсор - на последнем
+    сообщении группы.
+    """
+    conversation = get_group(db, conversation_id, actor_id)
+    if conversation is None:
+        return None
+    current = set(get_group_member_ids(db, conversation_id))
+    new_ids = set(user_ids) - current
+    if not new_ids:
+        return 0
+    if len(current) + len(new_ids) > GROUP_MAX_MEMBERS:
+        raise ValueError(f"Too many members, max {GROUP_MAX_MEMBERS}")
+    missing = new_ids - _active_user_ids(db, new_ids)
+    if missing:
+        raise ValueError(f"Unknown users: {', '.join(map(str, sorted(missing)[:10]))}")
+
+    db.execute(models.ConversationMember.__table__.insert(), [
+        {
+            "conversation_id": conversation_id,
+            "user_id": user_id,
+            "unread_count": 0,
+            "last_read_message_id": conversation.last_message_id
+        }
+        for user_id in new_ids
+    ])
+    db.commit()
+    return len(new_ids)
+
+def remove_group_member(db: Session, conversation_id: int, actor_id: int, user_id: int) -> Optional[bool]:
+    """Выйти самому или удалить участника (только создатель группы).
+
+    None - actor не в группе или не вправе удалять, False - user_id не участник.
+    """
+    conversation = get_group(db, conversation_id, actor_id)
+    if conversation is None or (user_id != actor_id and conversation.created_by != actor_id):
+        return None
+    member = models.ConversationMember
+    removed = db.query(member).filter(
+        member.conversation_id == conversation_id,
+        member.user_id == user_id
+    ).delete(synchronize_session=False)
+    db.commit()
+    return bool(removed)
+
+def reserve_ids(db: Session, name: str, count: int) -> int:
+    """Резервирует count последовательных id, возвращает первый из них"""
+    sequence = models.IdSequence
+    updated = db.query(sequence).filter(sequence.name == name).update(
+        {sequence.next_value: sequence.next_value + count}, synchronize_session=False
+    )
+    if not updated:
+        # Первая выдача: продолжаем после уже существующих сообщений, в том числе архивных
+        start = max(db.query(func.max(models.Message.id)).scalar() or 0, message_archive.max_id()) + 1
+        db.add(sequence(name=name, next_value=start + count))
+        try:
+            db.commit()
+        except IntegrityError:
+            db.rollback()
+            return reserve_ids(db, name, count)
+        return start
+
+    next_value = db.query(sequence.next_value).filter(sequence.name == name).scalar()
+    db.commit()
+    return next_value - count
+
+def create_messages(db: Session, rows: List[dict]) -> List[models.Message]:
+    """Пакетная запись сообщений с заранее выданными id и created_at.
+
+    Строка с conversation_id - сообщение в группу (receiver_id нет),
+    без него - личное, диалог находится или создается по паре.
+    """
+    conversations = get_or_create_conversations(db, [
+        (row["sender_id"], row["receiver_id"]) for row in rows if row.get("conversation_id") is None
+    ])
+    messages = []
+    for row in rows:
+        conversation_id = row.get("conversation_id")
+        if conversation_id is None:
+            conversation_id = conversations[tuple(sorted((row["sender_id"], row["receiver_id"])))]
+        messages.append(models.Message(**dict(row, conversation_id=conversation_id), is_read=False))
+
+    db.add_all(messages)
+    update_chat_summaries(db, messages)
+    search.backend.index_messages(db, messages)
+    # Копии до коммита: после него атрибуты ORM-объектов могут истечь
+    cached = [CachedMessage.from_model(message) for message in messages]
+    db.commit()
+    recent_messages.append(cached)
+    return messages
+
+def update_chat_summaries(db: Session, messages: List[models.Message]):
+    """Последнее сообщение диалога и счетчики непрочитанных - в той же транзакции"""
+    latest: Dict[int, models.Message] = {}
+    unread: Dict[Tuple[int, int], int] = {}
+    for message in messages:
+        current = latest.get(message.conversation_id)
+        if current is None or (message.created_at, message.id) > (current.created_at, current.id):
+            latest[message.conversation_id] = message
+        # Непрочитанные в группе считаются от курсора при чтении
+        if message.receiver_id is not None and message.receiver_id != message.sender_id:
+            key = (message.conversation_id, message.receiver_id)
+            unread[key] = unread.get(key, 0) + 1
+
+    conversations = models.Conversation.__table__
+    db.execute(
+        update(conversations)
+        .where(conversations.c.id == bindparam("b_conversation_id"))
+        .where(or_(
+            conversations.c.last_message_at.is_(None),
+            conversations.c.last_message_at <= bindparam("b_message_at")
+        ))
+        .values(
+            last_message_id=bindparam("b_message_id"),
+            last_message_at=bindparam("b_message_at"),
+            last_message_sender_id=bindparam("b_sender_id"),
+            last_message_preview=bindparam("b_preview")
+        ),
+        [
+            {
+                "b_conversation_id": conversation_id,
+                "b_message_id": message.id,
+                "b_message_at": message.created_at,
+                "b_sender_id": message.sender_id,
+                "b_preview": message.content[:CHAT_PREVIEW_LENGTH]
+            }
+            for conversation_id, message in latest.items()
+        ]
+    )
+
+    if unread:
+        members = models.ConversationMember.__table__
+        db.execute(
+            update(members)
+            .where(members.c.conversation_id == bindparam("b_conversation_id"))
+            .where(members.c.user_id == bindparam("b_member_id"))
+            .values(unread_count=members.c.unread_count + bindparam("b_count")),
+            [
+                {"b_conversation_id": conversation_id, "b_member_id": user_id, "b_count": count}
+                for (conversation_id, user_id), count in unread.items()
+            ]
+        )
+
+def _message_key(message_id, outer=None):
+    """(created_at, id) сообщения как row value - позиция в истории диалога.
+
+    Для сообщения из архива подзапрос пуст (NULL): оно старше всех в messages.
+    outer - таблица внешнего запроса, из которой берется message_id: на
+    глубине больше одного уровня SQLAlchemy сам ее не коррелирует.
+    """
+    message = aliased(models.Message)
+    key = select(message.created_at, message.id).where(message.id == message_id)
+    if outer is not None:
+        key = key.correlate(outer)
+    return key.scalar_subquery()
+
+def _message_position(
+    db: Session, message_id: int, conversation_id: Optional[int] = None
+) -> Optional[Tuple[datetime, int]]:
+    """(created_at, id) сообщения из горячей таблицы или архива; None - нет такого (в этом диалоге)"""
+    row = db.execute(
+        select(models.Message.conversation_id, models.Message.created_at).where(models.Message.id == message_id)
+    ).first()
+    if row is None:
+        row = message_archive.message_key(message_id)
+        if row is None:
+            return None
+    if conversation_id is not None and row[0] != conversation_id:
+        return None
+    return row[1], message_id
+
+def mark_conversation_read(
+    db: Session,
+    user_id: int,
+    peer_id: int,
+    message_id: Optional[int] = None
+) -> Optional[Tuple[int, int]]:
+    """Сдвинуть курсор прочтения до message_id (по умолчанию - до последнего сообщения).
+
+    Одно обновление строки участника вместо пометки каждого сообщения.
+    Курсор не двигается назад. unread_count пересчитывается от курсора
+    по диапазону индекса (conversation_id, created_at, id): обычно там
+    несколько сообщений, пришедших после прочитанного. Курсор может
+    стоять и на архивном сообщении; тогда считаются только сообщения
+    горячей таблицы.
+    Возвращает (conversation_id, last_read_message_id), если курсор сдвинулся.
+    """
+    return _advance_read_cursor(db, get_conversation(db, user_id, peer_id), user_id, message_id)
+
+def mark_group_read(
+    db: Session,
+    user_id: int,
+    conversation_id: int,
+    message_id: Optional[int] = None
+) -> Optional[Tuple[int, int]]:
+    return _advance_read_cursor(db, get_group(db, conversation_id, user_id), user_id, message_id)
+
+def _advance_read_cursor(
+    db: Session,
+    conversation: Optional[models.Conversation],
+    user_id: int,
+    message_id: Optional[int]
+) -> Optional[Tuple[int, int]]:
+    if conversation is None or conversation.last_message_id is None:
+        return None
+
+    if message_id is None:
+        message_id = conversation.last_message_id
+    # Позиции - из горячей таблицы или архива, сравниваются здесь же
+    target = _message_position(db, message_id, conversation.id)
+    if target is None:
+        return None
+
+    member = models.ConversationMember
+    current_id = db.query(member.last_read_message_id).filter(
+        member.conversation_id == conversation.id,
+        member.user_id == user_id
+    ).scalar()
+    if current_id is not None:
+        current = _message_position(db, current_id)
+        if current is not None and current >= target:
+            return None
+
+    if conversation.is_group:
+        # Счетчик группы не хранится - см. _unread_count
+        unread = 0
+    else:
+        unread = select(func.count()).select_from(models.Message).where(
+            models.Message.conversation_id == conversation.id,
+            models.Message.sender_id != user_id,
+            tuple_(models.Message.created_at, models.Message.id) > target
+        ).scalar_subquery()
+
+    # Курсор, прочитанный выше, не должен был измениться параллельно
+    updated = db.query(member).filter(
+        member.conversation_id == conversation.id,
+        member.user_id == user_id,
+        member.last_read_message_id.is_(None) if current_id is None else member.last_read_message_id == current_id
+    ).update(
+        {member.last_read_message_id: message_id, member.unread_count: unread},
+        synchronize_session=False
+    )
+    db.commit()
+    return (conversation.id, message_id) if updated else None
+
+def _unread_count(user_id: int):
+    """Непрочитанные участника: счетчик личного диалога или подсчет от курсора в группе"""
+    conversation = models.Conversation
+    member = models.ConversationMember
+    message = aliased(models.Message)
+    cursor_message = aliased(models.Message)
+    group_unread = select(func.count()).select_from(message).where(
+        message.conversation_id == conversation.id,
+        message.sender_id != user_id,
         or_(
-            and_(models.Message.sender_id == user1_id, models.Message.receiver_id == user2_id),
-            and_(models.Message.sender_id == user2_id, models.Message.receiver_id == user1_id)
+            member.last_read_message_id.is_(None),
+            # Курсор на архивном сообщении: непрочитана вся горячая часть
+            ~exists().where(cursor_message.id == member.last_read_message_id).correlate(member),
+            tuple_(message.created_at, message.id) > _message_key(member.last_read_message_id, outer=member)
         )
-    ).order_by(models.Message.created_at.asc()).all()
\ No newline at end of file
+    ).scalar_subquery()
+    return case((conversation.is_group, group_unread), else_=member.unread_count)
+
+def _chat_query(db: Session, user_id: int, *columns):
+    """Диалоги пользователя с собеседником: (Conversation, *columns, id и имя собеседника).
+
+    У группы собеседника нет - id и имя None.
+    """
+    conversation = models.Conversation
+    member = models.ConversationMember
+    peer_id = case(
+        (conversation.user_low_id == user_id, conversation.user_high_id),
+        else_=conversation.user_low_id
+    )
+    query = db.query(
+        conversation,
+        *columns,
+        models.User.id,
+        models.User.username
+    ).join(
+        member, and_(member.conversation_id == conversation.id, member.user_id == user_id)
+    ).outerjoin(
+        models.User, models.User.id == peer_id
+    )
+    return query, peer_id
+
+def get_chat_list(
+    db: Session,
+    user_id: int,
+    before: Optional[int] = None,
+    limit: int = DEFAULT_PAGE_SIZE
+) -> Tuple[list, Optional[str]]:
+    """Диалоги пользователя по убыванию последней активности, keyset по (last_message_at, id)"""
+    conversation = models.Conversation
+    query, _ = _chat_query(db, user_id, _unread_count(user_id))
+    query = query.filter(conversation.last_message_id.isnot(None))
+
+    if before is not None:
+        anchor_conversation = aliased(models.Conversation)
+        anchor = select(anchor_conversation.last_message_at, anchor_conversation.id).where(
+            anchor_conversation.id == before
+        ).scalar_subquery()
+        query = query.filter(tuple_(conversation.last_message_at, conversation.id) < anchor)
+
+    rows = query.order_by(
+        conversation.last_message_at.desc(), conversation.id.desc()
+    ).limit(limit + 1).all()
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    next_cursor = encode_cursor(rows[-1][0].id, "c") if has_more and rows else None
+    return rows, next_cursor
+
+def sync_conversations(
+    db: Session,
+    user_id: int,
+    known: Dict[int, int],
+    since: Optional[int] = None,
+    limit: int = DEFAULT_PAGE_SIZE,
+    groups: Optional[Dict[int, int]] = None
+) -> Tuple[list, bool]:
+    """Изменения диалогов относительно состояния клиента.
+
+    known - последнее сообщение, которое клиент видел, по id собеседника:
+    для этих диалогов возвращаются только более новые сообщения; groups -
+    то же для групп по id диалога. since -
+    последнее сообщение, известное клиенту вообще: диалоги, где после него
+    была активность, попадают в ответ сводкой без сообщений. Состояние
+    прочтения собеседника - его курсор и число наших непрочитанных.
+    """
+    conversation = models.Conversation
+    peer_member = aliased(models.ConversationMember)
+    groups = groups or {}
+    query, peer_id = _chat_query(
+        db, user_id,
+        _unread_count(user_id),
+        peer_member.unread_count,
+        peer_member.last_read_message_id
+    )
+    query = query.outerjoin(
+        peer_member, and_(peer_member.conversation_id == conversation.id, peer_member.user_id == peer_id)
+    )
+
+    conditions = []
+    if known:
+        conditions.append(peer_id.in_(list(known)))
+    if groups:
+        conditions.append(and_(conversation.is_group, conversation.id.in_(list(groups))))
+    if since is not None:
+        anchor = _message_position(db, since)
+        if anchor is not None:
+            conditions.append(tuple_(conversation.last_message_at, conversation.last_message_id) > anchor)
+    if not conditions:
+        return [], False
+
+    rows = query.filter(or_(*conditions)).order_by(
+        conversation.last_message_at.desc(), conversation.id.desc()
+    ).limit(MAX_PAGE_SIZE + 1).all()
+    truncated = len(rows) > MAX_PAGE_SIZE
+
+    changes = []
+    for chat, unread_count, peer_unread_count, peer_last_read_id, chat_peer_id, username in rows[:MAX_PAGE_SIZE]:
+        messages, next_cursor = [], None
+        seen = groups.get(chat.id) if chat.is_group else known.get(chat_peer_id)
+        # Диалог без новых сообщений не требует отдельного запроса
+        if seen is not None and chat.last_message_id not in (None, seen):
+            messages, next_cursor = _history_page(db, chat.id, after=seen, limit=limit)
+        changes.append((
+            chat, unread_count, peer_unread_count, peer_last_read_id,
+            chat_peer_id, username, messages, next_cursor
+        ))
+    return changes, truncated
+
+def search_users(db: Session, query: str, limit: int = 20):
+    # Префиксный диапазон по username использует его индекс, в отличие от LIKE
+    return db.query(models.User).filter(
+        models.User.username >= query,
+        models.User.username < query + "\uffff",
+        models.User.is_active != False
+    ).order_by(models.User.username).limit(limit).all()
+
+def search_messages(db: Session, user_id: int, query: str, limit: int = 20, offset: int = 0):
+    return search.backend.search(db, user_id, query, limit, offset)
+
+def create_message(db: Session, message: schemas.MessageCreate, sender_id: int):
+    # id выдаются из общей последовательности, чтобы не пересечься с write-behind
+    db_message, = create_messages(db, [{
+        "id": reserve_ids(db, "messages", 1),
+        "sender_id": sender_id,
+        "receiver_id": message.receiver_id,
+        "content": message.content,
+        "created_at": datetime.utcnow()
+    }])
+    return db_message
+
+def get_messages_between_users(
+    db: Session,
+    user1_id: int,
+    user2_id: int,
+    before: Optional[int] = None,
+    after: Optional[int] = None,
+    limit: int = DEFAULT_PAGE_SIZE
+) -> Tuple[list, Optional[str]]:
+    """Страница истории диалога по ключу (created_at, id).
+
+    before/after - id сообщения-якоря из курсора. Без after возвращается
+    страница, заканчивающаяся перед якорем (или самая свежая), иначе -
+    начинающаяся после него. Сообщения всегда идут по возрастанию времени,
+    next_cursor указывает на продолжение в том же направлении.
+    """
+    conversation = get_conversation(db, user1_id, user2_id)
+    if conversation is None:
+        return [], None
+    return _conversation_page(db, conversation, before, after, limit)
+
+def get_group_messages(
+    db: Session,
+    user_id: int,
+    conversation_id: int,
+    before: Optional[int] = None,
+    after: Optional[int] = None,
+    limit: int = DEFAULT_PAGE_SIZE
+) -> Optional[Tuple[list, Optional[str]]]:
+    """То же для группы; None, если пользователь в ней не состоит"""
+    conversation = get_group(db, conversation_id, user_id)
+    if conversation is None:
+        return None
+    return _conversation_page(db, conversation, before, after, limit)
+
+def _conversation_page(
+    db: Session,
+    conversation: models.Conversation,
+    before: Optional[int],
+    after: Optional[int],
+    limit: int
+) -> Tuple[list, Optional[str]]:
+    if before is None and after is None:
+        return _latest_page(db, conversation, limit)
+    return _history_page(db, conversation.id, before=before, after=after, limit=limit)
+
+_MESSAGE_COLUMNS = (
+    models.Message.id, models.Message.conversation_id, models.Message.sender_id,
+    models.Message.receiver_id, models.Message.content, models.Message.created_at
+)
+
+def _latest_page(
+    db: Session, conversation: models.Conversation, limit: int
+) -> Tuple[List[CachedMessage], Optional[str]]:
+    """Самая свежая страница: из кэша горячих диалогов или одним запросом колонок"""
+    cached = recent_messages.latest_page(conversation.id, conversation.last_message_id, limit)
+    if cached is not None:
+        page, has_more = cached
+    else:
+        # Читаем сразу столько, сколько держит кольцо, чтобы следующие запросы попали в кэш
+        size = max(limit, recent_messages.capacity)
+        rows = db.execute(
+            select(*_MESSAGE_COLUMNS)
+            .where(models.Message.conversation_id == conversation.id)
+            .order_by(models.Message.created_at.desc(), models.Message.id.desc())
+            .limit(size + 1)
+        ).all()
+        if len(rows) <= size and message_archive.partitions:
+            rows += message_archive.read_before(
+                conversation.id, _row_position(rows[-1]) if rows else None, size + 1 - len(rows)
+            )
+        messages = [CachedMessage(*row) for row in reversed(rows[:size])]
+        recent_messages.fill(conversation.id, messages, complete=len(rows) <= size)
+        page, has_more = messages[-limit:], len(rows) > limit
+
+    next_cursor = encode_cursor(page[0].id) if has_more and page else None
+    return page, next_cursor
+
+def preload_latest_pages(db: Session, count: int) -> int:
+    """Заполнить кольца кэша для count диалогов с самыми свежими сообщениями"""
+    conversations = db.scalars(
+        select(models.Conversation)
+        .where(models.Conversation.last_message_id.is_not(None))
+        .order_by(models.Conversation.last_message_at.desc())
+        .limit(count)
+    ).all()
+    for conversation in conversations:
+        _latest_page(db, conversation, DEFAULT_PAGE_SIZE)
+    return len(conversations)
+
+def _history_page(
+    db: Session,
+    conversation_id: int,
+    before: Optional[int] = None,
+    after: Optional[int] = None,
+    limit: int = DEFAULT_PAGE_SIZE
+) -> Tuple[List[CachedMessage], Optional[str]]:
+    newer = after is not None
+    anchor_id = after if newer else before
+
+    # Только нужные колонки через Core: без ORM-объекта и identity map на строку
+    query = select(*_MESSAGE_COLUMNS).where(models.Message.conversation_id == conversation_id)
+    if anchor_id is not None:
+        anchor_message = aliased(models.Message)
+        anchor = select(anchor_message.created_at, anchor_message.id).where(
+            anchor_message.id == anchor_id
+        ).scalar_subquery()
+        key = tuple_(models.Message.created_at, models.Message.id)
+        query = query.where(key > anchor if newer else key < anchor)
+
+    # Один диапазон индекса (conversation_id, created_at, id) с LIMIT:
+    # стоимость страницы не зависит от длины истории
+    if newer:
+        query = query.order_by(models.Message.created_at.asc(), models.Message.id.asc())
+    else:
+        query = query.order_by(models.Message.created_at.desc(), models.Message.id.desc())
+    rows = db.execute(query.limit(limit + 1)).all()
+    if len(rows) <= limit and message_archive.partitions:
+        rows = _continue_in_archive(db, conversation_id, rows, anchor_id, newer, limit)
+
+    has_more = len(rows) > limit
+    page = [CachedMessage(*row) for row in rows[:limit]]
+    if not newer:
+        page.reverse()
+
+    next_cursor = None
+    if has_more and page:
+        next_cursor = encode_cursor(page[-1].id if newer else page[0].id)
+    return page, next_cursor
+
+def _row_position(row) -> Tuple[datetime, int]:
+    # Строка в порядке _MESSAGE_COLUMNS
+    return row[5], row[0]
+
+def _continue_in_archive(
+    db: Session,
+    conversation_id: int,
+    rows: list,
+    anchor_id: Optional[int],
+    newer: bool,
+    limit: int
+) -> list:
+    """Страница, которой не хватило горячей таблицы, дочитывается из архива.
+
+    Архив целиком старше горячей таблицы: более старые сообщения
+    продолжаются в нем от самого старого горячего, а более новые, чем
+    архивный якорь, идут сначала из архива, потом из горячей таблицы.
+    """
+    if not newer:
+        if rows:
+            position = _row_position(rows[-1])
+        elif anchor_id is not None:
+            position = _message_position(db, anchor_id, conversation_id)
+            if position is None:
+                return rows
+        else:
+            position = None
+        return rows + message_archive.read_before(conversation_id, position, limit + 1 - len(rows))
+
+    # Якорь в горячей таблице - все более новые сообщения тоже там
+    if rows:
+        return rows
+    found = message_archive.message_key(anchor_id)
+    if found is None or found[0] != conversation_id:
+        return rows
+    position = (found[1], anchor_id)
+    rows = message_archive.read_after(conversation_id, position, limit + 1)
+    if len(rows) <= limit:
+        # Продолжение после последнего архивного: строки, которые еще не
+        # успели удалить из горячей таблицы при переносе, не повторяются
+        if rows:
+            position = _row_position(rows[-1])
+        rows += db.execute(
+            select(*_MESSAGE_COLUMNS)
+            .where(
+                models.Message.conversation_id == conversation_id,
+                tuple_(models.Message.created_at, models.Message.id) > position
+            )
+            .order_by(models.Message.created_at.asc(), models.Message.id.asc())
+            .limit(limit + 1 - len(rows))
+        ).all()
+    return rows
@@ -0,0 +1,155 @@
+from typing import Dict, List, Optional, Tuple
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from . import models, schemas, crud, database, cache
+from .hashing import password_hasher
+
+# Асинхронные варианты функций crud для AsyncSession.
+# Простые выборки написаны напрямую, многошаговые операции переиспользуют
+# синхронную логику crud через run_sync: она выполняется в greenlet, а
+# каждый запрос к БД отдает управление event loop. Записи идут под
+# database.write_lock().
+
+async def get_user_by_email(db: AsyncSession, email: str):
+    result = await db.execute(select(models.User).where(models.User.email == email))
+    return result.scalars().first()
+
+async def get_user_by_username(db: AsyncSession, username: str):
+    result = await db.execute(select(models.User).where(models.User.username == username))
+    return result.scalars().first()
+
+async def get_user_by_id(db: AsyncSession, user_id: int):
+    return await db.get(models.User, user_id)
+
+async def get_all_users(db: AsyncSession):
+    result = await db.execute(select(models.User))
+    return result.scalars().all()
+
+async def create_user(db: AsyncSession, user: schemas.UserCreate):
+    # Хеш считается в пуле bcrypt до захвата блокировки записи, а соединение
+    # с БД на это время возвращается в пул (close отпускает его, сессия
+    # остается пригодной для следующих запросов)
+    await db.close()
+    hashed_password = await password_hasher.hash(user.password)
+    async with database.write_lock():
+        return await db.run_sync(crud.create_user, user, hashed_password)
+
+async def deactivate_user(db: AsyncSession, user_id: int):
+    async with database.write_lock():
+        user = await db.run_sync(crud.deactivate_user, user_id)
+    # Изменение пользователя сбрасывает его запись в кэше авторизации
+    cache.invalidate_user(user_id)
+    return user
+
+async def authenticate_user(db: AsyncSession, email: str, password: str):
+    user = await get_user_by_email(db, email)
+    if not user:
+        return None
+    # Проверка пароля не держит соединение с БД: объект user остается
+    # с загруженными полями, но отсоединяется от сессии
+    await db.close()
+    verified, new_hash = await password_hasher.verify_and_update(password, user.hashed_password)
+    if not verified:
+        return None
+    if new_hash is not None:
+        # Хеш со старой стоимостью BCRYPT_ROUNDS заменяется прозрачно
+        async with database.write_lock():
+            await db.execute(
+                update(models.User).where(models.User.id == user.id).values(hashed_password=new_hash)
+            )
+            await db.commit()
+    return user
+
+async def create_message(db: AsyncSession, message: schemas.MessageCreate, sender_id: int):
+    async with database.write_lock():
+        return await db.run_sync(crud.create_message, message, sender_id)
+
+async def get_messages_between_users(
+    db: AsyncSession,
+    user1_id: int,
+    user2_id: int,
+    before: Optional[int] = None,
+    after: Optional[int] = None,
+    limit: int = crud.DEFAULT_PAGE_SIZE
+) -> Tuple[list, Optional[str]]:
+    return await db.run_sync(
+        crud.get_messages_between_users, user1_id, user2_id,
+        before=before, after=after, limit=limit
+    )
+
+async def get_group_messages(
+    db: AsyncSession,
+    user_id: int,
+    conversation_id: int,
+    before: Optional[int] = None,
+    after: Optional[int] = None,
+    limit: int = crud.DEFAULT_PAGE_SIZE
+) -> Optional[Tuple[list, Optional[str]]]:
+    return await db.run_sync(
+        crud.get_group_messages, user_id, conversation_id,
+        before=before, after=after, limit=limit
+    )
+
+async def get_group(db: AsyncSession, conversation_id: int, user_id: int):
+    return await db.run_sync(crud.get_group, conversation_id, user_id)
+
+async def get_group_member_ids(db: AsyncSession, conversation_id: int) -> List[int]:
+    return await db.run_sync(crud.get_group_member_ids, conversation_id)
+
+async def create_group(db: AsyncSession, title: str, creator_id: int, member_ids: List[int]):
+    async with database.write_lock():
+        return await db.run_sync(crud.create_group, title, creator_id, member_ids)
+
+async def add_group_members(db: AsyncSession, conversation_id: int, actor_id: int, user_ids: List[int]):
+    async with database.write_lock():
+        added = await db.run_sync(crud.add_group_members, conversation_id, actor_id, user_ids)
+    cache.invalidate_group(conversation_id)
+    return added
+
+async def remove_group_member(db: AsyncSession, conversation_id: int, actor_id: int, user_id: int):
+    async with database.write_lock():
+        removed = await db.run_sync(crud.remove_group_member, conversation_id, actor_id, user_id)
+    cache.invalidate_group(conversation_id)
+    return removed
+
+async def mark_group_read(
+    db: AsyncSession,
+    user_id: int,
+    conversation_id: int,
+    message_id: Optional[int] = None
+) -> Optional[Tuple[int, int]]:
+    async with database.write_lock():
+        return await db.run_sync(crud.mark_group_read, user_id, conversation_id, message_id)
+
+async def mark_conversation_read(
+    db: AsyncSession,
+    user_id: int,
+    peer_id: int,
+    message_id: Optional[int] = None
+) -> Optional[Tuple[int, int]]:
+    async with database.write_lock():
+        return await db.run_sync(crud.mark_conversation_read, user_id, peer_id, message_id)
+
+async def get_chat_list(
+    db: AsyncSession,
+    user_id: int,
+    before: Optional[int] = None,
+    limit: int = crud.DEFAULT_PAGE_SIZE
+):
+    return await db.run_sync(crud.get_chat_list, user_id, before=before, limit=limit)
+
+async def search_users(db: AsyncSession, query: str, limit: int = 20):
+    return await db.run_sync(crud.search_users, query, limit)
+
+async def search_messages(db: AsyncSession, user_id: int, query: str, limit: int = 20, offset: int = 0):
+    return await db.run_sync(crud.search_messages, user_id, query, limit, offset)
+
+async def sync_conversations(
+    db: AsyncSession,
+    user_id: int,
+    known: Dict[int, int],
+    since: Optional[int] = None,
+    limit: int = crud.DEFAULT_PAGE_SIZE,
+    groups: Optional[Dict[int, int]] = None
+):
+    return await db.run_sync(crud.sync_conversations, user_id, known, since=since, limit=limit, groups=groups)
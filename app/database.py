@@ -1,17 +1,178 @@
-from sqlalchemy import create_engine
+import asyncio
+import contextlib
+from typing import Optional
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
 import os
-from dotenv import load_dotenv
-
-load_dotenv()
 
+# Настройки читаются из окружения; .env загружает точка входа (run.py)
 SQLALCHEMY_DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./messenger.db")
+IS_SQLITE = SQLALCHEMY_DATABASE_URL.startswith("sqlite")
+
+# Профили настройки SQLite. default - поведение драйвера как есть,
+# production - WAL (читатели не блокируют писателя), synchronous=NORMAL
+# (fsync на checkpoint, а не на каждый коммит), большой кэш страниц и mmap.
+# Любую прагму профиля можно переопределить через SQLITE_<ИМЯ>.
+SQLITE_PROFILES = {
+    "default": {},
+    "production": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "busy_timeout": 5000,
+        "cache_size": -64000,
+        "mmap_size": 268435456,
+        "temp_store": "MEMORY",
+    },
+}
+
+DB_PROFILE = os.getenv("DB_PROFILE", "production")
+
+def get_sqlite_pragmas(profile: str = DB_PROFILE) -> dict:
+    if profile not in SQLITE_PROFILES:
+        raise ValueError(f"Unknown DB_PROFILE: {profile}")
+    pragmas = dict(SQLITE_PROFILES[profile])
+    for name in SQLITE_PROFILES["production"]:
+        value = os.getenv(f"SQLITE_{name.upper()}")
+        if value is not None:
+            pragmas[name] = value
+    return pragmas
+
+def apply_sqlite_pragmas(engine, pragmas: dict, query_only: bool = False):
+    sync_engine = getattr(engine, "sync_engine", engine)
+
+    @event.listens_for(sync_engine, "connect")
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        if query_only:
+            cursor.execute("PRAGMA query_only=ON")
+        cursor.close()
+
+def get_pool_options(prefix: str = "DB", pool_size: int = 5, max_overflow: int = 10) -> dict:
+    # Для in-memory SQLite пул не настраивается: там одно соединение на процесс
+    if IS_SQLITE and (":memory:" in SQLALCHEMY_DATABASE_URL or SQLALCHEMY_DATABASE_URL.rstrip("/") == "sqlite:"):
+        return {}
+    return {
+        "pool_size": int(os.getenv(f"{prefix}_POOL_SIZE", pool_size)),
+        "max_overflow": int(os.getenv(f"{prefix}_MAX_OVERFLOW", max_overflow)),
+        "pool_timeout": float(os.getenv(f"{prefix}_POOL_TIMEOUT", 30)),
+    }
+
+def create_engine_from_env(url: str, pool_options: dict):
+    if pool_options:
+        pool_options = dict(pool_options, poolclass=QueuePool)
+    return create_engine(
+        url, connect_args={"check_same_thread": False} if IS_SQLITE else {}, **pool_options
+    )
+
+# Асинхронный драйвер для того же URL: горячий путь не блокирует event loop
+ASYNC_DRIVERS = {
+    "sqlite": "sqlite+aiosqlite",
+    "postgresql": "postgresql+asyncpg",
+    "postgres": "postgresql+asyncpg",
+}
+
+def get_async_database_url(url: str) -> str:
+    scheme, sep, rest = url.partition("://")
+    if "+" in scheme:
+        scheme = scheme.split("+", 1)[0]
+    return ASYNC_DRIVERS.get(scheme, scheme) + sep + rest
+
+def create_async_engine_from_env(url: str, pool_options: dict):
+    if pool_options:
+        pool_options = dict(pool_options, poolclass=AsyncAdaptedQueuePool)
+    return create_async_engine(get_async_database_url(url), **pool_options)
+
+# DB_SPLIT_READ_WRITE=true: записи идут через единственное соединение-писатель,
+# чтение истории - через отдельный пул соединений только для чтения
+SPLIT_READ_WRITE = IS_SQLITE and os.getenv("DB_SPLIT_READ_WRITE", "False").lower() == "true"
+
+# Движки создает init_engines: в воркере - при старте (lifespan), в CLI и
+# бенчмарках - явно. Импорт модуля ничего не открывает.
+engine: Optional[Engine] = None
+async_engine: Optional[AsyncEngine] = None
+async_read_engine: Optional[AsyncEngine] = None
+
+# Фабрики сессий существуют с импорта, движок им назначает init_engines.
+# expire_on_commit=False: после commit атрибуты не перечитываются лениво,
+# что в асинхронной сессии было бы ошибкой
+SessionLocal = sessionmaker(autocommit=False, autoflush=False)
+AsyncSessionLocal = async_sessionmaker(class_=AsyncSession, autoflush=False, expire_on_commit=False)
+AsyncReadSessionLocal = async_sessionmaker(class_=AsyncSession, autoflush=False, expire_on_commit=False)
 
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False} if "sqlite" in SQLALCHEMY_DATABASE_URL else {}
-)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+def init_engines():
+    global engine, async_engine, async_read_engine
+    if engine is not None:
+        return
+
+    engine = create_engine_from_env(SQLALCHEMY_DATABASE_URL, get_pool_options())
+    if SPLIT_READ_WRITE:
+        async_engine = create_async_engine_from_env(
+            SQLALCHEMY_DATABASE_URL, get_pool_options("DB_WRITE", pool_size=1, max_overflow=0)
+        )
+        async_read_engine = create_async_engine_from_env(
+            SQLALCHEMY_DATABASE_URL, get_pool_options("DB_READ", pool_size=8, max_overflow=8)
+        )
+    else:
+        async_engine = create_async_engine_from_env(SQLALCHEMY_DATABASE_URL, get_pool_options())
+        async_read_engine = async_engine
+
+    if IS_SQLITE:
+        apply_sqlite_pragmas(engine, get_sqlite_pragmas())
+        apply_sqlite_pragmas(async_engine, get_sqlite_pragmas())
+        if SPLIT_READ_WRITE:
+            apply_sqlite_pragmas(async_read_engine, get_sqlite_pragmas(), query_only=True)
+
+    SessionLocal.configure(bind=engine)
+    AsyncSessionLocal.configure(bind=async_engine)
+    AsyncReadSessionLocal.configure(bind=async_read_engine)
+
+async def prime_pools() -> int:
+    """Открыть постоянные соединения асинхронных пулов заранее.
+
+    Первые запросы после старта не платят за подключение и прагмы.
+    Возвращает число открытых соединений.
+    """
+    async def touch(target: AsyncEngine, count: int) -> int:
+        connections = []
+        try:
+            # Держим все сразу: по очереди пул вернул бы одно и то же соединение
+            for _ in range(count):
+                connection = await target.connect()
+                connections.append(connection)
+                await connection.execute(text("SELECT 1"))
+        finally:
+            for connection in connections:
+                await connection.close()
+        return len(connections)
+
+    opened = 0
+    for target in {async_engine, async_read_engine}:
+        size = getattr(target.pool, "size", None)
+        opened += await touch(target, size() if callable(size) else 1)
+    return opened
+
+async def dispose_engines():
+    global engine, async_engine, async_read_engine
+    if engine is None:
+        return
+    await async_engine.dispose()
+    if async_read_engine is not async_engine:
+        await async_read_engine.dispose()
+    engine.dispose()
+    engine = async_engine = async_read_engine = None
+
+# SQLite допускает одного писателя: конкурирующие транзакции ждут busy timeout,
+# поэтому записи из event loop выстраиваются в очередь заранее
+_sqlite_write_lock = asyncio.Lock() if IS_SQLITE else None
+
+def write_lock():
+    return _sqlite_write_lock or contextlib.nullcontext()
 
 Base = declarative_base()
 
@@ -20,4 +181,12 @@ def get_db():
     try:
         yield db
     finally:
-        db.close()
\ No newline at end of file
+        db.close()
+
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+async def get_async_read_db():
+    async with AsyncReadSessionLocal() as db:
+        yield db
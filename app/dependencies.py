@@ -1,32 +1,32 @@
 from fastapi import Depends, HTTPException, status, Cookie
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from sqlalchemy.orm import Session
-from . import crud, auth, database
+from sqlalchemy.ext.asyncio import AsyncSession
+from . import cache, database
 
 security = HTTPBearer()
 
-def get_current_user(
-    db: Session = Depends(database.get_db),
+async def get_current_user(
+    db: AsyncSession = Depends(database.get_async_read_db),
     authorization: HTTPAuthorizationCredentials = Depends(security)
 ):
     token = authorization.credentials
-    user_id = auth.decode_access_token(token)
+    user_id = cache.decode_access_token(token)
     if user_id is None:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid authentication credentials",
             headers={"WWW-Authenticate": "Bearer"},
         )
-    user = crud.get_user_by_id(db, user_id)
-    if user is None:
+    user = await cache.get_user(db, user_id)
+    if user is None or not user.is_active:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="User not found",
         )
     return user
 
-def get_current_user_from_cookie(
-    db: Session = Depends(database.get_db),
+async def get_current_user_from_cookie(
+    db: AsyncSession = Depends(database.get_async_read_db),
     access_token: str = Cookie(None, alias="access_token")
 ):
     if not access_token:
@@ -35,15 +35,15 @@ def get_current_user_from_cookie(
             detail="Not authenticated",
         )
     
-    user_id = auth.decode_access_token(access_token)
+    user_id = cache.decode_access_token(access_token)
     if user_id is None:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid authentication credentials",
         )
     
-    user = crud.get_user_by_id(db, user_id)
-    if user is None:
+    user = await cache.get_user(db, user_id)
+    if user is None or not user.is_active:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="User not found",
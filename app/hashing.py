@@ -0,0 +1,62 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple
+
+from . import auth
+
+# bcrypt занимает сотни миллисекунд CPU. В обработчике event loop это
+# останавливало бы все WebSocket-соединения воркера, поэтому хеширование
+# и проверка идут в отдельном пуле потоков (bcrypt отпускает GIL).
+# Очередь ограничена: при шторме логинов лишние запросы сразу получают
+# 429, а не копятся минутами.
+
+class PoolSaturated(Exception):
+    pass
+
+class PasswordHasher:
+    def __init__(self, workers: Optional[int] = None, queue_limit: Optional[int] = None):
+        self.workers = workers or int(os.getenv("BCRYPT_WORKERS", min(4, os.cpu_count() or 1)))
+        self.queue_limit = queue_limit if queue_limit is not None else int(os.getenv("BCRYPT_QUEUE_LIMIT", 64))
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self.in_flight = 0
+        self.completed = 0
+        self.rejected = 0
+
+    async def _run(self, func, *args):
+        # Работают workers задач, еще queue_limit ждут в очереди пула
+        if self.in_flight >= self.workers + self.queue_limit:
+            self.rejected += 1
+            raise PoolSaturated()
+        # Пул создается при первом хешировании, в том числе после shutdown
+        # (lifespan, запущенный повторно в том же процессе)
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="bcrypt")
+        self.in_flight += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+        finally:
+            self.in_flight -= 1
+            self.completed += 1
+
+    async def hash(self, password: str) -> str:
+        return await self._run(auth.get_password_hash, password)
+
+    async def verify_and_update(self, password: str, hashed_password: str) -> Tuple[bool, Optional[str]]:
+        return await self._run(auth.verify_and_update_password, password, hashed_password)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "queue_limit": self.queue_limit,
+            "in_flight": self.in_flight,
+            "completed": self.completed,
+            "rejected": self.rejected,
+        }
+
+password_hasher = PasswordHasher()
@@ -0,0 +1,147 @@
+import os
+import time
+from typing import Dict, Optional, Tuple
+
+# Ограничения входящих WebSocket-кадров. Без них один клиент мог слать
+# кадры любого размера с любой частотой и занимать запись в БД всех
+# остальных.
+#
+# Кадр проходит три ведра токенов: своего соединения, пользователя (все
+# его устройства вместе) и общее ведро воркера. Кадры стоят по-разному:
+# набор текста почти ничего, sync - как несколько сообщений.
+#
+# Превышение лимита соединения или пользователя - ошибка клиента: он
+# получает кадр error с retry_after, а после WS_MAX_VIOLATIONS отказов
+# подряд соединение закрывается с 1008. Пустое общее ведро или очередь
+# записи - перегрузка сервера: кадр error с кодом overloaded, в нарушения
+# не засчитывается.
+
+MAX_FRAME_BYTES = int(os.getenv("WS_MAX_FRAME_BYTES", 64 * 1024))
+MAX_CONTENT_LENGTH = int(os.getenv("MESSAGE_MAX_LENGTH", 4096))
+
+FRAME_COSTS = {"typing": 0.2, "sync": 5.0}
+DEFAULT_FRAME_COST = 1.0
+
+# Коды кадра error
+RATE_LIMITED = "rate_limited"
+OVERLOADED = "overloaded"
+TOO_LARGE = "too_large"
+INVALID = "invalid"
+# Отправитель не состоит в группе
+FORBIDDEN = "forbidden"
+# Получателя личного сообщения не существует
+UNKNOWN_RECEIVER = "unknown_receiver"
+REJECT_CODES = (RATE_LIMITED, OVERLOADED, TOO_LARGE, INVALID, FORBIDDEN, UNKNOWN_RECEIVER)
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def wait_time(self, cost: float, now: float) -> float:
+        """Пополнить ведро; 0 - токенов хватает, иначе сколько секунд ждать"""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= cost:
+            return 0.0
+        return (cost - self.tokens) / self.rate
+
+class ConnectionQuota:
+    """Ведро одного соединения и счетчик отказов подряд"""
+
+    def __init__(self, limiter: "IngressLimiter", user_id: int):
+        self.limiter = limiter
+        self.user_id = user_id
+        self.bucket = TokenBucket(limiter.connection_rate, limiter.connection_burst)
+        self.violations = 0
+
+    def admit(self, frame_type: Optional[str]) -> Optional[Tuple[str, float]]:
+        """None - кадр принят, иначе (код отказа, retry_after)"""
+        return self.limiter.admit(self, frame_type)
+
+    def rejected(self, code: str) -> bool:
+        """Учесть отказ; True - клиент исчерпал терпение сервера, закрываем"""
+        self.limiter.rejected[code] += 1
+        if code == OVERLOADED:
+            return False
+        self.violations += 1
+        if self.violations >= self.limiter.max_violations:
+            self.limiter.policy_closes += 1
+            return True
+        return False
+
+    def release(self):
+        self.limiter.release(self.user_id)
+
+class IngressLimiter:
+    def __init__(self):
+        self.connection_rate = float(os.getenv("WS_CONNECTION_RATE", 10))
+        self.connection_burst = float(os.getenv("WS_CONNECTION_BURST", 30))
+        self.user_rate = float(os.getenv("WS_USER_RATE", 20))
+        self.user_burst = float(os.getenv("WS_USER_BURST", 60))
+        self.max_violations = int(os.getenv("WS_MAX_VIOLATIONS", 20))
+
+        # Общий бюджет воркера: сколько кадров в секунду он готов разбирать
+        self.ingress = TokenBucket(
+            float(os.getenv("WS_INGRESS_RATE", 2000)),
+            float(os.getenv("WS_INGRESS_BURST", 4000))
+        )
+        # user_id -> (ведро пользователя, число его соединений в воркере)
+        self.users: Dict[int, Tuple[TokenBucket, int]] = {}
+
+        self.accepted = 0
+        self.rejected: Dict[str, int] = {code: 0 for code in REJECT_CODES}
+        self.policy_closes = 0
+        self.oversized_frames = 0
+        self.invalid_frames = 0
+
+    def open(self, user_id: int) -> ConnectionQuota:
+        bucket, connections = self.users.get(user_id, (None, 0))
+        if bucket is None:
+            bucket = TokenBucket(self.user_rate, self.user_burst)
+        self.users[user_id] = (bucket, connections + 1)
+        return ConnectionQuota(self, user_id)
+
+    def release(self, user_id: int):
+        bucket, connections = self.users.get(user_id, (None, 0))
+        if connections > 1:
+            self.users[user_id] = (bucket, connections - 1)
+        else:
+            self.users.pop(user_id, None)
+
+    def admit(self, quota: ConnectionQuota, frame_type: Optional[str]) -> Optional[Tuple[str, float]]:
+        cost = FRAME_COSTS.get(frame_type, DEFAULT_FRAME_COST)
+        now = time.monotonic()
+        user_bucket = self.users[quota.user_id][0]
+
+        # Токены списываются только если кадр проходят все три ведра
+        wait = max(quota.bucket.wait_time(cost, now), user_bucket.wait_time(cost, now))
+        if wait > 0:
+            return RATE_LIMITED, wait
+        wait = self.ingress.wait_time(cost, now)
+        if wait > 0:
+            return OVERLOADED, wait
+
+        quota.bucket.tokens -= cost
+        user_bucket.tokens -= cost
+        self.ingress.tokens -= cost
+        quota.violations = 0
+        self.accepted += 1
+        return None
+
+    def stats(self) -> dict:
+        return {
+            "accepted": self.accepted,
+            "rejected": dict(self.rejected),
+            "policy_closes": self.policy_closes,
+            "oversized_frames": self.oversized_frames,
+            "invalid_frames": self.invalid_frames,
+            "ingress_tokens": round(self.ingress.tokens, 1),
+            "tracked_users": len(self.users),
+        }
+
+ingress = IngressLimiter()
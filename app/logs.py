@@ -0,0 +1,96 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+from datetime import datetime, timezone
+from typing import Dict, Optional, Tuple
+
+# Логи приложения (логгеры app.*).
+#
+#   LOG_LEVEL        - уровень (INFO по умолчанию)
+#   LOG_FORMAT       - json (строка JSON на событие) или text
+#   LOG_SAMPLE_EVERY - из частых событий (extra={"sample": True}) пишется
+#                      каждое N-е, в записи поле sampled=N
+#
+# В stdout пишет отдельный поток через QueueHandler: event loop только
+# кладет запись в очередь и не ждет терминал или сборщик логов.
+
+# Поля LogRecord, которые не относятся к extra
+_RECORD_FIELDS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "sample"}
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname.lower(),
+            "logger": record.name,
+            "event": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_FIELDS:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    def format(self, record: logging.LogRecord) -> str:
+        line = super().format(record)
+        extra = " ".join(f"{key}={value}" for key, value in record.__dict__.items() if key not in _RECORD_FIELDS)
+        return f"{line} {extra}" if extra else line
+
+class SampleFilter(logging.Filter):
+    """Пропускает каждое N-е из событий с extra={"sample": True}, считая по тексту события"""
+
+    def __init__(self, every: int):
+        super().__init__()
+        self.every = every
+        self.seen: Dict[Tuple[str, str], int] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not getattr(record, "sample", False) or self.every <= 1:
+            return True
+        key = (record.name, record.msg)
+        seen = self.seen.get(key, 0)
+        self.seen[key] = seen + 1
+        if seen % self.every:
+            return False
+        record.sampled = self.every
+        return True
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+def configure():
+    global _listener
+    if _listener is not None:
+        return
+
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(JsonFormatter() if os.getenv("LOG_FORMAT", "text") == "json" else TextFormatter())
+
+    records: queue.SimpleQueue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(records)
+    # Отбор - до очереди, чтобы отброшенные записи не стоили форматирования
+    queue_handler.addFilter(SampleFilter(int(os.getenv("LOG_SAMPLE_EVERY", 100))))
+
+    logger = logging.getLogger("app")
+    logger.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+    logger.addHandler(queue_handler)
+    logger.propagate = False
+
+    _listener = logging.handlers.QueueListener(records, handler)
+    _listener.start()
+    atexit.register(shutdown)
+
+def shutdown():
+    """Дописать очередь логов (остановка воркера)"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -1,21 +1,29 @@
-from fastapi import FastAPI, Request, Depends, HTTPException, status, Form, WebSocket, WebSocketDisconnect
-from fastapi.responses import HTMLResponse, RedirectResponse
+from fastapi import FastAPI, Request, Depends, HTTPException, status, Form, Query, WebSocket, WebSocketDisconnect
+from fastapi.responses import HTMLResponse, PlainTextResponse, RedirectResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
-from sqlalchemy.orm import Session
-import json
-from typing import Dict
+from pydantic import ValidationError
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import Optional
 
-from . import models, schemas, crud, auth, dependencies
-from .database import engine, get_db
+from . import schemas, crud, crud_async, auth, cache, codecs, database, dependencies, limits, logs, metrics, migrations, search, warmup
+from .archive import message_archiver
+from .message_cache import recent_messages
+from .persistence import message_writer
+from .receipts import read_receipts
+from .hashing import PoolSaturated, password_hasher
+from .presence import presence
+from .websocket import Connection, FrameRejected, authenticate_websocket, manager
+from .database import AsyncSessionLocal, AsyncReadSessionLocal, get_async_db, get_async_read_db
+from contextlib import asynccontextmanager
+import hashlib
+import logging
 import os
-from dotenv import load_dotenv
+import time
 
-load_dotenv()
-
-models.Base.metadata.create_all(bind=engine)
-
-app = FastAPI(title="Telegram-like Messenger")
+logs.configure()
+logger = logging.getLogger(__name__)
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 PROJECT_ROOT = os.path.dirname(BASE_DIR)
@@ -23,66 +31,236 @@ PROJECT_ROOT = os.path.dirname(BASE_DIR)
 static_dir = os.path.join(PROJECT_ROOT, "app", "static")
 templates_dir = os.path.join(PROJECT_ROOT, "templates")
 
-app.mount("/static", StaticFiles(directory=static_dir), name="static")
 templates = Jinja2Templates(directory=templates_dir)
 
-# WebSocket соединения
-class ConnectionManager:
-    def __init__(self):
-        self.active_connections: Dict[int, WebSocket] = {}
-    
-    async def connect(self, websocket: WebSocket, user_id: int):
-        await websocket.accept()
-        self.active_connections[user_id] = websocket
-        print(f"User {user_id} connected")
-    
-    def disconnect(self, user_id: int):
-        if user_id in self.active_connections:
-            del self.active_connections[user_id]
-            print(f"User {user_id} disconnected")
-    
-    async def send_personal_message(self, message: str, user_id: int):
-        if user_id in self.active_connections:
-            try:
-                await self.active_connections[user_id].send_text(message)
-            except:
-                self.disconnect(user_id)
+# Время старта воркера для /stats: от импорта модуля до готовности принимать трафик
+IMPORTED_AT = time.perf_counter()
+startup_stats: dict = {}
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Схему создают и обновляют миграции шагом деплоя (python run.py migrate);
+    # воркер только открывает пулы и проверяет, что схема актуальна
+    began = time.perf_counter()
+    database.init_engines()
+    migrations.check(database.engine)
 
-manager = ConnectionManager()
+    await manager.backplane.start(manager.deliver_local, manager.deliver_local_many)
+    await message_writer.start()
+    await read_receipts.start(manager.send_personal_message)
+    await presence.start(manager.send_personal_message)
+    await message_archiver.start()
+    if warmup.ENABLED:
+        startup_stats["warmup"] = await warmup.warm_up(templates.env)
 
+    ready = time.perf_counter()
+    startup_stats["lifespan_seconds"] = ready - began
+    startup_stats["since_import_seconds"] = ready - IMPORTED_AT
+    logger.info("worker ready", extra={"startup_seconds": round(ready - IMPORTED_AT, 3)})
+    try:
+        yield
+    finally:
+        # Сначала дописываем очередь сообщений, потом закрываем шину и пул
+        await message_writer.close()
+        await message_archiver.close()
+        await read_receipts.close()
+        await presence.close()
+        await manager.backplane.close()
+        await database.dispose_engines()
+        password_hasher.shutdown()
+
+app = FastAPI(title="Telegram-like Messenger", lifespan=lifespan)
+app.add_middleware(metrics.MetricsMiddleware)
+app.mount("/static", StaticFiles(directory=static_dir), name="static")
+
+# WebSocket: пользователь определяется по токену (cookie или ?token=),
+# у пользователя может быть несколько устройств одновременно
+@app.websocket("/ws")
+async def websocket_endpoint(websocket: WebSocket):
+    await serve_websocket(websocket)
+
+# Старый адрес: id в пути должен совпадать с владельцем токена
 @app.websocket("/ws/{user_id}")
-async def websocket_endpoint(websocket: WebSocket, user_id: int):
-    await manager.connect(websocket, user_id)
-    
+async def websocket_endpoint_by_id(websocket: WebSocket, user_id: int):
+    await serve_websocket(websocket, user_id)
+
+async def serve_websocket(websocket: WebSocket, expected_user_id: Optional[int] = None):
+    # Одна сессия на соединение, закрывается при выходе из цикла
+    async with AsyncReadSessionLocal() as db:
+        user = await authenticate_websocket(websocket, db)
+        # Соединение с БД возвращается в пул сразу после запроса: иначе
+        # каждый открытый сокет держал бы его до отключения
+        await db.close()
+        if user is None or (expected_user_id is not None and user.id != expected_user_id):
+            await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+            return
+        
+        connection = await manager.connect(websocket, user.id)
+        presence.connected(user.id)
+        try:
+            await receive_loop(connection, db)
+        finally:
+            await manager.disconnect(connection)
+            await presence.disconnected(user.id)
+
+async def receive_loop(connection: Connection, db: AsyncSession):
+    user_id = connection.user_id
     try:
         while True:
-            data = await websocket.receive_text()
-            message_data = json.loads(data)
+            try:
+                message_data = await connection.receive_event()
+            except FrameRejected as e:
+                await connection.close(e.close_code)
+                break
+            presence.touch(user_id)
             
-            if message_data["type"] == "message":
-                db = next(get_db())
-                message = schemas.MessageCreate(
-                    content=message_data["content"],
-                    receiver_id=message_data["receiver_id"]
-                )
-                db_message = crud.create_message(db, message, user_id)
-                
-                await websocket.send_text(json.dumps({
-                    "type": "message_sent",
-                    "message_id": db_message.id
-                }))
-                
-                await manager.send_personal_message(json.dumps({
-                    "type": "new_message",
-                    "sender_id": user_id,
-                    "content": message_data["content"],
-                    "timestamp": db_message.created_at.isoformat()
-                }), message_data["receiver_id"])
+            frame_type = message_data.get("type")
+            metrics.ws_frames_received.labels(frame_type if frame_type in FRAME_TYPES else "other").inc()
+            rejection = connection.quota.admit(frame_type)
+            if rejection is None:
+                try:
+                    rejection = await handle_frame(connection, db, frame_type, message_data)
+                # ValueError - нечисловой id в int(), ValidationError - схема
+                except (KeyError, TypeError, ValueError, ValidationError):
+                    rejection = (limits.INVALID, None)
+            
+            if rejection is not None and await reject_frame(connection, frame_type, *rejection):
+                break
     
     except WebSocketDisconnect:
-        manager.disconnect(user_id)
-    except Exception as e:
-        manager.disconnect(user_id)
+        pass
+    except Exception:
+        logger.exception("websocket receive loop failed", extra={"user_id": user_id})
+        # Клиент не должен ждать ответа на кадр, который сервер не обработает
+        await connection.close(status.WS_1011_INTERNAL_ERROR)
+
+FRAME_TYPES = ("message", "typing", "read", "sync")
+
+async def reject_frame(connection: Connection, frame_type, code: str, retry_after: Optional[float]) -> bool:
+    """Ответить кадром error; True - соединение закрыто за повторные нарушения"""
+    event = {"type": "error", "code": code, "frame": frame_type}
+    if retry_after is not None:
+        event["retry_after"] = round(retry_after, 3)
+    await connection.send_event(event)
+    if connection.quota.rejected(code):
+        await connection.close(status.WS_1008_POLICY_VIOLATION)
+        return True
+    return False
+
+async def handle_frame(connection: Connection, db: AsyncSession, frame_type, message_data: dict):
+    """Обработать принятый кадр; вернуть (код отказа, retry_after), если он отклонен"""
+    user_id = connection.user_id
+    
+    if frame_type == "message":
+        # Сообщение в группу адресуется conversation_id, личное - receiver_id
+        if "conversation_id" in message_data:
+            message = schemas.GroupMessageCreate(
+                content=message_data["content"],
+                conversation_id=message_data["conversation_id"]
+            )
+        else:
+            message = schemas.MessageCreate(
+                content=message_data["content"],
+                receiver_id=message_data["receiver_id"]
+            )
+        if len(message.content) > limits.MAX_CONTENT_LENGTH:
+            return limits.TOO_LARGE, None
+        # Запись не успевает за приемом - новые сообщения не принимаем,
+        # пока очередь не разберется
+        if message_writer.saturated:
+            return limits.OVERLOADED, message_writer.flush_interval
+        
+        members = None
+        if isinstance(message, schemas.GroupMessageCreate):
+            try:
+                members = await cache.get_group_members(db, message.conversation_id)
+            finally:
+                await db.close()
+            if user_id not in members:
+                return limits.FORBIDDEN, None
+        else:
+            # Проверка до записи: строка с несуществующим получателем
+            # нарушила бы внешний ключ и уронила пакет записи
+            try:
+                receiver = await cache.get_user(db, message.receiver_id)
+            finally:
+                await db.close()
+            if receiver is None:
+                return limits.UNKNOWN_RECEIVER, None
+        
+        pending = await message_writer.submit(user_id, message)
+        metrics.messages_received.inc()
+        
+        # Доставка не ждет записи в БД, подтверждение - ждет
+        # уровня надежности из MESSAGE_DURABILITY
+        event = {
+            "type": "new_message",
+            "message_id": pending.id,
+            "sender_id": user_id,
+            "content": message.content,
+            "timestamp": pending.created_at.isoformat()
+        }
+        if members is None:
+            await manager.send_personal_message(event, message.receiver_id)
+        else:
+            event["conversation_id"] = message.conversation_id
+            await manager.send_group_message(event, [member_id for member_id in members if member_id != user_id])
+        # Остальные устройства отправителя показывают свое исходящее сообщение
+        # сразу, а не после следующей синхронизации
+        if members is None:
+            event["receiver_id"] = message.receiver_id
+        await manager.send_personal_message(event, user_id, origin=connection)
+        
+        try:
+            await pending.durable
+        except Exception:
+            await connection.send_event({
+                "type": "message_failed",
+                "message_id": pending.id
+            })
+            return None
+        
+        await connection.send_event({
+            "type": "message_sent",
+            "message_id": pending.id,
+            "timestamp": pending.created_at.isoformat()
+        })
+    
+    elif frame_type == "typing":
+        # Частые события набора склеиваются, собеседник видит только смену состояния
+        await presence.typing_changed(
+            user_id, int(message_data["receiver_id"]), bool(message_data.get("is_typing", True))
+        )
+    
+    elif frame_type == "read":
+        # Сессия соединения - только для чтения, запись идет через свою
+        async with AsyncSessionLocal() as write_db:
+            if "conversation_id" in message_data:
+                await crud_async.mark_group_read(
+                    write_db, user_id, int(message_data["conversation_id"]), message_data.get("message_id")
+                )
+            else:
+                await mark_read(write_db, user_id, int(message_data["user_id"]), message_data.get("message_id"))
+    
+    elif frame_type == "sync":
+        # После переподключения клиент догружает только изменения
+        try:
+            request = schemas.SyncRequest(
+                conversations=message_data.get("conversations") or {},
+                groups=message_data.get("groups") or {},
+                since=message_data.get("since")
+            )
+            changes = await get_sync_changes(db, user_id, request)
+        except ValueError as e:
+            await connection.send_event({"type": "sync_failed", "detail": str(e)})
+            return None
+        finally:
+            await db.close()
+        await connection.send_event(dict(changes, type="sync"))
+    
+    else:
+        return limits.INVALID, None
+    return None
 
 # Главная страница
 @app.get("/", response_class=HTMLResponse)
@@ -100,16 +278,16 @@ async def register(
     username: str = Form(...),
     email: str = Form(...),
     password: str = Form(...),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
-    db_user = crud.get_user_by_email(db, email)
+    db_user = await crud_async.get_user_by_email(db, email)
     if db_user:
         return templates.TemplateResponse(
             "register.html",
             {"request": request, "error": "Email already registered"}
         )
     
-    db_user = crud.get_user_by_username(db, username)
+    db_user = await crud_async.get_user_by_username(db, username)
     if db_user:
         return templates.TemplateResponse(
             "register.html",
@@ -122,13 +300,34 @@ async def register(
         password=password
     )
     
-    user = crud.create_user(db, user_create)
+    try:
+        user = await crud_async.create_user(db, user_create)
+    except PoolSaturated:
+        return too_many_requests(request, "register.html")
+    except IntegrityError:
+        # Пока считался хеш, параллельный запрос зарегистрировал тот же
+        # email или имя - ответ тот же, что и при проверке выше
+        await db.rollback()
+        email_taken = await crud_async.get_user_by_email(db, email) is not None
+        return templates.TemplateResponse(
+            "register.html",
+            {"request": request, "error": "Email already registered" if email_taken else "Username already taken"}
+        )
     
     access_token = auth.create_access_token(data={"sub": str(user.id)})
     response = RedirectResponse(url="/chats", status_code=status.HTTP_303_SEE_OTHER)
     response.set_cookie(key="access_token", value=access_token, httponly=True)
     return response
 
+# Пул bcrypt переполнен: клиенту лучше повторить позже, чем ждать в очереди
+def too_many_requests(request: Request, template: str):
+    return templates.TemplateResponse(
+        template,
+        {"request": request, "error": "Too many requests, please try again in a moment"},
+        status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+        headers={"Retry-After": "1"}
+    )
+
 # Вход
 @app.get("/login", response_class=HTMLResponse)
 async def login_page(request: Request):
@@ -139,9 +338,12 @@ async def login(
     request: Request,
     email: str = Form(...),
     password: str = Form(...),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
-    user = crud.authenticate_user(db, email, password)
+    try:
+        user = await crud_async.authenticate_user(db, email, password)
+    except PoolSaturated:
+        return too_many_requests(request, "login.html")
     if not user:
         return templates.TemplateResponse(
             "login.html",
@@ -164,56 +366,446 @@ async def logout():
 @app.get("/chats", response_class=HTMLResponse)
 async def chats_page(
     request: Request,
-    current_user: models.User = Depends(dependencies.get_current_user_from_cookie),
-    db: Session = Depends(get_db)
+    current_user: cache.CachedUser = Depends(dependencies.get_current_user_from_cookie)
 ):
-    users = crud.get_all_users(db)
+    # Список чатов страница подгружает сама через /api/chats
     return templates.TemplateResponse(
         "chats.html",
         {
             "request": request,
             "current_user": current_user,
-            "users": users,
             "current_user_id": current_user.id
         }
     )
 
+# Список диалогов текущего пользователя по последней активности
+@app.get("/api/chats")
+async def get_chats(
+    before: Optional[str] = None,
+    limit: int = Query(crud.DEFAULT_PAGE_SIZE, ge=1, le=crud.MAX_PAGE_SIZE),
+    current_user: cache.CachedUser = Depends(dependencies.get_current_user_from_cookie),
+    db: AsyncSession = Depends(get_async_read_db)
+):
+    before_id = None
+    if before:
+        before_id = crud.decode_cursor(before, "c")
+        if before_id is None:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Invalid cursor",
+            )
+
+    rows, next_cursor = await crud_async.get_chat_list(db, current_user.id, before=before_id, limit=limit)
+    peers = await presence.get_presence(db, {peer_id for _, _, peer_id, _ in rows if peer_id is not None})
+    # У группы нет собеседника: вместо имени - название, онлайн-статуса нет
+    no_peer = {"online": False, "last_seen": None}
+    return {
+        "chats": [
+            {
+                "conversation_id": conversation.id,
+                "is_group": conversation.is_group,
+                "title": conversation.title,
+                "user_id": peer_id,
+                "username": username,
+                "unread_count": unread_count,
+                "online": peers.get(peer_id, no_peer)["online"],
+                "last_seen": peers.get(peer_id, no_peer)["last_seen"],
+                "last_message": {
+                    "id": conversation.last_message_id,
+                    "sender_id": conversation.last_message_sender_id,
+                    "preview": conversation.last_message_preview,
+                    "created_at": conversation.last_message_at.isoformat()
+                }
+            }
+            for conversation, unread_count, peer_id, username in rows
+        ],
+        "next_cursor": next_cursor
+    }
+
+@app.post("/api/chats/{user_id}/read")
+async def mark_chat_read(
+    user_id: int,
+    message_id: Optional[int] = None,
+    current_user: cache.CachedUser = Depends(dependencies.get_current_user_from_cookie),
+    db: AsyncSession = Depends(get_async_db)
+):
+    last_read_message_id = await mark_read(db, current_user.id, user_id, message_id)
+    return {"last_read_message_id": last_read_message_id}
+
+async def mark_read(db: AsyncSession, user_id: int, peer_id: int, message_id: Optional[int] = None):
+    result = await crud_async.mark_conversation_read(db, user_id, peer_id, message_id)
+    if result is None:
+        return None
+    # Собеседник узнает о прочтении одним склеенным событием
+    conversation_id, last_read_message_id = result
+    read_receipts.notify(peer_id, user_id, conversation_id, last_read_message_id)
+    return last_read_message_id
+
+# Онлайн-статус пачки пользователей: ids=1,2,3
+@app.get("/api/presence")
+async def get_presence(
+    ids: str = Query(..., max_length=2000),
+    current_user: cache.CachedUser = Depends(dependencies.get_current_user_from_cookie),
+    db: AsyncSession = Depends(get_async_read_db)
+):
+    try:
+        user_ids = {int(user_id) for user_id in ids.split(",") if user_id}
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="ids must be comma-separated integers",
+        )
+    if len(user_ids) > crud.MAX_PAGE_SIZE:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Too many ids, max {crud.MAX_PAGE_SIZE}",
+        )
+    return await presence.get_presence(db, user_ids)
+
+# Поиск собеседников по началу имени
+@app.get("/api/users/search")
+async def search_users(
+    q: str = Query(..., min_length=1, max_length=64),
+    limit: int = Query(20, ge=1, le=50),
+    current_user: cache.CachedUser = Depends(dependencies.get_current_user_from_cookie),
+    db: AsyncSession = Depends(get_async_read_db)
+):
+    users = await crud_async.search_users(db, q, limit)
+    return [
+        {"id": user.id, "username": user.username}
+        for user in users
+        if user.id != current_user.id
+    ]
+
+# Полнотекстовый поиск по истории своих диалогов
+@app.get("/api/search")
+async def search_messages(
+    q: str = Query(..., min_length=1, max_length=256),
+    limit: int = Query(20, ge=1, le=100),
+    offset: int = Query(0, ge=0, le=1000),
+    current_user: cache.CachedUser = Depends(dependencies.get_current_user_from_cookie),
+    db: AsyncSession = Depends(get_async_read_db)
+):
+    if search.backend.name == "none":
+        raise HTTPException(status_code=status.HTTP_501_NOT_IMPLEMENTED, detail="Message search is disabled")
+    rows = await crud_async.search_messages(db, current_user.id, q, limit + 1, offset)
+    return {
+        "results": [
+            {
+                "message_id": message_id,
+                "conversation_id": conversation_id,
+                "user_id": peer_id,
+                "username": username,
+                "sender_id": sender_id,
+                "created_at": created_at.isoformat(),
+                "snippet": search.snippet_to_html(snippet)
+            }
+            for message_id, conversation_id, sender_id, peer_id, username, created_at, snippet in rows[:limit]
+        ],
+        "next_offset": offset + limit if len(rows) > limit else None
+    }
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+# Сообщений в одном куске потокового ответа
+HISTORY_CHUNK_SIZE = 50
+
+async def get_history_page(
+    request: Request,
+    db: AsyncSession,
+    current_user: cache.CachedUser,
+    before: Optional[str],
+    after: Optional[str],
+    limit: int,
+    peer_id: Optional[int] = None,
+    group_id: Optional[int] = None
+) -> Response:
+    """Страница истории личного диалога с peer_id или группы group_id.
+
+    Тело собирается из уже закодированных кусков без промежуточного
+    словаря на всю страницу. Accept: application/x-ndjson - по строке на
+    сообщение, курсор в заголовке X-Next-Cursor; иначе прежний JSON
+    {"messages": [...], "next_cursor": ...}, отдаваемый частями.
+    ETag считается по id сообщений страницы (сообщения не меняются),
+    так что при совпадении If-None-Match кодирование и передача
+    пропускаются - ответ 304.
+    """
+    if before and after:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Use either before or after cursor",
+        )
+    cursors = {}
+    for name, cursor in (("before", before), ("after", after)):
+        if cursor:
+            cursors[name] = crud.decode_cursor(cursor)
+            if cursors[name] is None:
+                raise HTTPException(
+                    status_code=status.HTTP_400_BAD_REQUEST,
+                    detail="Invalid cursor",
+                )
+
+    if group_id is None:
+        messages, next_cursor = await crud_async.get_messages_between_users(
+            db, current_user.id, peer_id, limit=limit, **cursors
+        )
+    else:
+        page = await crud_async.get_group_messages(db, current_user.id, group_id, limit=limit, **cursors)
+        if page is None:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="Group not found",
+            )
+        messages, next_cursor = page
+
+    ndjson = NDJSON_MEDIA_TYPE in request.headers.get("accept", "")
+    etag = history_etag(current_user.id, messages, next_cursor, ndjson)
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache", "Vary": "Accept, Cookie"}
+    if etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    if ndjson:
+        if next_cursor:
+            headers["X-Next-Cursor"] = next_cursor
+        body = stream_history_ndjson(messages, current_user.id)
+        return StreamingResponse(body, media_type=NDJSON_MEDIA_TYPE, headers=headers)
+    body = stream_history_json(messages, next_cursor, current_user.id)
+    return StreamingResponse(body, media_type="application/json", headers=headers)
+
+def history_etag(viewer_id: int, messages: list, next_cursor: Optional[str], ndjson: bool) -> str:
+    digest = hashlib.blake2b(digest_size=12)
+    # is_sent зависит от того, кто смотрит
+    digest.update(f"{viewer_id}:{int(ndjson)}:{next_cursor}:".encode())
+    digest.update(",".join(str(msg.id) for msg in messages).encode())
+    return f'"{digest.hexdigest()}"'
+
+def _encoded_chunks(messages: list, current_user_id: int):
+    for start in range(0, len(messages), HISTORY_CHUNK_SIZE):
+        yield [
+            codecs.dumps_bytes(serialize_message(msg, current_user_id))
+            for msg in messages[start:start + HISTORY_CHUNK_SIZE]
+        ]
+
+def stream_history_ndjson(messages: list, current_user_id: int):
+    for chunk in _encoded_chunks(messages, current_user_id):
+        yield b"\n".join(chunk) + b"\n"
+
+def stream_history_json(messages: list, next_cursor: Optional[str], current_user_id: int):
+    separator = b'{"messages":['
+    for chunk in _encoded_chunks(messages, current_user_id):
+        yield separator + b",".join(chunk)
+        separator = b","
+    if separator != b",":
+        yield separator
+    yield b'],"next_cursor":' + codecs.dumps_bytes(next_cursor) + b"}"
+
+def serialize_message(msg, current_user_id: int) -> dict:
+    # msg - models.Message или message_cache.CachedMessage
+    return {
+        "id": msg.id,
+        "sender_id": msg.sender_id,
+        "content": msg.content,
+        "created_at": msg.created_at.isoformat(),
+        "is_sent": msg.sender_id == current_user_id
+    }
+
+async def get_sync_changes(
+    db: AsyncSession,
+    user_id: int,
+    request: schemas.SyncRequest,
+    limit: int = crud.DEFAULT_PAGE_SIZE
+) -> dict:
+    if len(request.conversations) + len(request.groups) > crud.MAX_PAGE_SIZE:
+        raise ValueError(f"Too many conversations, max {crud.MAX_PAGE_SIZE}")
+
+    changes, truncated = await crud_async.sync_conversations(
+        db, user_id, request.conversations, since=request.since, limit=limit, groups=request.groups
+    )
+    return {
+        "conversations": [
+            {
+                "conversation_id": conversation.id,
+                "is_group": conversation.is_group,
+                "title": conversation.title,
+                "user_id": peer_id,
+                "username": username,
+                "unread_count": unread_count,
+                "peer_unread_count": peer_unread_count,
+                "peer_last_read_id": peer_last_read_id,
+                "last_message_id": conversation.last_message_id,
+                "preview": conversation.last_message_preview,
+                "messages": [serialize_message(msg, user_id) for msg in messages],
+                "next_cursor": next_cursor
+            }
+            for (
+                conversation, unread_count, peer_unread_count, peer_last_read_id,
+                peer_id, username, messages, next_cursor
+            ) in changes
+        ],
+        # Изменений больше, чем помещается в ответ: клиенту проще перечитать список чатов
+        "truncated": truncated
+    }
+
+# Дельта-синхронизация: только то, что изменилось с последнего состояния клиента
+@app.post("/api/sync")
+async def sync(
+    request: schemas.SyncRequest,
+    current_user: cache.CachedUser = Depends(dependencies.get_current_user_from_cookie),
+    db: AsyncSession = Depends(get_async_read_db)
+):
+    try:
+        return await get_sync_changes(db, current_user.id, request)
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=str(e),
+        )
+
 # API для получения сообщений (работает с cookies)
 @app.get("/api/messages/{user_id}")
 async def get_messages(
+    request: Request,
     user_id: int,
-    current_user: models.User = Depends(dependencies.get_current_user_from_cookie),
-    db: Session = Depends(get_db)
+    before: Optional[str] = None,
+    after: Optional[str] = None,
+    limit: int = Query(crud.DEFAULT_PAGE_SIZE, ge=1, le=crud.MAX_PAGE_SIZE),
+    current_user: cache.CachedUser = Depends(dependencies.get_current_user_from_cookie),
+    db: AsyncSession = Depends(get_async_read_db)
 ):
-    messages = crud.get_messages_between_users(db, current_user.id, user_id)
-    
-    return [
-        {
-            "id": msg.id,
-            "sender_id": msg.sender_id,
-            "content": msg.content,
-            "created_at": msg.created_at.isoformat(),
-            "is_sent": msg.sender_id == current_user.id
-        }
-        for msg in messages
-    ]
+    return await get_history_page(request, db, current_user, before, after, limit, peer_id=user_id)
 
 # Простой маршрут для получения сообщений без авторизации в заголовках
 @app.get("/messages/{user_id}")
 async def get_messages_simple(
+    request: Request,
     user_id: int,
-    current_user: models.User = Depends(dependencies.get_current_user_from_cookie),
-    db: Session = Depends(get_db)
+    before: Optional[str] = None,
+    after: Optional[str] = None,
+    limit: int = Query(crud.DEFAULT_PAGE_SIZE, ge=1, le=crud.MAX_PAGE_SIZE),
+    current_user: cache.CachedUser = Depends(dependencies.get_current_user_from_cookie),
+    db: AsyncSession = Depends(get_async_read_db)
 ):
-    messages = crud.get_messages_between_users(db, current_user.id, user_id)
-    
-    return [
-        {
-            "id": msg.id,
-            "sender_id": msg.sender_id,
-            "content": msg.content,
-            "created_at": msg.created_at.isoformat(),
-            "is_sent": msg.sender_id == current_user.id
-        }
-        for msg in messages
-    ]
\ No newline at end of file
+    return await get_history_page(request, db, current_user, before, after, limit, peer_id=user_id)
+
+# Группы: сообщение хранится один раз, участники и их курсоры прочтения -
+# в conversation_members
+@app.post("/api/groups")
+async def create_group(
+    group: schemas.GroupCreate,
+    current_user: cache.CachedUser = Depends(dependencies.get_current_user_from_cookie),
+    db: AsyncSession = Depends(get_async_db)
+):
+    try:
+        conversation = await crud_async.create_group(db, group.title, current_user.id, group.member_ids)
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=str(e),
+        )
+    return {"conversation_id": conversation.id, "title": conversation.title}
+
+@app.get("/api/groups/{conversation_id}")
+async def get_group(
+    conversation_id: int,
+    current_user: cache.CachedUser = Depends(dependencies.get_current_user_from_cookie),
+    db: AsyncSession = Depends(get_async_read_db)
+):
+    conversation = await crud_async.get_group(db, conversation_id, current_user.id)
+    if conversation is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Group not found",
+        )
+    members = await cache.get_group_members(db, conversation_id)
+    return {
+        "conversation_id": conversation.id,
+        "title": conversation.title,
+        "created_by": conversation.created_by,
+        "member_ids": sorted(members)
+    }
+
+@app.post("/api/groups/{conversation_id}/members")
+async def add_group_members(
+    conversation_id: int,
+    members: schemas.GroupMembers,
+    current_user: cache.CachedUser = Depends(dependencies.get_current_user_from_cookie),
+    db: AsyncSession = Depends(get_async_db)
+):
+    try:
+        added = await crud_async.add_group_members(db, conversation_id, current_user.id, members.user_ids)
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=str(e),
+        )
+    if added is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Group not found",
+        )
+    return {"added": added}
+
+# Выйти из группы (свой id) или удалить участника (создатель группы)
+@app.delete("/api/groups/{conversation_id}/members/{user_id}")
+async def remove_group_member(
+    conversation_id: int,
+    user_id: int,
+    current_user: cache.CachedUser = Depends(dependencies.get_current_user_from_cookie),
+    db: AsyncSession = Depends(get_async_db)
+):
+    removed = await crud_async.remove_group_member(db, conversation_id, current_user.id, user_id)
+    if removed is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Group not found",
+        )
+    return {"removed": removed}
+
+@app.get("/api/groups/{conversation_id}/messages")
+async def get_group_messages(
+    request: Request,
+    conversation_id: int,
+    before: Optional[str] = None,
+    after: Optional[str] = None,
+    limit: int = Query(crud.DEFAULT_PAGE_SIZE, ge=1, le=crud.MAX_PAGE_SIZE),
+    current_user: cache.CachedUser = Depends(dependencies.get_current_user_from_cookie),
+    db: AsyncSession = Depends(get_async_read_db)
+):
+    return await get_history_page(request, db, current_user, before, after, limit, group_id=conversation_id)
+
+# Курсор прочтения участника; уведомлений о прочтении в группах нет -
+# это было бы событие каждому участнику на каждое прочтение
+@app.post("/api/groups/{conversation_id}/read")
+async def mark_group_read(
+    conversation_id: int,
+    message_id: Optional[int] = None,
+    current_user: cache.CachedUser = Depends(dependencies.get_current_user_from_cookie),
+    db: AsyncSession = Depends(get_async_db)
+):
+    result = await crud_async.mark_group_read(db, current_user.id, conversation_id, message_id)
+    return {"last_read_message_id": result[1] if result else None}
+
+# Счетчики для дашбордов
+def collect_stats() -> dict:
+    return {
+        "caches": cache.stats(),
+        "message_cache": recent_messages.stats(),
+        "websocket": manager.stats(),
+        "message_writer": message_writer.stats(),
+        "archive": message_archiver.stats(),
+        "read_receipts": read_receipts.stats(),
+        "password_hasher": password_hasher.stats(),
+        "presence": presence.stats(),
+        "ingress": limits.ingress.stats(),
+        "startup": startup_stats
+    }
+
+metrics.registry.add_collector(collect_stats)
+
+@app.get("/stats")
+async def get_stats():
+    return collect_stats()
+
+# Те же счетчики и гистограммы задержек в формате Prometheus
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    return PlainTextResponse(metrics.registry.render(), media_type="text/plain; version=0.0.4")
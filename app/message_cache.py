@@ -0,0 +1,173 @@
+import os
+import sys
+from collections import OrderedDict, deque
+from datetime import datetime
+from itertools import islice
+from typing import Deque, Iterable, List, Optional, Tuple
+
+# Последние сообщения активных диалогов в памяти воркера.
+#
+# Самую свежую страницу истории запрашивают снова и снова (открытие чата,
+# переподключение), и каждый раз это был запрос и ORM-объект на строку.
+# Здесь на диалог хранится кольцо из HOT_CACHE_MESSAGES компактных
+# сообщений; create_messages дописывает в уже закэшированные кольца после
+# коммита, а весь кэш ограничен бюджетом HOT_CACHE_BYTES с вытеснением
+# давно не читанных диалогов.
+#
+# Кольцо годится, только если его последнее сообщение совпадает с
+# conversations.last_message_id: так сообщения, записанные другим
+# воркером, не теряются - устаревшее кольцо просто перечитывается.
+
+class CachedMessage:
+    """Сообщение без ORM-состояния; serialize_message работает с ним как с моделью"""
+    __slots__ = ("id", "conversation_id", "sender_id", "receiver_id", "content", "created_at")
+
+    def __init__(self, id, conversation_id, sender_id, receiver_id, content, created_at):
+        self.id = id
+        self.conversation_id = conversation_id
+        self.sender_id = sender_id
+        self.receiver_id = receiver_id
+        self.content = content
+        self.created_at = created_at
+
+    @classmethod
+    def from_model(cls, message) -> "CachedMessage":
+        return cls(
+            message.id, message.conversation_id, message.sender_id,
+            message.receiver_id, message.content, message.created_at
+        )
+
+# Объект, datetime и четыре int; текст считается отдельно
+MESSAGE_OVERHEAD = (
+    sys.getsizeof(CachedMessage(0, 0, 0, 0, "", None))
+    + sys.getsizeof(datetime(2000, 1, 1))
+    + 4 * sys.getsizeof(2 ** 40)
+)
+
+def message_size(message: CachedMessage) -> int:
+    return MESSAGE_OVERHEAD + sys.getsizeof(message.content)
+
+class ConversationRing:
+    __slots__ = ("messages", "complete", "size")
+
+    def __init__(self, capacity: int):
+        self.messages: Deque[CachedMessage] = deque(maxlen=capacity)
+        # Кольцо держит всю историю диалога с первого сообщения
+        self.complete = False
+        self.size = 0
+
+class RecentMessageCache:
+    def __init__(self, capacity: Optional[int] = None, budget: Optional[int] = None):
+        self.capacity = capacity if capacity is not None else int(os.getenv("HOT_CACHE_MESSAGES", 100))
+        self.budget = budget if budget is not None else int(os.getenv("HOT_CACHE_BYTES", 64 * 1024 * 1024))
+        self.rings: "OrderedDict[int, ConversationRing]" = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.evictions = 0
+        self.appended = 0
+
+    def latest_page(
+        self, conversation_id: int, last_message_id: Optional[int], limit: int
+    ) -> Optional[Tuple[List[CachedMessage], bool]]:
+        """Последние limit сообщений и есть ли более старые; None - идти в БД"""
+        ring = self.rings.get(conversation_id)
+        if ring is None:
+            self.misses += 1
+            return None
+        messages = ring.messages
+        if not messages or messages[-1].id != last_message_id:
+            self.stale += 1
+            self.misses += 1
+            self._drop(conversation_id)
+            return None
+
+        count = len(messages)
+        if count > limit:
+            page, has_more = list(islice(messages, count - limit, count)), True
+        elif ring.complete:
+            page, has_more = list(messages), False
+        else:
+            self.misses += 1
+            return None
+        self.rings.move_to_end(conversation_id)
+        self.hits += 1
+        return page, has_more
+
+    def fill(self, conversation_id: int, messages: List[CachedMessage], complete: bool):
+        """Кольцо из последних сообщений, прочитанных из БД (по возрастанию)"""
+        if not self.capacity or not messages:
+            return
+        self._drop(conversation_id)
+        ring = ConversationRing(self.capacity)
+        ring.complete = complete and len(messages) <= self.capacity
+        for message in messages[-self.capacity:]:
+            ring.messages.append(message)
+            ring.size += message_size(message)
+        self.rings[conversation_id] = ring
+        self.size += ring.size
+        self._enforce_budget()
+
+    def append(self, messages: Iterable[CachedMessage]):
+        """Write-through: новые сообщения дописываются только в уже закэшированные диалоги"""
+        for message in sorted(messages, key=lambda message: (message.created_at, message.id)):
+            ring = self.rings.get(message.conversation_id)
+            if ring is None:
+                continue
+            if ring.messages:
+                last = ring.messages[-1]
+                if message.id == last.id:
+                    continue
+                try:
+                    in_order = (message.created_at, message.id) > (last.created_at, last.id)
+                except TypeError:
+                    # Время из БД с часовым поясом, у нового сообщения - без
+                    in_order = False
+                if not in_order:
+                    # Сообщение из прошлого (часы другого воркера) - проще перечитать
+                    self._drop(message.conversation_id)
+                    continue
+            if len(ring.messages) == ring.messages.maxlen:
+                evicted = message_size(ring.messages[0])
+                ring.size -= evicted
+                self.size -= evicted
+                ring.complete = False
+            ring.messages.append(message)
+            added = message_size(message)
+            ring.size += added
+            self.size += added
+            self.appended += 1
+        self._enforce_budget()
+
+    def _drop(self, conversation_id: int):
+        ring = self.rings.pop(conversation_id, None)
+        if ring is not None:
+            self.size -= ring.size
+
+    def _enforce_budget(self):
+        while self.size > self.budget and self.rings:
+            _, ring = self.rings.popitem(last=False)
+            self.size -= ring.size
+            self.evictions += 1
+
+    def clear(self):
+        self.rings.clear()
+        self.size = 0
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "conversations": len(self.rings),
+            "messages": sum(len(ring.messages) for ring in self.rings.values()),
+            "bytes": self.size,
+            "budget_bytes": self.budget,
+            "hits": self.hits,
+            "misses": self.misses,
+            "stale": self.stale,
+            "evictions": self.evictions,
+            "appended": self.appended,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+recent_messages = RecentMessageCache()
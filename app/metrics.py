@@ -0,0 +1,232 @@
+import bisect
+import time
+from abc import ABC, abstractmethod
+from typing import Callable, Dict, List, Sequence, Tuple
+
+# Метрики в текстовом формате Prometheus для GET /metrics.
+#
+# Счетчики и гистограммы - свои, на несколько строк: горячему пути нужен
+# только инкремент в словаре, без блокировок prometheus_client. Метрики
+# живут в памяти воркера; при нескольких воркерах каждый отдает свои, и
+# Prometheus различает их по instance (порт/под на воркер).
+#
+# Кроме явных метрик в вывод попадают числа из /stats (соединения,
+# очереди, кэши): коллекторы из add_collector раскладываются в плоские
+# имена void_<подсистема>_<поле>.
+
+PREFIX = "void_"
+
+# Секунды: от долей миллисекунды (fan-out в памяти) до секунд (bcrypt, fsync)
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric(ABC):
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = PREFIX + name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], object] = {}
+        registry.register(self)
+
+    def labels(self, *values):
+        key = tuple(str(value) for value in values)
+        child = self._children.get(key)
+        if child is None:
+            child = self._children[key] = self._new_child()
+        return child
+
+    @abstractmethod
+    def _new_child(self):
+        """Значение для одного набора меток"""
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        for values, child in sorted(self._children.items()):
+            lines.extend(self._render_child(values, child))
+        return lines
+
+    @abstractmethod
+    def _render_child(self, values, child) -> List[str]:
+        """Строки экспозиции одного набора меток"""
+
+class _CounterChild:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+class Counter(Metric):
+    type = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount: float = 1):
+        self.labels().inc(amount)
+
+    def _render_child(self, values, child) -> List[str]:
+        return [f"{self.name}{_format_labels(self.labelnames, values)} {_format_value(child.value)}"]
+
+class _HistogramChild:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = buckets
+        # counts[i] - наблюдения в (buckets[i-1], buckets[i]], последний - выше всех границ
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def time(self) -> "_Timer":
+        return _Timer(self)
+
+class _Timer:
+    __slots__ = ("child", "began")
+
+    def __init__(self, child: _HistogramChild):
+        self.child = child
+
+    def __enter__(self):
+        self.began = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.child.observe(time.perf_counter() - self.began)
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS
+    ):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def time(self) -> _Timer:
+        return self.labels().time()
+
+    def _render_child(self, values, child) -> List[str]:
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), child.counts):
+            cumulative += count
+            labels = _format_labels(self.labelnames, values, f'le="{_format_value(float(bound))}"')
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = _format_labels(self.labelnames, values)
+        lines.append(f"{self.name}_sum{labels} {_format_value(child.sum)}")
+        lines.append(f"{self.name}_count{labels} {child.count}")
+        return lines
+
+def _flatten(prefix: str, value, lines: List[str]):
+    if isinstance(value, dict):
+        for key, item in value.items():
+            _flatten(f"{prefix}_{key}", item, lines)
+    elif isinstance(value, bool):
+        lines.append(f"{prefix} {int(value)}")
+    elif isinstance(value, (int, float)):
+        lines.append(f"{prefix} {_format_value(value)}")
+
+class Registry:
+    def __init__(self):
+        self.metrics: List[Metric] = []
+        self._collectors: List[Callable[[], dict]] = []
+
+    def register(self, metric: Metric):
+        self.metrics.append(metric)
+
+    def add_collector(self, collect: Callable[[], dict]):
+        """Функция, возвращающая словарь чисел (как /stats), снимается при каждом запросе"""
+        self._collectors.append(collect)
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        for collect in self._collectors:
+            snapshot: List[str] = []
+            _flatten(PREFIX.rstrip("_"), collect(), snapshot)
+            for line in snapshot:
+                lines.append(f"# TYPE {line.split(' ', 1)[0]} untyped")
+                lines.append(line)
+        return "\n".join(lines) + "\n"
+
+registry = Registry()
+
+class MetricsMiddleware:
+    """ASGI-обертка: время ответа по шаблону маршрута, а не по конкретному URL"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status_code = 500
+        began = time.perf_counter()
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            # Роутер дописывает найденный маршрут в scope; статика и 404 - без шаблона
+            route = scope.get("route")
+            path = getattr(route, "path", None) or ("/static" if scope["path"].startswith("/static/") else "unmatched")
+            http_request_seconds.labels(scope["method"], path, status_code).observe(time.perf_counter() - began)
+
+http_request_seconds = Histogram(
+    "http_request_duration_seconds", "HTTP request latency by route", ("method", "route", "status")
+)
+ws_frames_received = Counter("ws_frames_received_total", "Inbound WebSocket frames by type", ("type",))
+messages_received = Counter("messages_received_total", "Chat messages accepted from WebSocket clients")
+messages_persisted = Counter("messages_persisted_total", "Chat messages committed to the database")
+fanout_seconds = Histogram(
+    "fanout_duration_seconds", "Time to encode and enqueue one event for all local devices of its recipients"
+)
+ws_send_seconds = Histogram("ws_send_duration_seconds", "Time to write one frame to a WebSocket")
+db_commit_seconds = Histogram(
+    "db_commit_duration_seconds", "Duration of background database writes", ("operation",)
+)
+message_batch_size = Histogram(
+    "message_batch_size", "Messages per group commit", buckets=SIZE_BUCKETS
+)
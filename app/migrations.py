@@ -0,0 +1,266 @@
+import logging
+
+from sqlalchemy import inspect, text
+from sqlalchemy.engine import Connection, Engine
+
+from . import crud, logs, models, search
+from .database import IS_SQLITE
+
+logger = logging.getLogger(__name__)
+
+# Версионированные миграции схемы. create_all создает только отсутствующие
+# таблицы, поэтому изменения существующих таблиц и перенос данных живут здесь.
+# Каждая миграция должна быть идемпотентной: на свежей БД create_all уже
+# создал актуальную схему.
+#
+# Применяются один раз шагом деплоя (python run.py migrate или
+# python -m app.migrations), а не каждым воркером: воркер при старте только
+# проверяет версию схемы (check) и отказывается работать со старой.
+
+def _column_names(connection: Connection, table: str):
+    return {column["name"] for column in inspect(connection).get_columns(table)}
+
+def _create_indexes(connection: Connection, table):
+    for index in table.indexes:
+        index.create(bind=connection, checkfirst=True)
+
+def _rebuild_table(connection: Connection, table):
+    """Пересоздать таблицу SQLite по модели, сохранив строки.
+
+    SQLite не умеет ALTER COLUMN, поэтому снять NOT NULL можно только так:
+    новая таблица, перенос данных, замена старой (порядок из документации
+    SQLite, чтобы внешние ключи других таблиц продолжали указывать на имя).
+    """
+    columns = ", ".join(
+        column.name for column in table.columns if column.name in _column_names(connection, table.name)
+    )
+    rebuilt = table.to_metadata(table.metadata, name=f"{table.name}_rebuild")
+    rebuilt.indexes.clear()
+    try:
+        rebuilt.create(bind=connection)
+    finally:
+        table.metadata.remove(rebuilt)
+    connection.execute(text(f"INSERT INTO {rebuilt.name} ({columns}) SELECT {columns} FROM {table.name}"))
+    connection.execute(text(f"DROP TABLE {table.name}"))
+    connection.execute(text(f"ALTER TABLE {rebuilt.name} RENAME TO {table.name}"))
+    _create_indexes(connection, table)
+
+def _canonical_pair(table: str):
+    return (
+        f"CASE WHEN {table}.sender_id < {table}.receiver_id THEN {table}.sender_id ELSE {table}.receiver_id END",
+        f"CASE WHEN {table}.sender_id < {table}.receiver_id THEN {table}.receiver_id ELSE {table}.sender_id END",
+    )
+
+def _conversations(connection: Connection):
+    if "conversation_id" not in _column_names(connection, "messages"):
+        connection.execute(text(
+            "ALTER TABLE messages ADD COLUMN conversation_id INTEGER REFERENCES conversations(id)"
+        ))
+
+    low, high = _canonical_pair("m")
+
+    # Заполняем канонические пары собеседников по уже существующим сообщениям
+    connection.execute(text(f"""
+        INSERT INTO conversations (user_low_id, user_high_id, created_at)
+        SELECT {low}, {high}, MIN(m.created_at)
+        FROM messages m
+        WHERE m.conversation_id IS NULL
+        AND NOT EXISTS (
+            SELECT 1 FROM conversations c
+            WHERE c.user_low_id = {low} AND c.user_high_id = {high}
+        )
+        GROUP BY {low}, {high}
+    """))
+    low, high = _canonical_pair("messages")
+    connection.execute(text(f"""
+        UPDATE messages SET conversation_id = (
+            SELECT c.id FROM conversations c
+            WHERE c.user_low_id = {low}
+            AND c.user_high_id = {high}
+        )
+        WHERE conversation_id IS NULL
+    """))
+
+    connection.execute(text("DROP INDEX IF EXISTS ix_messages_pair_created_at"))
+    _create_indexes(connection, models.Message.__table__)
+
+def _chat_summaries(connection: Connection):
+    columns = _column_names(connection, "conversations")
+    for name, column_type in (
+        ("last_message_id", "INTEGER"),
+        ("last_message_at", "DATETIME"),
+        ("last_message_sender_id", "INTEGER"),
+        ("last_message_preview", "VARCHAR"),
+    ):
+        if name not in columns:
+            connection.execute(text(f"ALTER TABLE conversations ADD COLUMN {name} {column_type}"))
+
+    # Участники: обе стороны каждого диалога
+    for side in ("user_low_id", "user_high_id"):
+        connection.execute(text(f"""
+            INSERT INTO conversation_members (conversation_id, user_id, unread_count)
+            SELECT c.id, c.{side}, 0 FROM conversations c
+            WHERE NOT EXISTS (
+                SELECT 1 FROM conversation_members cm
+                WHERE cm.conversation_id = c.id AND cm.user_id = c.{side}
+            )
+        """))
+    connection.execute(text("""
+        UPDATE conversation_members SET unread_count = (
+            SELECT COUNT(*) FROM messages m
+            WHERE m.conversation_id = conversation_members.conversation_id
+            AND m.receiver_id = conversation_members.user_id
+            AND m.sender_id != m.receiver_id
+            AND NOT m.is_read
+        )
+    """))
+
+    connection.execute(text("""
+        UPDATE conversations SET last_message_id = (
+            SELECT m.id FROM messages m
+            WHERE m.conversation_id = conversations.id
+            ORDER BY m.created_at DESC, m.id DESC
+            LIMIT 1
+        )
+        WHERE last_message_id IS NULL
+    """))
+    connection.execute(text(f"""
+        UPDATE conversations SET
+            last_message_at = (SELECT m.created_at FROM messages m WHERE m.id = conversations.last_message_id),
+            last_message_sender_id = (SELECT m.sender_id FROM messages m WHERE m.id = conversations.last_message_id),
+            last_message_preview = (
+                SELECT substr(m.content, 1, {crud.CHAT_PREVIEW_LENGTH}) FROM messages m
+                WHERE m.id = conversations.last_message_id
+            )
+        WHERE last_message_id IS NOT NULL AND last_message_at IS NULL
+    """))
+    _create_indexes(connection, models.ConversationMember.__table__)
+
+def _read_cursors(connection: Connection):
+    if "last_read_message_id" not in _column_names(connection, "conversation_members"):
+        connection.execute(text("ALTER TABLE conversation_members ADD COLUMN last_read_message_id INTEGER"))
+
+    # Курсор из флагов is_read: без непрочитанных - последнее сообщение
+    # диалога, иначе - сообщение прямо перед первым непрочитанным
+    connection.execute(text("""
+        UPDATE conversation_members SET last_read_message_id = CASE
+            WHEN unread_count = 0 THEN (
+                SELECT c.last_message_id FROM conversations c
+                WHERE c.id = conversation_members.conversation_id
+            )
+            ELSE (
+                SELECT m.id FROM messages m
+                WHERE m.conversation_id = conversation_members.conversation_id
+                AND (m.created_at, m.id) < (
+                    SELECT u.created_at, u.id FROM messages u
+                    WHERE u.conversation_id = conversation_members.conversation_id
+                    AND u.receiver_id = conversation_members.user_id
+                    AND u.sender_id != u.receiver_id
+                    AND NOT u.is_read
+                    ORDER BY u.created_at, u.id
+                    LIMIT 1
+                )
+                ORDER BY m.created_at DESC, m.id DESC
+                LIMIT 1
+            )
+        END
+        WHERE last_read_message_id IS NULL
+    """))
+
+def _message_search(connection: Connection):
+    # Индекс строится один раз по всей истории, дальше пополняется при записи
+    search.backend.ensure_schema(connection)
+    search.backend.rebuild(connection)
+
+def _group_conversations(connection: Connection):
+    columns = _column_names(connection, "conversations")
+    nullable = {
+        (table, column["name"]): column["nullable"]
+        for table in ("conversations", "messages")
+        for column in inspect(connection).get_columns(table)
+    }
+    if IS_SQLITE:
+        # Новые столбцы создаст пересборка по модели
+        if not nullable[("conversations", "user_low_id")] or "is_group" not in columns:
+            _rebuild_table(connection, models.Conversation.__table__)
+        if not nullable[("messages", "receiver_id")]:
+            _rebuild_table(connection, models.Message.__table__)
+        return
+
+    for name, column_type in (
+        ("is_group", "BOOLEAN NOT NULL DEFAULT FALSE"),
+        ("title", "VARCHAR"),
+        ("created_by", "INTEGER REFERENCES users(id)"),
+    ):
+        if name not in columns:
+            connection.execute(text(f"ALTER TABLE conversations ADD COLUMN {name} {column_type}"))
+    for table, column in (("conversations", "user_low_id"), ("conversations", "user_high_id"), ("messages", "receiver_id")):
+        if not nullable[(table, column)]:
+            connection.execute(text(f"ALTER TABLE {table} ALTER COLUMN {column} DROP NOT NULL"))
+
+MIGRATIONS = [
+    (1, "conversations", _conversations),
+    (2, "chat_summaries", _chat_summaries),
+    (3, "message_search", _message_search),
+    (4, "read_cursors", _read_cursors),
+    (5, "group_conversations", _group_conversations),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+def current_version(connection: Connection) -> int:
+    connection.execute(text("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            name VARCHAR NOT NULL,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """))
+    version = connection.execute(text("SELECT MAX(version) FROM schema_migrations")).scalar()
+    return version or 0
+
+def schema_version(connection: Connection) -> int:
+    """Версия схемы без записи в БД; 0 - миграции не применялись"""
+    if not inspect(connection).has_table("schema_migrations"):
+        return 0
+    version = connection.execute(text("SELECT MAX(version) FROM schema_migrations")).scalar()
+    return version or 0
+
+def check(engine: Engine):
+    with engine.connect() as connection:
+        version = schema_version(connection)
+    if version < LATEST_VERSION:
+        raise RuntimeError(
+            f"Database schema is at version {version}, expected {LATEST_VERSION}: "
+            "run `python run.py migrate` before starting workers"
+        )
+
+def upgrade(engine: Engine):
+    models.Base.metadata.create_all(bind=engine)
+    with engine.begin() as connection:
+        version = current_version(connection)
+
+    for migration_version, name, migrate in MIGRATIONS:
+        if migration_version <= version:
+            continue
+        # Каждая миграция применяется в своей транзакции
+        with engine.begin() as connection:
+            migrate(connection)
+            connection.execute(
+                text("INSERT INTO schema_migrations (version, name) VALUES (:version, :name)"),
+                {"version": migration_version, "name": name}
+            )
+        logger.info("applied migration", extra={"version": migration_version, "migration": name})
+
+def main():
+    from . import database
+
+    database.init_engines()
+    try:
+        upgrade(database.engine)
+    finally:
+        database.engine.dispose()
+
+if __name__ == "__main__":
+    logs.configure()
+    main()
@@ -1,6 +1,6 @@
-from sqlalchemy import Column, Integer, String, DateTime, Boolean, ForeignKey, Text
+from sqlalchemy import Column, Integer, String, DateTime, Boolean, ForeignKey, Text, Index, UniqueConstraint
 from sqlalchemy.orm import relationship
-from sqlalchemy.sql import func
+from sqlalchemy.sql import false, func
 from .database import Base
 
 class User(Base):
@@ -23,16 +23,75 @@ class User(Base):
     def get_full_name(self):
         return f"{self.first_name or ''} {self.last_name or ''}".strip() or self.username
 
+class Conversation(Base):
+    __tablename__ = "conversations"
+    __table_args__ = (
+        UniqueConstraint("user_low_id", "user_high_id", name="uq_conversations_pair"),
+    )
+    
+    id = Column(Integer, primary_key=True, index=True)
+    # Пара собеседников в каноническом порядке: user_low_id <= user_high_id.
+    # У группы пары нет (NULL), состав - в conversation_members
+    user_low_id = Column(Integer, ForeignKey("users.id"))
+    user_high_id = Column(Integer, ForeignKey("users.id"))
+    is_group = Column(Boolean, nullable=False, default=False, server_default=false())
+    title = Column(String)
+    created_by = Column(Integer, ForeignKey("users.id"))
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    # Денормализованная сводка для списка чатов, обновляется при записи сообщений
+    last_message_id = Column(Integer)
+    last_message_at = Column(DateTime(timezone=True))
+    last_message_sender_id = Column(Integer)
+    last_message_preview = Column(String)
+    
+    # Отношения
+    messages = relationship("Message", back_populates="conversation")
+    members = relationship("ConversationMember", back_populates="conversation", cascade="all, delete-orphan")
+
+class ConversationMember(Base):
+    __tablename__ = "conversation_members"
+    __table_args__ = (
+        Index("ix_conversation_members_user", "user_id", "conversation_id"),
+    )
+    
+    conversation_id = Column(Integer, ForeignKey("conversations.id"), primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    # Курсор прочтения: все сообщения диалога до этого (по created_at, id)
+    # прочитаны; unread_count - число входящих после него. В группах
+    # счетчик не ведется при записи (это обновление строки каждого
+    # участника), непрочитанные считаются от курсора при чтении
+    last_read_message_id = Column(Integer)
+    unread_count = Column(Integer, nullable=False, default=0)
+    
+    # Отношения
+    conversation = relationship("Conversation", back_populates="members")
+
 class Message(Base):
     __tablename__ = "messages"
+    __table_args__ = (
+        # История, непрочитанные и список чатов читаются одним диапазоном этого индекса
+        Index("ix_messages_conversation_created_at", "conversation_id", "created_at", "id"),
+    )
     
     id = Column(Integer, primary_key=True, index=True)
+    conversation_id = Column(Integer, ForeignKey("conversations.id"))
     sender_id = Column(Integer, ForeignKey("users.id"), nullable=False)
-    receiver_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    # NULL в группе: сообщение хранится один раз на диалог, а не на участника
+    receiver_id = Column(Integer, ForeignKey("users.id"))
     content = Column(Text, nullable=False)
+    # Не обновляется: прочитанность хранит ConversationMember.last_read_message_id
     is_read = Column(Boolean, default=False)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     
     # Отношения
     sender = relationship("User", foreign_keys=[sender_id], back_populates="sent_messages")
-    receiver = relationship("User", foreign_keys=[receiver_id], back_populates="received_messages")
\ No newline at end of file
+    receiver = relationship("User", foreign_keys=[receiver_id], back_populates="received_messages")
+    conversation = relationship("Conversation", back_populates="messages")
+
+class IdSequence(Base):
+    __tablename__ = "id_sequences"
+    
+    # Выдача id блоками: воркер резервирует диапазон одной транзакцией
+    # и раздает id сообщениям до записи в БД
+    name = Column(String, primary_key=True)
+    next_value = Column(Integer, nullable=False)
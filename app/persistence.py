@@ -0,0 +1,193 @@
+import asyncio
+import logging
+import os
+import time
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import List, Optional, Union
+
+from sqlalchemy.exc import IntegrityError
+
+from . import crud, database, metrics, schemas
+
+logger = logging.getLogger(__name__)
+
+# Write-behind запись сообщений. Сообщение сразу получает id и время и
+# уходит получателям, а в БД попадает пакетами (group commit).
+#
+# MESSAGE_DURABILITY:
+#   sync  - коммит каждого сообщения до доставки (как раньше)
+#   group - пакет по размеру/окну времени, message_sent после коммита пакета
+#   async - message_sent сразу, запись в фоне
+
+DURABILITY_MODES = ("sync", "group", "async")
+
+@dataclass
+class PendingMessage:
+    id: int
+    sender_id: int
+    # Личное сообщение - receiver_id, в группу - conversation_id
+    receiver_id: Optional[int]
+    content: str
+    created_at: datetime
+    durable: asyncio.Future = field(repr=False)
+    conversation_id: Optional[int] = None
+
+    def as_row(self) -> dict:
+        return {
+            "id": self.id,
+            "conversation_id": self.conversation_id,
+            "sender_id": self.sender_id,
+            "receiver_id": self.receiver_id,
+            "content": self.content,
+            "created_at": self.created_at
+        }
+
+class MessageWriter:
+    FLUSH_RETRIES = 3
+
+    def __init__(
+        self,
+        mode: Optional[str] = None,
+        batch_size: Optional[int] = None,
+        flush_interval_ms: Optional[int] = None,
+        id_block_size: Optional[int] = None
+    ):
+        self.mode = mode or os.getenv("MESSAGE_DURABILITY", "group")
+        if self.mode not in DURABILITY_MODES:
+            raise ValueError(f"Unknown MESSAGE_DURABILITY: {self.mode}")
+        self.batch_size = batch_size or int(os.getenv("MESSAGE_BATCH_SIZE", 256))
+        self.flush_interval = (flush_interval_ms or int(os.getenv("MESSAGE_FLUSH_INTERVAL_MS", 10))) / 1000
+        self.id_block_size = id_block_size or int(os.getenv("MESSAGE_ID_BLOCK", 1000))
+        # Сколько сообщений может ждать записи, прежде чем прием новых отклоняется
+        self.queue_limit = int(os.getenv("MESSAGE_QUEUE_LIMIT", 10000))
+
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self._task: Optional[asyncio.Task] = None
+        self._next_id = 0
+        self._id_limit = 0
+        self._id_lock = asyncio.Lock()
+
+    async def start(self):
+        if self._task is None:
+            # Очередь и блокировка привязываются к циклу событий первого
+            # ожидания, а lifespan может запускаться в новом цикле
+            self.queue = asyncio.Queue()
+            self._id_lock = asyncio.Lock()
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        # Дренаж: все принятые сообщения записываются до остановки
+        if self._task is not None:
+            await self.queue.put(None)
+            await self._task
+            self._task = None
+
+    @property
+    def saturated(self) -> bool:
+        return self.queue.qsize() >= self.queue_limit
+
+    async def submit(
+        self, sender_id: int, message: Union[schemas.MessageCreate, schemas.GroupMessageCreate]
+    ) -> PendingMessage:
+        loop = asyncio.get_running_loop()
+        pending = PendingMessage(
+            id=await self._allocate_id(),
+            sender_id=sender_id,
+            receiver_id=getattr(message, "receiver_id", None),
+            content=message.content,
+            created_at=datetime.utcnow(),
+            durable=loop.create_future(),
+            conversation_id=getattr(message, "conversation_id", None)
+        )
+
+        if self.mode == "sync" or self._task is None:
+            await self._flush([pending])
+        else:
+            self.queue.put_nowait(pending)
+            if self.mode == "async":
+                pending.durable.set_result(None)
+        return pending
+
+    async def _allocate_id(self) -> int:
+        async with self._id_lock:
+            if self._next_id >= self._id_limit:
+                async with database.AsyncSessionLocal() as db, database.write_lock():
+                    first = await db.run_sync(crud.reserve_ids, "messages", self.id_block_size)
+                self._next_id, self._id_limit = first, first + self.id_block_size
+            self._next_id += 1
+            return self._next_id - 1
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        closing = False
+        while not closing:
+            first = await self.queue.get()
+            if first is None:
+                break
+            batch = [first]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    pending = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if pending is None:
+                    closing = True
+                    break
+                batch.append(pending)
+            await self._flush(batch)
+
+    async def _write(self, batch: List[PendingMessage]) -> Optional[Exception]:
+        """Записать пакет одной транзакцией; ошибка после всех попыток или None"""
+        error = None
+        for attempt in range(self.FLUSH_RETRIES):
+            try:
+                async with database.AsyncSessionLocal() as db, database.write_lock():
+                    began = time.perf_counter()
+                    await db.run_sync(crud.create_messages, [pending.as_row() for pending in batch])
+                    metrics.db_commit_seconds.labels("message_batch").observe(time.perf_counter() - began)
+                return None
+            except Exception as e:
+                error = e
+                logger.warning(
+                    "message batch flush failed",
+                    extra={"attempt": attempt + 1, "batch": len(batch), "error": str(e)}
+                )
+                # Нарушение ограничения повтор не исправит
+                if isinstance(e, IntegrityError):
+                    break
+                await asyncio.sleep(0.1 * (attempt + 1))
+        return error
+
+    async def _flush(self, batch: List[PendingMessage]):
+        error = await self._write(batch)
+        if isinstance(error, IntegrityError) and len(batch) > 1:
+            # Одна плохая строка не должна отклонять весь пакет: пишем по
+            # одному, и message_failed получает только ее отправитель
+            for pending in batch:
+                await self._flush([pending])
+            return
+
+        if error is None:
+            metrics.messages_persisted.inc(len(batch))
+            metrics.message_batch_size.observe(len(batch))
+        for pending in batch:
+            if pending.durable.done():
+                continue
+            if error is None:
+                pending.durable.set_result(None)
+            else:
+                pending.durable.set_exception(error)
+
+    def stats(self) -> dict:
+        return {
+            "mode": self.mode,
+            "queued": self.queue.qsize(),
+            "queue_limit": self.queue_limit,
+        }
+
+message_writer = MessageWriter()
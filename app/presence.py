@@ -0,0 +1,176 @@
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Dict, Iterable, Optional, Tuple
+
+from . import crud, database, metrics
+
+logger = logging.getLogger(__name__)
+
+# Присутствие и индикатор набора текста.
+#
+# Онлайн-состояние живет в памяти воркера (подключенные устройства), а
+# users.last_seen пишется пакетом раз в PRESENCE_FLUSH_INTERVAL секунд:
+# и для тех, кто был активен, и для всех подключенных. Поэтому свежий
+# last_seen (моложе двух интервалов) означает, что пользователь онлайн в
+# каком-то из воркеров.
+#
+# typing пересылается только при смене состояния, повторное "печатает"
+# не чаще раза в TYPING_REFRESH_INTERVAL, новое начало набора - не чаще
+# TYPING_MIN_INTERVAL на пару собеседников.
+
+Publish = Callable[[dict, int], Awaitable[None]]
+
+class PresenceService:
+    def __init__(
+        self,
+        flush_interval: Optional[float] = None,
+        typing_min_interval: Optional[float] = None,
+        typing_refresh_interval: Optional[float] = None
+    ):
+        self.flush_interval = flush_interval or float(os.getenv("PRESENCE_FLUSH_INTERVAL", 15))
+        self.typing_min_interval = typing_min_interval or float(os.getenv("TYPING_MIN_INTERVAL", 0.5))
+        self.typing_refresh_interval = typing_refresh_interval or float(os.getenv("TYPING_REFRESH_INTERVAL", 3))
+
+        self.devices: Dict[int, int] = {}
+        self.last_active: Dict[int, datetime] = {}
+        # отправитель -> получатель -> (печатает ли, когда переслали)
+        self.typing: Dict[int, Dict[int, Tuple[bool, float]]] = {}
+        self.typing_forwarded = 0
+        self.typing_suppressed = 0
+        self.last_seen_writes = 0
+
+        self._publish: Optional[Publish] = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self, publish: Publish):
+        self._publish = publish
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    def is_online(self, user_id: int) -> bool:
+        return user_id in self.devices
+
+    def connected(self, user_id: int):
+        self.devices[user_id] = self.devices.get(user_id, 0) + 1
+        self.touch(user_id)
+
+    async def disconnected(self, user_id: int):
+        self.touch(user_id)
+        remaining = self.devices.get(user_id, 0) - 1
+        if remaining > 0:
+            self.devices[user_id] = remaining
+            return
+        self.devices.pop(user_id, None)
+        # Последнее устройство ушло: незаконченный набор текста гасим сами
+        for receiver_id, (is_typing, _) in self.typing.pop(user_id, {}).items():
+            if is_typing:
+                await self._send_typing(user_id, receiver_id, False)
+
+    def touch(self, user_id: int):
+        self.last_active[user_id] = datetime.utcnow()
+
+    async def typing_changed(self, sender_id: int, receiver_id: int, is_typing: bool):
+        self.touch(sender_id)
+        now = time.monotonic()
+        previous = self.typing.get(sender_id, {}).get(receiver_id)
+
+        if previous is None:
+            forward = is_typing
+        else:
+            was_typing, forwarded_at = previous
+            elapsed = now - forwarded_at
+            if is_typing and was_typing:
+                forward = elapsed >= self.typing_refresh_interval
+            elif is_typing:
+                forward = elapsed >= self.typing_min_interval
+            else:
+                # Окончание набора пересылаем всегда, если собеседник видит начало
+                forward = was_typing
+
+        if not forward:
+            self.typing_suppressed += 1
+            return
+
+        if is_typing:
+            self.typing.setdefault(sender_id, {})[receiver_id] = (True, now)
+        else:
+            self.typing.get(sender_id, {})[receiver_id] = (False, now)
+        await self._send_typing(sender_id, receiver_id, is_typing)
+
+    async def _send_typing(self, sender_id: int, receiver_id: int, is_typing: bool):
+        self.typing_forwarded += 1
+        if self._publish is not None:
+            await self._publish({
+                "type": "user_typing",
+                "sender_id": sender_id,
+                "is_typing": is_typing
+            }, receiver_id)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("presence flush failed")
+
+    async def flush(self):
+        now = datetime.utcnow()
+        for user_id in self.devices:
+            self.last_active[user_id] = now
+        if not self.last_active:
+            return
+
+        last_active, self.last_active = self.last_active, {}
+        async with database.AsyncSessionLocal() as db, database.write_lock():
+            with metrics.db_commit_seconds.labels("last_seen").time():
+                await db.run_sync(crud.update_last_seen, last_active)
+        self.last_seen_writes += len(last_active)
+
+        # Записи о наборе текста старше интервала обновления больше не нужны
+        expired = time.monotonic() - self.typing_refresh_interval * 2
+        for sender_id in list(self.typing):
+            receivers = self.typing[sender_id]
+            for receiver_id in [r for r, (_, at) in receivers.items() if at < expired]:
+                del receivers[receiver_id]
+            if not receivers:
+                del self.typing[sender_id]
+
+    async def get_presence(self, db, user_ids: Iterable[int]) -> Dict[int, dict]:
+        user_ids = list(user_ids)
+        last_seen = await db.run_sync(crud.get_last_seen, user_ids)
+        online_after = datetime.utcnow() - timedelta(seconds=self.flush_interval * 2)
+        presence = {}
+        for user_id in user_ids:
+            seen = last_seen.get(user_id)
+            if user_id in self.last_active and (seen is None or self.last_active[user_id] > seen):
+                seen = self.last_active[user_id]
+            presence[user_id] = {
+                "online": self.is_online(user_id) or (seen is not None and seen > online_after),
+                "last_seen": seen.isoformat() if seen else None
+            }
+        return presence
+
+    def stats(self) -> dict:
+        return {
+            "online": len(self.devices),
+            "pending_last_seen": len(self.last_active),
+            "last_seen_writes": self.last_seen_writes,
+            "typing_forwarded": self.typing_forwarded,
+            "typing_suppressed": self.typing_suppressed,
+        }
+
+presence = PresenceService()
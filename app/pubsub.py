@@ -0,0 +1,291 @@
+import asyncio
+import logging
+import os
+from abc import ABC, abstractmethod
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Set
+from urllib.parse import urlparse
+
+logger = logging.getLogger(__name__)
+
+# Шина доставки сообщений между воркерами. Каждый воркер подписывается только
+# на каналы пользователей, чьи сокеты держит сам, а send_personal_message
+# публикует в канал получателя - кто бы его ни держал.
+
+MessageHandler = Callable[[int, str], Awaitable[None]]
+# Одно сообщение сразу многим пользователям этого воркера (рассылка в группу)
+BatchHandler = Callable[[List[int], str], Awaitable[None]]
+
+class Backplane(ABC):
+    def __init__(self):
+        self.handler: Optional[MessageHandler] = None
+        self.batch_handler: Optional[BatchHandler] = None
+        self.subscriptions: Set[int] = set()
+
+    async def start(self, handler: MessageHandler, batch_handler: Optional[BatchHandler] = None):
+        self.handler = handler
+        self.batch_handler = batch_handler
+
+    async def close(self):
+        self.subscriptions.clear()
+
+    async def subscribe(self, user_id: int):
+        self.subscriptions.add(user_id)
+
+    async def unsubscribe(self, user_id: int):
+        self.subscriptions.discard(user_id)
+
+    @abstractmethod
+    async def publish(self, user_id: int, message: str):
+        """Доставить сообщение в канал пользователя, кто бы его ни держал"""
+
+    async def publish_many(self, user_ids: Iterable[int], message: str):
+        for user_id in user_ids:
+            await self.publish(user_id, message)
+
+class InProcessBackplane(Backplane):
+    """Доставка в пределах одного процесса, без внешнего брокера"""
+
+    async def publish(self, user_id: int, message: str):
+        if user_id in self.subscriptions and self.handler:
+            await self.handler(user_id, message)
+
+    async def publish_many(self, user_ids: Iterable[int], message: str):
+        if self.batch_handler is None:
+            await super().publish_many(user_ids, message)
+            return
+        subscribed = [user_id for user_id in user_ids if user_id in self.subscriptions]
+        if subscribed:
+            await self.batch_handler(subscribed, message)
+
+# Протокол Redis (RESP2): хватает PUBLISH/SUBSCRIBE/UNSUBSCRIBE/PING,
+# поэтому вместо Redis подойдет любой совместимый сервер, в том числе
+# локальный брокер из `python -m app.pubsub`.
+
+def encode_command(*args) -> bytes:
+    parts = [f"*{len(args)}\r\n".encode()]
+    for arg in args:
+        if not isinstance(arg, bytes):
+            arg = str(arg).encode()
+        parts.append(f"${len(arg)}\r\n".encode() + arg + b"\r\n")
+    return b"".join(parts)
+
+class RespError(Exception):
+    pass
+
+async def read_reply(reader: asyncio.StreamReader):
+    line = await reader.readline()
+    if not line:
+        raise ConnectionError("Connection closed by server")
+    prefix, payload = line[:1], line[1:-2]
+    if prefix == b"+":
+        return payload.decode()
+    if prefix == b"-":
+        raise RespError(payload.decode())
+    if prefix == b":":
+        return int(payload)
+    if prefix == b"$":
+        length = int(payload)
+        if length == -1:
+            return None
+        data = await reader.readexactly(length + 2)
+        return data[:-2]
+    if prefix == b"*":
+        length = int(payload)
+        if length == -1:
+            return None
+        return [await read_reply(reader) for _ in range(length)]
+    raise RespError(f"Unknown reply type: {line!r}")
+
+class RedisBackplane(Backplane):
+    RECONNECT_DELAY = 1.0
+    # PUBLISH одной пачки уходят одной записью; между пачками блокировка
+    # отпускается, и личные сообщения не ждут рассылку в большую группу
+    PUBLISH_CHUNK = 256
+
+    def __init__(self, url: str, prefix: str = "void:user:"):
+        super().__init__()
+        parsed = urlparse(url)
+        self.host = parsed.hostname or "localhost"
+        self.port = parsed.port or 6379
+        self.password = parsed.password
+        self.db = int(parsed.path.lstrip("/") or 0)
+        self.prefix = prefix
+
+        self._publisher: Optional[tuple] = None
+        self._publish_lock = asyncio.Lock()
+        self._subscriber_writer: Optional[asyncio.StreamWriter] = None
+        self._listener: Optional[asyncio.Task] = None
+
+    def channel(self, user_id: int) -> str:
+        return f"{self.prefix}{user_id}"
+
+    async def _open_connection(self):
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        if self.password:
+            writer.write(encode_command("AUTH", self.password))
+            await read_reply(reader)
+        if self.db:
+            writer.write(encode_command("SELECT", self.db))
+            await read_reply(reader)
+        return reader, writer
+
+    async def start(self, handler: MessageHandler, batch_handler: Optional[BatchHandler] = None):
+        await super().start(handler, batch_handler)
+        self._listener = asyncio.create_task(self._listen())
+
+    async def close(self):
+        if self._listener:
+            self._listener.cancel()
+            try:
+                await self._listener
+            except asyncio.CancelledError:
+                pass
+        for writer in (self._subscriber_writer, self._publisher and self._publisher[1]):
+            if writer:
+                writer.close()
+        self._publisher = None
+        self._subscriber_writer = None
+        await super().close()
+
+    async def subscribe(self, user_id: int):
+        if user_id in self.subscriptions:
+            return
+        await super().subscribe(user_id)
+        if self._subscriber_writer:
+            self._subscriber_writer.write(encode_command("SUBSCRIBE", self.channel(user_id)))
+
+    async def unsubscribe(self, user_id: int):
+        if user_id not in self.subscriptions:
+            return
+        await super().unsubscribe(user_id)
+        if self._subscriber_writer:
+            self._subscriber_writer.write(encode_command("UNSUBSCRIBE", self.channel(user_id)))
+
+    async def publish(self, user_id: int, message: str):
+        await self.publish_many((user_id,), message)
+
+    async def publish_many(self, user_ids: Iterable[int], message: str):
+        # Тело кодируется один раз, PUBLISH идут пачками (pipelining)
+        user_ids = list(user_ids)
+        payload = message.encode()
+        for start in range(0, len(user_ids), self.PUBLISH_CHUNK):
+            await self._publish_chunk(user_ids[start:start + self.PUBLISH_CHUNK], payload)
+
+    async def _publish_chunk(self, user_ids: List[int], payload: bytes):
+        acknowledged = 0
+        async with self._publish_lock:
+            for attempt in range(2):
+                try:
+                    if self._publisher is None:
+                        self._publisher = await self._open_connection()
+                    reader, writer = self._publisher
+                    pending = user_ids[acknowledged:]
+                    writer.write(b"".join(
+                        encode_command("PUBLISH", self.channel(user_id), payload) for user_id in pending
+                    ))
+                    for _ in pending:
+                        await read_reply(reader)
+                        acknowledged += 1
+                    return
+                except (ConnectionError, OSError, asyncio.IncompleteReadError):
+                    # Один повтор на свежем соединении после обрыва - только
+                    # для неподтвержденных: подтвержденным повтор продублировал бы
+                    self._drop_publisher()
+                    if attempt:
+                        raise
+                except RespError:
+                    # Оставшиеся ответы пачки не прочитаны - соединение не переиспользуем
+                    self._drop_publisher()
+                    raise
+
+    def _drop_publisher(self):
+        if self._publisher is not None:
+            self._publisher[1].close()
+            self._publisher = None
+
+    async def _listen(self):
+        # Подписочное соединение переподключается и восстанавливает подписки
+        while True:
+            try:
+                reader, writer = await self._open_connection()
+                self._subscriber_writer = writer
+                if self.subscriptions:
+                    writer.write(encode_command(
+                        "SUBSCRIBE", *[self.channel(user_id) for user_id in self.subscriptions]
+                    ))
+                while True:
+                    reply = await read_reply(reader)
+                    if isinstance(reply, list) and len(reply) == 3 and reply[0] == b"message":
+                        user_id = int(reply[1].decode()[len(self.prefix):])
+                        if self.handler:
+                            await self.handler(user_id, reply[2].decode())
+            except asyncio.CancelledError:
+                raise
+            except (ConnectionError, OSError, RespError) as e:
+                logger.warning("pub/sub connection lost", extra={"error": str(e)})
+            self._subscriber_writer = None
+            await asyncio.sleep(self.RECONNECT_DELAY)
+
+def create_backplane(url: Optional[str] = None) -> Backplane:
+    url = url or os.getenv("PUBSUB_URL", "memory://")
+    if url.startswith("memory://"):
+        return InProcessBackplane()
+    if url.startswith("redis://"):
+        return RedisBackplane(url, prefix=os.getenv("PUBSUB_PREFIX", "void:user:"))
+    raise ValueError(f"Unsupported PUBSUB_URL: {url}")
+
+# Локальный брокер для разработки и нескольких воркеров без Redis:
+#   python -m app.pubsub --port 6379
+
+class LocalBroker:
+    def __init__(self):
+        self.channels: Dict[bytes, Set[asyncio.StreamWriter]] = {}
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        subscribed: Set[bytes] = set()
+        try:
+            while True:
+                command = await read_reply(reader)
+                if not isinstance(command, list) or not command:
+                    break
+                name = command[0].upper()
+                if name == b"PUBLISH":
+                    receivers = list(self.channels.get(command[1], ()))
+                    for receiver in receivers:
+                        receiver.write(encode_command("message", command[1], command[2]))
+                    writer.write(f":{len(receivers)}\r\n".encode())
+                elif name in (b"SUBSCRIBE", b"UNSUBSCRIBE"):
+                    for channel in command[1:]:
+                        if name == b"SUBSCRIBE":
+                            subscribed.add(channel)
+                            self.channels.setdefault(channel, set()).add(writer)
+                        else:
+                            subscribed.discard(channel)
+                            self.channels.get(channel, set()).discard(writer)
+                        writer.write(encode_command(name.lower(), channel, len(subscribed)))
+                elif name in (b"PING", b"SELECT", b"AUTH"):
+                    writer.write(b"+PONG\r\n" if name == b"PING" else b"+OK\r\n")
+                else:
+                    writer.write(b"-ERR unknown command\r\n")
+        except (ConnectionError, asyncio.IncompleteReadError, RespError):
+            pass
+        finally:
+            for channel in subscribed:
+                self.channels.get(channel, set()).discard(writer)
+            writer.close()
+
+async def serve(host: str, port: int):
+    broker = LocalBroker()
+    server = await asyncio.start_server(broker.handle, host, port)
+    print(f"Pub/sub broker listening on {host}:{port}")
+    async with server:
+        await server.serve_forever()
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Local Redis-protocol pub/sub broker")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6379)
+    args = parser.parse_args()
+    asyncio.run(serve(args.host, args.port))
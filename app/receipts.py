@@ -0,0 +1,70 @@
+import asyncio
+import os
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+# Уведомления о прочтении. Клиент отмечает диалог прочитанным на каждое
+# входящее сообщение, поэтому события склеиваются: за окно
+# READ_RECEIPT_INTERVAL_MS собеседник получает один messages_read с
+# последним положением курсора.
+
+Publish = Callable[[dict, int], Awaitable[None]]
+
+class ReadReceiptNotifier:
+    def __init__(self, interval_ms: Optional[int] = None):
+        self.interval = (interval_ms or int(os.getenv("READ_RECEIPT_INTERVAL_MS", 250))) / 1000
+        # (кому, кто прочитал) -> (conversation_id, last_read_message_id)
+        self.pending: Dict[Tuple[int, int], Tuple[int, int]] = {}
+        self.coalesced = 0
+        self._publish: Optional[Publish] = None
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self, publish: Publish):
+        self._publish = publish
+        if self._task is None:
+            # Событие из прошлого запуска привязано к его циклу
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self._flush()
+
+    def notify(self, recipient_id: int, reader_id: int, conversation_id: int, last_read_message_id: int):
+        key = (recipient_id, reader_id)
+        if key in self.pending:
+            self.coalesced += 1
+        self.pending[key] = (conversation_id, last_read_message_id)
+        self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            await asyncio.sleep(self.interval)
+            self._wakeup.clear()
+            await self._flush()
+
+    async def _flush(self):
+        if not self.pending or self._publish is None:
+            return
+        pending, self.pending = self.pending, {}
+        await asyncio.gather(*(
+            self._publish({
+                "type": "messages_read",
+                "reader_id": reader_id,
+                "conversation_id": conversation_id,
+                "last_read_message_id": last_read_message_id
+            }, recipient_id)
+            for (recipient_id, reader_id), (conversation_id, last_read_message_id) in pending.items()
+        ))
+
+    def stats(self) -> dict:
+        return {"pending": len(self.pending), "coalesced": self.coalesced}
+
+read_receipts = ReadReceiptNotifier()
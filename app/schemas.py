@@ -1,6 +1,6 @@
-from pydantic import BaseModel, EmailStr
+from pydantic import BaseModel, EmailStr, Field
 from datetime import datetime
-from typing import Optional
+from typing import Dict, List, Optional
 
 class UserBase(BaseModel):
     username: str
@@ -15,4 +15,22 @@ class UserLogin(BaseModel):
 
 class MessageCreate(BaseModel):
     content: str
-    receiver_id: int
\ No newline at end of file
+    receiver_id: int
+
+class GroupMessageCreate(BaseModel):
+    content: str
+    conversation_id: int
+
+class GroupCreate(BaseModel):
+    title: str = Field(..., min_length=1, max_length=128)
+    member_ids: List[int] = []
+
+class GroupMembers(BaseModel):
+    user_ids: List[int] = Field(..., min_length=1)
+
+class SyncRequest(BaseModel):
+    # id собеседника -> id последнего сообщения, которое видел клиент
+    conversations: Dict[int, int] = {}
+    # id группы -> id последнего сообщения, которое видел клиент
+    groups: Dict[int, int] = {}
+    since: Optional[int] = None
@@ -0,0 +1,161 @@
+import html
+import os
+import re
+from typing import List, Optional
+
+from sqlalchemy import DateTime, text
+from sqlalchemy.engine import Connection
+from sqlalchemy.orm import Session
+
+from . import models
+from .database import IS_SQLITE
+
+# Полнотекстовый поиск по сообщениям. Индекс обновляется в транзакции
+# записи сообщений (crud.create_messages), поиск ограничен диалогами,
+# в которых состоит пользователь. Сообщения, перенесенные в архив
+# (app.archive), из индекса удаляются.
+
+SNIPPET_START = "\x02"
+SNIPPET_END = "\x03"
+
+def snippet_to_html(snippet: str) -> str:
+    return html.escape(snippet).replace(SNIPPET_START, "<mark>").replace(SNIPPET_END, "</mark>")
+
+def to_match_query(query: str) -> Optional[str]:
+    # Пользовательский ввод не должен становиться синтаксисом FTS:
+    # каждое слово - фраза в кавычках, последнее ищется по префиксу
+    words = re.findall(r"\w+", query)
+    if not words:
+        return None
+    terms = ['"' + word.replace('"', '""') + '"' for word in words]
+    terms[-1] += "*"
+    return " ".join(terms)
+
+# Собеседник для строки результата; в группе (receiver_id IS NULL) - автор
+PEER_ID = (
+    "CASE WHEN m.sender_id = :user_id AND m.receiver_id IS NOT NULL "
+    "THEN m.receiver_id ELSE m.sender_id END"
+)
+
+class SearchBackend:
+    name = "none"
+
+    def ensure_schema(self, connection: Connection):
+        pass
+
+    def rebuild(self, connection: Connection):
+        pass
+
+    def index_messages(self, db: Session, messages: List[models.Message]):
+        pass
+
+    def unindex_messages(self, db: Session, messages: list):
+        """Убрать из индекса сообщения, которые переносятся в архив (нужны id и content)"""
+        pass
+
+    def search(self, db: Session, user_id: int, query: str, limit: int, offset: int) -> list:
+        """Поиск выключен (SEARCH_BACKEND=none): индекса нет, результатов тоже"""
+        return []
+
+class FTS5Backend(SearchBackend):
+    """SQLite FTS5 с внешним содержимым: текст хранится только в messages"""
+    name = "fts5"
+
+    def ensure_schema(self, connection: Connection):
+        connection.execute(text("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+                content,
+                content='messages',
+                content_rowid='id',
+                tokenize='unicode61 remove_diacritics 2'
+            )
+        """))
+
+    def rebuild(self, connection: Connection):
+        connection.execute(text("INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')"))
+
+    def index_messages(self, db: Session, messages: List[models.Message]):
+        db.execute(
+            text("INSERT INTO messages_fts (rowid, content) VALUES (:id, :content)"),
+            [{"id": message.id, "content": message.content} for message in messages]
+        )
+
+    def unindex_messages(self, db: Session, messages: list):
+        # Внешнее содержимое: удалению нужен тот же текст, что был проиндексирован
+        db.execute(
+            text("INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', :id, :content)"),
+            [{"id": message.id, "content": message.content} for message in messages]
+        )
+
+    def search(self, db: Session, user_id: int, query: str, limit: int, offset: int) -> list:
+        match = to_match_query(query)
+        if match is None:
+            return []
+        return db.execute(text(f"""
+            SELECT m.id, m.conversation_id, m.sender_id, u.id, u.username, m.created_at,
+                   snippet(messages_fts, 0, '{SNIPPET_START}', '{SNIPPET_END}', '…', 12) AS snippet
+            FROM messages_fts
+            JOIN messages m ON m.id = messages_fts.rowid
+            JOIN conversation_members cm
+                ON cm.conversation_id = m.conversation_id AND cm.user_id = :user_id
+            JOIN users u
+                ON u.id = {PEER_ID}
+            WHERE messages_fts MATCH :match
+            ORDER BY bm25(messages_fts)
+            LIMIT :limit OFFSET :offset
+        """).columns(created_at=DateTime), {
+            "user_id": user_id, "match": match, "limit": limit, "offset": offset
+        }).all()
+
+class LikeBackend(SearchBackend):
+    """Запасной вариант без индекса для БД без FTS5"""
+    name = "like"
+
+    def search(self, db: Session, user_id: int, query: str, limit: int, offset: int) -> list:
+        words = re.findall(r"\w+", query)
+        if not words:
+            return []
+        conditions = " AND ".join(f"m.content LIKE :word{i}" for i in range(len(words)))
+        params = {f"word{i}": f"%{word}%" for i, word in enumerate(words)}
+        rows = db.execute(text(f"""
+            SELECT m.id, m.conversation_id, m.sender_id, u.id, u.username, m.created_at, m.content
+            FROM messages m
+            JOIN conversation_members cm
+                ON cm.conversation_id = m.conversation_id AND cm.user_id = :user_id
+            JOIN users u
+                ON u.id = {PEER_ID}
+            WHERE {conditions}
+            ORDER BY m.created_at DESC, m.id DESC
+            LIMIT :limit OFFSET :offset
+        """).columns(created_at=DateTime), dict(params, user_id=user_id, limit=limit, offset=offset)).all()
+        return [row[:6] + (row[6][:120],) for row in rows]
+
+BACKENDS = {
+    "fts5": FTS5Backend,
+    "like": LikeBackend,
+    "none": SearchBackend,
+}
+
+def create_backend(name: Optional[str] = None) -> SearchBackend:
+    name = name or os.getenv("SEARCH_BACKEND") or ("fts5" if IS_SQLITE else "like")
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown SEARCH_BACKEND: {name}")
+    return BACKENDS[name]()
+
+backend = create_backend()
+
+if __name__ == "__main__":
+    import sys
+
+    from . import database
+
+    if sys.argv[1:] != ["rebuild"]:
+        print("Usage: python -m app.search rebuild")
+        sys.exit(1)
+
+    # Полная перестройка индекса для существующей БД
+    database.init_engines()
+    with database.engine.begin() as connection:
+        backend.ensure_schema(connection)
+        backend.rebuild(connection)
+    print(f"Search index rebuilt ({backend.name})")
@@ -0,0 +1,77 @@
+import asyncio
+import logging
+import os
+import time
+from typing import Dict
+
+from jinja2 import Environment
+from sqlalchemy import select
+
+from . import auth, cache, crud, database, models
+from .archive import message_archive
+
+logger = logging.getLogger(__name__)
+
+# Прогрев воркера перед приемом трафика. Выполняется в lifespan, а uvicorn
+# начинает принимать соединения только после его завершения, поэтому первые
+# запросы не платят за то, что иначе делалось бы лениво:
+#
+#   - соединения пулов БД (подключение и прагмы SQLite)
+#   - компиляция шаблонов Jinja2
+#   - кэш пользователей: WARMUP_USERS последних заходивших
+#   - кольца последних сообщений: WARMUP_CONVERSATIONS самых свежих диалогов
+#   - бэкенд bcrypt и каталог разделов архива
+#
+# WARMUP=false отключает прогрев (например, для сравнения времени старта).
+
+ENABLED = os.getenv("WARMUP", "True").lower() == "true"
+USERS = int(os.getenv("WARMUP_USERS", 1000))
+CONVERSATIONS = int(os.getenv("WARMUP_CONVERSATIONS", 100))
+
+def compile_templates(env: Environment) -> int:
+    # get_template компилирует шаблон и кладет его в кэш окружения
+    names = env.list_templates(extensions=("html",))
+    for name in names:
+        env.get_template(name)
+    return len(names)
+
+async def preload_users(count: int) -> int:
+    if count <= 0:
+        return 0
+    async with database.AsyncReadSessionLocal() as db:
+        users = (await db.scalars(
+            select(models.User)
+            .where(models.User.is_active)
+            .order_by(models.User.last_seen.desc())
+            .limit(min(count, cache.user_cache.maxsize))
+        )).all()
+    for user in users:
+        cache.user_cache.set(user.id, cache.CachedUser.from_model(user))
+    return len(users)
+
+async def preload_conversations(count: int) -> int:
+    if count <= 0:
+        return 0
+    async with database.AsyncReadSessionLocal() as db:
+        return await db.run_sync(crud.preload_latest_pages, count)
+
+async def warm_up(env: Environment) -> Dict[str, float]:
+    """Прогреть воркер; возвращает время шагов и число загруженного"""
+    began = time.perf_counter()
+    stats: Dict[str, float] = {}
+
+    async def step(name: str, coroutine):
+        step_began = time.perf_counter()
+        result = await coroutine
+        stats[f"{name}_seconds"] = time.perf_counter() - step_began
+        return result
+
+    stats["connections"] = await step("pools", database.prime_pools())
+    stats["templates"] = compile_templates(env)
+    stats["users"] = await step("users", preload_users(USERS))
+    stats["conversations"] = await step("conversations", preload_conversations(CONVERSATIONS))
+    await step("bcrypt", asyncio.to_thread(auth.load_backend))
+    stats["archive_partitions"] = len(message_archive.partitions)
+    stats["seconds"] = time.perf_counter() - began
+    logger.info("worker warmed up", extra={name: round(value, 4) for name, value in stats.items()})
+    return stats
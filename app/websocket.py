@@ -1,137 +1,294 @@
-import json
-from typing import Dict, Set
-from fastapi import WebSocket, WebSocketDisconnect, Depends
-from sqlalchemy.orm import Session
-from . import crud, auth, database
-from . import schemas
+import asyncio
+import logging
+import os
+import time
+import uuid
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from fastapi import WebSocket, WebSocketDisconnect, status
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from . import cache, codecs, limits, metrics, pubsub
+
+logger = logging.getLogger(__name__)
+
+# Политика для медленного клиента, чья очередь исходящих переполнена:
+#   disconnect - закрыть соединение (клиент переподключится и догрузит
+#                пропущенное через sync)
+#   drop       - отбросить самое старое сообщение в очереди
+SLOW_CONSUMER_POLICIES = ("disconnect", "drop")
+
+SEND_QUEUE_SIZE = int(os.getenv("WS_SEND_QUEUE_SIZE", 256))
+SEND_TIMEOUT = float(os.getenv("WS_SEND_TIMEOUT", 10))
+SLOW_CONSUMER_POLICY = os.getenv("WS_SLOW_CONSUMER_POLICY", "disconnect")
+if SLOW_CONSUMER_POLICY not in SLOW_CONSUMER_POLICIES:
+    raise ValueError(f"Unknown WS_SLOW_CONSUMER_POLICY: {SLOW_CONSUMER_POLICY}")
+
+# 1013 Try Again Later: клиент отстал, но может переподключиться
+CLOSE_SLOW_CONSUMER = 1013
+
+# Поле события с устройством, которому его доставлять не нужно: свое
+# отправленное сообщение приходит остальным устройствам отправителя
+ORIGIN_FIELD = "origin"
+
+class FrameRejected(Exception):
+    """Входящий кадр, после которого соединение закрывается с close_code"""
+
+    def __init__(self, close_code: int, reason: str):
+        super().__init__(reason)
+        self.close_code = close_code
+
+class Connection:
+    """Одно устройство пользователя: очередь исходящих и отдельная задача-писатель.
+
+    Отправители только кладут сообщение в очередь, поэтому медленный сокет
+    не задерживает цикл приема того, кто отправляет.
+    """
+
+    def __init__(
+        self,
+        websocket: WebSocket,
+        user_id: int,
+        manager: "ConnectionManager",
+        codec: codecs.Codec = codecs.DEFAULT_CODEC
+    ):
+        self.websocket = websocket
+        self.user_id = user_id
+        self.manager = manager
+        self.codec = codec
+        # Уникален между воркерами: по нему событие из шины узнает устройство-источник
+        self.device_id = uuid.uuid4().hex
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=SEND_QUEUE_SIZE)
+        self.quota = limits.ingress.open(user_id)
+        self.closed = False
+        self._writer: Optional[asyncio.Task] = None
+        self._closing: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._writer = asyncio.create_task(self._write_loop())
+
+    async def receive_event(self) -> dict:
+        message = await self.websocket.receive()
+        if message["type"] == "websocket.disconnect":
+            raise WebSocketDisconnect(message.get("code", status.WS_1000_NORMAL_CLOSURE))
+        data = message.get("text")
+        if data is None:
+            data = message.get("bytes") or b""
+        # Текст меряем в символах: кодировать ради длины дороже, чем
+        # возможная разница в 4 раза на не-ASCII
+        if len(data) > limits.MAX_FRAME_BYTES:
+            limits.ingress.oversized_frames += 1
+            raise FrameRejected(status.WS_1009_MESSAGE_TOO_BIG, "Frame too large")
+        try:
+            event = self.codec.decode(data)
+        except Exception:
+            event = None
+        if not isinstance(event, dict):
+            limits.ingress.invalid_frames += 1
+            raise FrameRejected(status.WS_1007_INVALID_FRAME_PAYLOAD_DATA, "Malformed frame")
+        return event
+
+    async def send_event(self, event: dict):
+        await self.send(self.codec.encode(event))
+
+    def offer(self, message: codecs.Frame) -> bool:
+        """Поставить кадр в очередь без ожидания; False - очередь полна, нужен send"""
+        if self.closed:
+            return True
+        try:
+            self.queue.put_nowait(message)
+            return True
+        except asyncio.QueueFull:
+            return False
+
+    async def send(self, message: codecs.Frame):
+        """Поставить в очередь кадр, уже закодированный кодеком соединения"""
+        if self.offer(message):
+            return
+
+        if SLOW_CONSUMER_POLICY == "drop":
+            self.queue.get_nowait()
+            self.queue.put_nowait(message)
+            self.manager.dropped += 1
+        else:
+            self.manager.slow_disconnects += 1
+            self.close_soon(CLOSE_SLOW_CONSUMER)
+
+    async def _write_loop(self):
+        try:
+            while True:
+                message = await self.queue.get()
+                if message is None:
+                    break
+                if isinstance(message, bytes):
+                    send = self.websocket.send_bytes(message)
+                else:
+                    send = self.websocket.send_text(message)
+                began = time.perf_counter()
+                await asyncio.wait_for(send, SEND_TIMEOUT)
+                metrics.ws_send_seconds.observe(time.perf_counter() - began)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # Сокет закрыт или отправка зависла - цикл приема увидит закрытие
+            await self.close(status.WS_1011_INTERNAL_ERROR)
+
+    def _stop_writer(self):
+        self.closed = True
+        if self._writer is not None and self._writer is not asyncio.current_task():
+            self._writer.cancel()
+
+    async def _send_close(self, code: int):
+        try:
+            await asyncio.wait_for(self.websocket.close(code=code), SEND_TIMEOUT)
+        except Exception:
+            pass
+
+    async def close(self, code: int = status.WS_1000_NORMAL_CLOSURE):
+        if self.closed:
+            return
+        self._stop_writer()
+        await self._send_close(code)
+
+    def close_soon(self, code: int):
+        """Закрыть, не дожидаясь кадра закрытия: зовется из доставки чужих
+        сообщений, и зависший сокет не должен задерживать отправителя"""
+        if self.closed:
+            return
+        self._stop_writer()
+        self._closing = asyncio.create_task(self._send_close(code))
+
+    async def drain(self):
+        """Дописать очередь и остановить писателя (штатный выход клиента)"""
+        if self._writer is not None and not self.closed:
+            try:
+                self.queue.put_nowait(None)
+            except asyncio.QueueFull:
+                self._writer.cancel()
+            try:
+                await asyncio.wait_for(self._writer, SEND_TIMEOUT)
+            except (asyncio.CancelledError, asyncio.TimeoutError, Exception):
+                pass
+        self.closed = True
 
 class ConnectionManager:
-    def __init__(self):
-        self.active_connections: Dict[int, WebSocket] = {}
-        self.user_connections: Dict[int, Set[WebSocket]] = {}
-    
-    async def connect(self, websocket: WebSocket, user_id: int):
-        await websocket.accept()
-        
-        if user_id not in self.user_connections:
-            self.user_connections[user_id] = set()
-        
-        self.user_connections[user_id].add(websocket)
-        self.active_connections[user_id] = websocket
-        
-        print(f"✅ User {user_id} connected. Total connections: {len(self.active_connections)}")
-    
-    def disconnect(self, websocket: WebSocket, user_id: int):
-        if user_id in self.user_connections:
-            self.user_connections[user_id].discard(websocket)
-            if not self.user_connections[user_id]:
-                del self.user_connections[user_id]
-                if user_id in self.active_connections:
-                    del self.active_connections[user_id]
-        
-        print(f"❌ User {user_id} disconnected. Total connections: {len(self.active_connections)}")
-    
-    async def send_personal_message(self, message: dict, user_id: int):
-        if user_id in self.user_connections:
-            for connection in self.user_connections[user_id]:
-                try:
-                    await connection.send_json(message)
-                except:
-                    pass
-    
-    async def broadcast(self, message: dict):
-        for user_id in self.user_connections:
-            await self.send_personal_message(message, user_id)
-
-manager = ConnectionManager()
-
-async def websocket_endpoint(websocket: WebSocket, token: str, db: Session):
-    """WebSocket endpoint для обработки соединений"""
-    # Декодируем токен
-    user_id = auth.decode_access_token(token)
-    if not user_id:
-        await websocket.close(code=1008)
-        return
-    
-    user = crud.get_user_by_id(db, user_id)
-    if not user:
-        await websocket.close(code=1008)
-        return
-    
-    await manager.connect(websocket, user_id)
-    
-    try:
-        while True:
-            # Ждем данные от клиента
-            data = await websocket.receive_json()
-            print(f"📨 Received WebSocket data from user {user_id}: {data}")
-            
-            if data["type"] == "message":
-                # Создаем сообщение в БД
-                message = crud.create_message(
-                    db,
-                    schemas.MessageCreate(
-                        content=data["content"],
-                        receiver_id=data["receiver_id"]
-                    ),
-                    sender_id=user_id
-                )
-                
-                # Получаем данные пользователей
-                sender = crud.get_user_by_id(db, user_id)
-                receiver = crud.get_user_by_id(db, data["receiver_id"])
-                
-                # Формируем ответ
-                response = {
-                    "type": "new_message",
-                    "message": {
-                        "id": message.id,
-                        "sender_id": user_id,
-                        "receiver_id": data["receiver_id"],
-                        "content": data["content"],
-                        "is_read": False,
-                        "created_at": message.created_at.isoformat(),
-                        "sender_username": sender.username if sender else "",
-                        "receiver_username": receiver.username if receiver else ""
-                    }
-                }
-                
-                # Отправляем отправителю
-                await manager.send_personal_message(response, user_id)
-                
-                # Отправляем получателю, если он онлайн
-                await manager.send_personal_message(response, data["receiver_id"])
-                
-                print(f"📤 Message sent from {user_id} to {data['receiver_id']}")
-            
-            elif data["type"] == "read_messages":
-                # Отмечаем сообщения как прочитанные
-                count = crud.mark_messages_as_read(db, data["sender_id"], user_id)
-                
-                response = {
-                    "type": "messages_read",
-                    "sender_id": data["sender_id"],
-                    "receiver_id": user_id,
-                    "count": count
-                }
-                
-                # Уведомляем отправителя
-                await manager.send_personal_message(response, data["sender_id"])
-            
-            elif data["type"] == "typing":
-                # Уведомление о печатании
-                response = {
-                    "type": "user_typing",
-                    "sender_id": user_id,
-                    "receiver_id": data["receiver_id"],
-                    "is_typing": data["is_typing"]
-                }
-                
-                await manager.send_personal_message(response, data["receiver_id"])
-    
-    except WebSocketDisconnect:
-        print(f"🔌 WebSocket disconnected for user {user_id}")
-        manager.disconnect(websocket, user_id)
-    except Exception as e:
-        print(f"💥 WebSocket error for user {user_id}: {e}")
-        manager.disconnect(websocket, user_id)
\ No newline at end of file
+    """Все устройства пользователей этого воркера; между воркерами доставляет шина"""
+
+    def __init__(self, backplane: pubsub.Backplane):
+        self.user_connections: Dict[int, Set[Connection]] = {}
+        self.backplane = backplane
+        self.dropped = 0
+        self.slow_disconnects = 0
+        self.group_fanouts = 0
+        # Кадры последнего события по кодекам: по шине рассылка в группу
+        # приходит отдельным сообщением на каждого участника, кодируем один раз
+        self._last_frames: Tuple[Optional[str], Dict[str, codecs.Frame]] = (None, {})
+
+    async def connect(self, websocket: WebSocket, user_id: int) -> Connection:
+        codec = codecs.negotiate(websocket.scope.get("subprotocols", []))
+        await websocket.accept(subprotocol=codec.name if codec else None)
+        connection = Connection(websocket, user_id, self, codec or codecs.DEFAULT_CODEC)
+        connection.start()
+
+        devices = self.user_connections.setdefault(user_id, set())
+        devices.add(connection)
+        if len(devices) == 1:
+            await self.backplane.subscribe(user_id)
+        logger.info("websocket connected", extra={"user_id": user_id, "devices": len(devices), "sample": True})
+        return connection
+
+    async def disconnect(self, connection: Connection):
+        await connection.drain()
+        connection.quota.release()
+        devices = self.user_connections.get(connection.user_id)
+        if devices is None or connection not in devices:
+            return
+        devices.discard(connection)
+        if not devices:
+            del self.user_connections[connection.user_id]
+            await self.backplane.unsubscribe(connection.user_id)
+        logger.info("websocket disconnected", extra={"user_id": connection.user_id, "sample": True})
+
+    async def send_personal_message(self, event: dict, user_id: int, origin: Optional[Connection] = None):
+        # Получатель может быть подключен к другому воркеру - доставляет шина.
+        # По шине событие идет в JSON, в кодек соединения - уже на месте.
+        # origin - устройство, которое событие уже знает и не получит
+        if origin is not None:
+            event = dict(event, **{ORIGIN_FIELD: origin.device_id})
+        await self.backplane.publish(user_id, codecs.DEFAULT_CODEC.encode(event))
+
+    async def send_group_message(self, event: dict, user_ids: Iterable[int]):
+        """Одно событие многим: сериализуется один раз, публикуется одной пачкой"""
+        self.group_fanouts += 1
+        await self.backplane.publish_many(user_ids, codecs.DEFAULT_CODEC.encode(event))
+
+    async def deliver_local(self, user_id: int, message: str):
+        await self.deliver_local_many((user_id,), message)
+
+    async def deliver_local_many(self, user_ids: Iterable[int], message: str):
+        connections = [
+            connection
+            for user_id in user_ids
+            for connection in self.user_connections.get(user_id, ())
+        ]
+        # Разбираем только события с источником - остальные идут как есть
+        if connections and f'"{ORIGIN_FIELD}":' in message:
+            origin = codecs.DEFAULT_CODEC.decode(message).get(ORIGIN_FIELD)
+            connections = [connection for connection in connections if connection.device_id != origin]
+        if not connections:
+            return
+
+        began = time.perf_counter()
+        frames = self._frames(message, connections)
+        # Обычно очередь свободна и кадр кладется сразу; задачи нужны только
+        # переполненным очередям, где send может закрывать соединение
+        slow = [
+            connection for connection in connections
+            if not connection.offer(frames[connection.codec.name])
+        ]
+        if slow:
+            await asyncio.gather(*(connection.send(frames[connection.codec.name]) for connection in slow))
+        metrics.fanout_seconds.observe(time.perf_counter() - began)
+
+    def _frames(self, message: str, connections: List[Connection]) -> Dict[str, codecs.Frame]:
+        # Каждый кодек кодирует событие один раз, сколько бы устройств его ни использовали
+        last_message, frames = self._last_frames
+        if last_message != message:
+            frames = {codecs.DEFAULT_CODEC.name: message}
+            self._last_frames = (message, frames)
+        event = None
+        for connection in connections:
+            if connection.codec.name not in frames:
+                if event is None:
+                    event = codecs.DEFAULT_CODEC.decode(message)
+                frames[connection.codec.name] = connection.codec.encode(event)
+        return frames
+
+    def stats(self) -> dict:
+        return {
+            "users": len(self.user_connections),
+            "connections": sum(len(devices) for devices in self.user_connections.values()),
+            "queued": sum(
+                connection.queue.qsize()
+                for devices in self.user_connections.values()
+                for connection in devices
+            ),
+            "dropped": self.dropped,
+            "slow_disconnects": self.slow_disconnects,
+            "group_fanouts": self.group_fanouts,
+        }
+
+async def authenticate_websocket(websocket: WebSocket, db: AsyncSession) -> Optional[cache.CachedUser]:
+    """Пользователь из cookie access_token или параметра ?token= (для не-браузерных клиентов)"""
+    token = websocket.cookies.get("access_token") or websocket.query_params.get("token")
+    if not token:
+        return None
+    user_id = cache.decode_access_token(token)
+    if user_id is None:
+        return None
+    user = await cache.get_user(db, user_id)
+    if user is None or not user.is_active:
+        return None
+    return user
+
+manager = ConnectionManager(pubsub.create_backplane())
@@ -0,0 +1,120 @@
+"""Общие части бенчмарков: перцентили, JSON-отчет для сравнения коммитов, пользователи.
+
+Каждый бенчмарк с --json PATH пишет отчет:
+
+    {
+      "benchmark": "swarm",
+      "commit": "4491343", "dirty": false,
+      "timestamp": "...", "python": "3.11.7",
+      "params": {...},          # аргументы запуска
+      "env": {...},             # настройки сервера из окружения (DB_PROFILE, ...)
+      "results": [{"scenario": "...", "throughput": ..., "p50_ms": ..., "p99_ms": ...}]
+    }
+
+benchmarks/compare.py сравнивает такие отчеты по (benchmark, scenario).
+"""
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+from datetime import datetime, timezone
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Настройки, от которых зависят цифры; попадают в отчет, если заданы
+ENV_KNOBS = (
+    "DATABASE_URL", "DB_PROFILE", "DB_SPLIT_READ_WRITE", "MESSAGE_DURABILITY", "MESSAGE_BATCH_SIZE",
+    "MESSAGE_FLUSH_INTERVAL_MS", "PUBSUB_URL", "WORKERS", "BCRYPT_ROUNDS", "BCRYPT_WORKERS",
+    "SEARCH_BACKEND", "WS_PER_MESSAGE_DEFLATE", "WS_CONNECTION_RATE", "WS_USER_RATE", "WS_INGRESS_RATE",
+)
+
+def percentile(values, fraction):
+    """values должны быть отсортированы"""
+    return values[max(int(len(values) * fraction) - 1, 0)] if values else 0.0
+
+def summarize(latencies, elapsed=None) -> dict:
+    """Задержки в секундах -> p50/p90/p99/max в миллисекундах и пропускная способность"""
+    values = sorted(latencies)
+    summary = {
+        "count": len(values),
+        "p50_ms": statistics.median(values) * 1000 if values else 0.0,
+        "p90_ms": percentile(values, 0.90) * 1000,
+        "p99_ms": percentile(values, 0.99) * 1000,
+        "max_ms": values[-1] * 1000 if values else 0.0,
+    }
+    if elapsed is not None:
+        summary["throughput"] = len(values) / elapsed if elapsed else 0.0
+    return summary
+
+def add_report_argument(parser):
+    parser.add_argument("--json", metavar="PATH", help="write results as a JSON report for benchmarks/compare.py")
+
+def _git(*args) -> str:
+    try:
+        return subprocess.run(
+            ["git", *args], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+def current_commit() -> str:
+    return _git("rev-parse", "--short", "HEAD")
+
+def write_report(path, benchmark, params, results):
+    if not path:
+        return
+    report = {
+        "benchmark": benchmark,
+        "commit": current_commit(),
+        "dirty": bool(_git("status", "--porcelain", "--untracked-files=no")),
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "params": params,
+        "env": {name: os.environ[name] for name in ENV_KNOBS if name in os.environ},
+        "results": results,
+    }
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    with open(path, "w") as output:
+        json.dump(report, output, indent=2)
+    print(f"report written to {path}")
+
+def open_database():
+    """Движки DATABASE_URL сервера и актуальная схема (то же, что python run.py migrate)"""
+    from app import database, migrations
+
+    database.init_engines()
+    migrations.upgrade(database.engine)
+    return database
+
+def seed_users(first_user_id, count, prefix="bench"):
+    """Пользователи с id first_user_id.. в DATABASE_URL сервера (без пароля, вход по токену)"""
+    from app import models
+
+    database = open_database()
+    with database.SessionLocal() as db:
+        existing = {
+            user_id for (user_id,) in db.query(models.User.id).filter(
+                models.User.id.between(first_user_id, first_user_id + count - 1)
+            )
+        }
+        db.add_all([
+            models.User(
+                id=user_id,
+                username=f"{prefix}{user_id}",
+                email=f"{prefix}{user_id}@bench.local",
+                hashed_password="-"
+            )
+            for user_id in range(first_user_id, first_user_id + count)
+            if user_id not in existing
+        ])
+        db.commit()
+
+def make_token(user_id):
+    """Токен, подписанный SECRET_KEY из окружения, как выдает сервер"""
+    from app import auth
+
+    return auth.create_access_token(data={"sub": str(user_id)})
@@ -0,0 +1,84 @@
+"""Сравнение отчетов бенчмарков (--json) двух коммитов.
+
+    python benchmarks/compare.py results/4491343 results/HEAD --threshold 10
+
+Аргументы - файлы отчетов или каталоги с ними (как пишет suite.py).
+Строки сопоставляются по (benchmark, scenario). Задержки (*_ms) лучше
+меньше, throughput - больше; изменение хуже --threshold процентов
+помечается как регрессия, и код выхода становится 1.
+"""
+import argparse
+import glob
+import json
+import os
+import sys
+
+LOWER_IS_BETTER = (
+    "p50_ms", "p90_ms", "p99_ms", "fanout_p50_ms", "fanout_p99_ms",
+    "lifespan_ms", "first_request_ms", "first_api_ms",
+)
+HIGHER_IS_BETTER = ("throughput",)
+COUNTERS = ("errors", "rejected", "failed", "connect_errors", "missing")
+
+def load(path):
+    paths = sorted(glob.glob(os.path.join(path, "*.json"))) if os.path.isdir(path) else [path]
+    rows, meta = {}, {}
+    for report_path in paths:
+        with open(report_path) as source:
+            report = json.load(source)
+        meta[report["benchmark"]] = report
+        for result in report["results"]:
+            rows[(report["benchmark"], result["scenario"])] = result
+    return rows, meta
+
+def describe(meta):
+    commits = {f"{report['commit']}{'+dirty' if report.get('dirty') else ''}" for report in meta.values()}
+    return ", ".join(sorted(commits)) or "?"
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("base")
+    parser.add_argument("new")
+    parser.add_argument("--threshold", type=float, default=10, help="percent")
+    args = parser.parse_args()
+
+    base, base_meta = load(args.base)
+    new, new_meta = load(args.new)
+    print(f"base: {describe(base_meta)}    new: {describe(new_meta)}")
+
+    # Разные настройки сервера делают сравнение бессмысленным - предупреждаем
+    for benchmark in sorted(base_meta.keys() & new_meta.keys()):
+        if base_meta[benchmark].get("env") != new_meta[benchmark].get("env"):
+            print(f"warning: {benchmark} ran with different server settings")
+
+    regressions = 0
+    print(f"{'benchmark':<14} {'scenario':<14} {'metric':<16} {'base':>11} {'new':>11} {'change':>9}")
+    for key in sorted(base.keys() & new.keys()):
+        before, after = base[key], new[key]
+        for metric in LOWER_IS_BETTER + HIGHER_IS_BETTER + COUNTERS:
+            if metric not in before or metric not in after:
+                continue
+            old_value, new_value = before[metric], after[metric]
+            if metric in COUNTERS:
+                if old_value == new_value:
+                    continue
+                change, worse = "", new_value > old_value
+            else:
+                delta = (new_value - old_value) / old_value * 100 if old_value else 0.0
+                change = f"{delta:+.1f}%"
+                worse = delta > args.threshold if metric in LOWER_IS_BETTER else -delta > args.threshold
+            regressions += worse
+            print(
+                f"{key[0]:<14} {key[1]:<14} {metric:<16} {old_value:>11.2f} {new_value:>11.2f} "
+                f"{change:>9}{'  REGRESSION' if worse else ''}"
+            )
+
+    for key in sorted(base.keys() ^ new.keys()):
+        print(f"{key[0]:<14} {key[1]:<14} only in {'base' if key in base else 'new'}")
+
+    if regressions:
+        print(f"{regressions} regression(s) beyond {args.threshold:g}%")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""Смешанная нагрузка чтение/запись: текущая настройка SQLite против профиля production.
+
+    python benchmarks/db_profile.py --seconds 10 --writers 4 --readers 16
+
+Каждая конфигурация запускается в отдельном процессе на свежей БД
+(настройки движка читаются из окружения при импорте app.database).
+Писатели вызывают crud_async.create_message (коммит на сообщение),
+читатели листают последние страницы истории случайных диалогов.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+CONFIGURATIONS = [
+    ("default", {"DB_PROFILE": "default"}),
+    ("production", {"DB_PROFILE": "production"}),
+    ("production+split", {"DB_PROFILE": "production", "DB_SPLIT_READ_WRITE": "true"}),
+]
+
+async def run_workload(seconds, writers, readers, users, seed_messages):
+    from app import crud, crud_async, models, schemas
+    from common import open_database
+
+    database = open_database()
+    with database.SessionLocal() as db:
+        db.add_all([
+            models.User(username=f"user{i}", email=f"user{i}@bench.local", hashed_password="-")
+            for i in range(users)
+        ])
+        db.commit()
+        crud.create_messages(db, [
+            {
+                "id": crud.reserve_ids(db, "messages", 1),
+                "sender_id": random.randint(1, users),
+                "receiver_id": random.randint(1, users),
+                "content": "seed message " * 4,
+                "created_at": datetime.utcnow()
+            }
+            for _ in range(seed_messages)
+        ])
+
+    deadline = time.perf_counter() + seconds
+    writes = 0
+    read_latencies = []
+
+    async def writer():
+        nonlocal writes
+        async with database.AsyncSessionLocal() as db:
+            while time.perf_counter() < deadline:
+                message = schemas.MessageCreate(content="bench message", receiver_id=random.randint(1, users))
+                await crud_async.create_message(db, message, random.randint(1, users))
+                writes += 1
+
+    async def reader():
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            async with database.AsyncReadSessionLocal() as db:
+                await crud_async.get_messages_between_users(
+                    db, random.randint(1, users), random.randint(1, users)
+                )
+            read_latencies.append(time.perf_counter() - started)
+
+    await asyncio.gather(*[writer() for _ in range(writers)], *[reader() for _ in range(readers)])
+    await database.dispose_engines()
+
+    reads = len(read_latencies)
+    read_latencies = sorted(read_latencies) or [0.0]
+    return {
+        "writes_per_sec": writes / seconds,
+        "reads_per_sec": reads / seconds,
+        "read_p50_ms": statistics.median(read_latencies) * 1000,
+        "read_p99_ms": read_latencies[max(int(len(read_latencies) * 0.99) - 1, 0)] * 1000,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--writers", type=int, default=4)
+    parser.add_argument("--readers", type=int, default=16)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--seed-messages", type=int, default=20000)
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        result = asyncio.run(run_workload(
+            args.seconds, args.writers, args.readers, args.users, args.seed_messages
+        ))
+        print(json.dumps(result))
+        return
+
+    print(f"{'profile':<18} {'writes/s':>10} {'reads/s':>10} {'read p50 ms':>12} {'read p99 ms':>12}")
+    for name, env in CONFIGURATIONS:
+        with tempfile.TemporaryDirectory() as directory:
+            child_env = dict(os.environ, DATABASE_URL=f"sqlite:///{directory}/bench.db", **env)
+            output = subprocess.run(
+                [sys.executable, __file__, "--child"] + sys.argv[1:],
+                env=child_env, capture_output=True, text=True, check=True
+            ).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        print(
+            f"{name:<18} {result['writes_per_sec']:>10.1f} {result['reads_per_sec']:>10.1f} "
+            f"{result['read_p50_ms']:>12.2f} {result['read_p99_ms']:>12.2f}"
+        )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+"""Рассылка в группу: задержка доставки всем онлайн-участникам группы 10/1k/10k.
+
+Запуск против работающего сервера (python run.py):
+
+    python benchmarks/group_fanout.py --url ws://localhost:8000 --members 10 1000 10000 --seed-users
+
+Для каждого размера создается группа (напрямую в DATABASE_URL сервера),
+все участники подключаются, первый отправляет --messages сообщений с
+интервалом --interval. Меряются задержка каждой доставки (отправка ->
+new_message у участника) и время до последнего участника, то есть полной
+рассылки одного сообщения (участники, которые не смогли подключиться,
+в ожидании не учитываются). Для 10k сокетов: ulimit -n 65536.
+"""
+import argparse
+import asyncio
+import json
+import time
+
+import websockets
+
+from common import add_report_argument, make_token, seed_users, summarize, write_report
+
+def create_group(first_user_id, members):
+    from app import crud, database
+
+    database.init_engines()
+    with database.SessionLocal() as db:
+        member_ids = list(range(first_user_id, first_user_id + members))
+        return crud.create_group(db, f"bench {members}", member_ids[0], member_ids[1:]).id
+
+async def run_member(url, user_id, connected, done, arrivals):
+    token = make_token(user_id)
+    try:
+        ws = await websockets.connect(f"{url}/ws?token={token}", open_timeout=60, max_queue=None)
+    except Exception:
+        connected.set_result(False)
+        return
+    connected.set_result(True)
+    try:
+        while not done.is_set():
+            try:
+                event = json.loads(await asyncio.wait_for(ws.recv(), 0.5))
+            except asyncio.TimeoutError:
+                continue
+            if event.get("type") == "new_message":
+                arrivals.append((int(event["content"]), time.perf_counter()))
+    finally:
+        await ws.close()
+
+async def run_level(url, members, messages, interval, first_user_id, connect_batch):
+    conversation_id = create_group(first_user_id, members)
+    loop = asyncio.get_running_loop()
+    done = asyncio.Event()
+    arrivals = []
+    receivers = []
+    connect_errors = 0
+    # Следующая пачка подключается, когда предыдущая готова: иначе тысячи
+    # одновременных рукопожатий переполняют backlog accept сервера
+    for start in range(1, members, connect_batch):
+        batch = [loop.create_future() for _ in range(start, min(start + connect_batch, members))]
+        for offset, connected in enumerate(batch):
+            receivers.append(asyncio.create_task(
+                run_member(url, first_user_id + start + offset, connected, done, arrivals)
+            ))
+        connect_errors += sum(not ok for ok in await asyncio.gather(*batch))
+    online = members - 1 - connect_errors
+
+    sent_at = {}
+    began = time.perf_counter()
+    async with websockets.connect(f"{url}/ws?token={make_token(first_user_id)}", open_timeout=60) as sender:
+        for i in range(messages):
+            sent_at[i] = time.perf_counter()
+            await sender.send(json.dumps({"type": "message", "conversation_id": conversation_id, "content": str(i)}))
+            while json.loads(await sender.recv())["type"] != "message_sent":
+                pass
+            await asyncio.sleep(interval)
+
+        # Ждем хвост рассылки: все доставки или паузу без новых
+        expected = messages * online
+        last_count, idle = -1, 0
+        while len(arrivals) < expected and idle < 20:
+            idle = idle + 1 if len(arrivals) == last_count else 0
+            last_count = len(arrivals)
+            await asyncio.sleep(0.1)
+    elapsed = time.perf_counter() - began
+    done.set()
+    await asyncio.gather(*receivers, return_exceptions=True)
+
+    latencies = [arrived - sent_at[index] for index, arrived in arrivals]
+    completion = {}
+    for index, arrived in arrivals:
+        completion[index] = max(completion.get(index, 0.0), arrived - sent_at[index])
+    full = summarize(list(completion.values()))
+    return dict(
+        summarize(latencies, elapsed),
+        scenario=f"{members} members",
+        members=members,
+        connect_errors=connect_errors,
+        missing=expected - len(arrivals),
+        fanout_p50_ms=full["p50_ms"],
+        fanout_p99_ms=full["p99_ms"]
+    )
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="ws://localhost:8000")
+    parser.add_argument("--members", type=int, nargs="+", default=[10, 1000, 10000])
+    parser.add_argument("--messages", type=int, default=20, help="messages sent to each group")
+    parser.add_argument("--interval", type=float, default=0.05, help="seconds between messages")
+    parser.add_argument("--first-user-id", type=int, default=1)
+    parser.add_argument("--connect-batch", type=int, default=200)
+    parser.add_argument("--seed-users", action="store_true", help="create bench users in DATABASE_URL")
+    add_report_argument(parser)
+    args = parser.parse_args()
+
+    if args.seed_users:
+        seed_users(args.first_user_id, max(args.members))
+
+    print(
+        f"{'members':>8} {'conn err':>8} {'deliveries':>11} {'missing':>8} "
+        f"{'p50 ms':>9} {'p99 ms':>9} {'all p50':>9} {'all p99':>9}"
+    )
+    results = []
+    for members in args.members:
+        result = await run_level(
+            args.url, members, args.messages, args.interval, args.first_user_id, args.connect_batch
+        )
+        results.append(result)
+        print(
+            f"{result['members']:>8} {result['connect_errors']:>8} {result['count']:>11} {result['missing']:>8} "
+            f"{result['p50_ms']:>9.2f} {result['p99_ms']:>9.2f} "
+            f"{result['fanout_p50_ms']:>9.2f} {result['fanout_p99_ms']:>9.2f}"
+        )
+    write_report(args.json, "group_fanout", vars(args), results)
+
+if __name__ == "__main__":
+    asyncio.run(main())
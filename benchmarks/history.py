@@ -0,0 +1,253 @@
+"""Чтение истории на больших базах: последняя страница, глубокая прокрутка, список чатов.
+
+Сначала база засевается (один раз, в отдельный файл), потом на ней
+запускается сервер и сам бенчмарк:
+
+    mkdir -p benchmarks/data
+    export DATABASE_URL=sqlite:///benchmarks/data/history-1m.db
+    python benchmarks/history.py seed --messages 1000000
+    python run.py &
+    python benchmarks/history.py run --url http://localhost:8000 --duration 20 --json out.json
+
+Для 10M: --messages 10000000 в history-10m.db (около 2 ГБ с индексом поиска).
+
+Сообщения распределены по диалогам по закону Ципфа: несколько горячих
+диалогов держат сотни тысяч сообщений, хвост - десятки. Время сообщений
+равномерно растет за последние --days дней. Сценарии run:
+
+  latest - последняя страница случайного диалога (/api/messages/{id})
+  scroll - листание горячего диалога вглубь по next_cursor
+  chats  - список чатов случайного пользователя (/api/chats)
+  search - поиск по словарю сидера (/api/search), если есть индекс
+
+run читает пары собеседников из той же DATABASE_URL и подписывает токены
+SECRET_KEY из окружения, как сервер.
+"""
+import argparse
+import asyncio
+import itertools
+import random
+import time
+from datetime import datetime, timedelta
+
+import httpx
+
+from common import add_report_argument, make_token, open_database, seed_users, summarize, write_report
+
+WORDS = (
+    "привет как дела встреча завтра утром вечером отчет проект код релиз база сервер "
+    "кофе обед звонок созвон документ ссылка фото отпуск погода пятница неделя задача "
+    "hello deploy review merge ticket build latency cache index query"
+).split()
+
+SCENARIOS = ("latest", "scroll", "chats", "search")
+
+def seed(args):
+    from sqlalchemy import bindparam, func, insert, text, update
+
+    from app import crud, models, search
+
+    database = open_database()
+    rng = random.Random(args.seed)
+
+    with database.SessionLocal() as db:
+        if db.query(func.count(models.Message.id)).scalar():
+            print("database already has messages; seed into a fresh DATABASE_URL")
+            return
+
+    seed_users(args.first_user_id, args.users, prefix="hist")
+    user_ids = range(args.first_user_id, args.first_user_id + args.users)
+    pairs = set()
+    while len(pairs) < args.conversations:
+        pairs.add(tuple(sorted(rng.sample(user_ids, 2))))
+
+    with database.SessionLocal() as db:
+        if database.IS_SQLITE:
+            db.execute(text("PRAGMA synchronous=OFF"))
+        conversation_ids = {}
+        ordered = sorted(pairs)
+        for offset in range(0, len(ordered), 500):
+            conversation_ids.update(crud.get_or_create_conversations(db, ordered[offset:offset + 500]))
+
+        conversations = [(conversation_ids[pair], pair) for pair in ordered]
+        rng.shuffle(conversations)
+        weights = list(itertools.accumulate(1 / (rank + 1) ** args.zipf for rank in range(len(conversations))))
+
+        messages = models.Message.__table__
+        began = time.perf_counter()
+        first_at = datetime.utcnow() - timedelta(days=args.days)
+        step = timedelta(days=args.days) / args.messages
+        latest = {}
+        for offset in range(0, args.messages, args.chunk):
+            count = min(args.chunk, args.messages - offset)
+            first_id = crud.reserve_ids(db, "messages", count)
+            rows = []
+            for i, (conversation_id, pair) in enumerate(rng.choices(conversations, cum_weights=weights, k=count)):
+                sender_id = rng.choice(pair)
+                row = {
+                    "id": first_id + i,
+                    "conversation_id": conversation_id,
+                    "sender_id": sender_id,
+                    "receiver_id": pair[0] if sender_id == pair[1] else pair[1],
+                    "content": " ".join(rng.choices(WORDS, k=rng.randint(2, 14))),
+                    "is_read": False,
+                    "created_at": first_at + step * (offset + i)
+                }
+                rows.append(row)
+                latest[conversation_id] = row
+            db.execute(insert(messages), rows)
+            db.commit()
+            done = offset + count
+            print(f"\r{done}/{args.messages} messages, {done / (time.perf_counter() - began):.0f}/s", end="", flush=True)
+        print()
+
+        conversations_table = models.Conversation.__table__
+        db.execute(
+            update(conversations_table)
+            .where(conversations_table.c.id == bindparam("b_conversation_id"))
+            .values(
+                last_message_id=bindparam("b_message_id"),
+                last_message_at=bindparam("b_message_at"),
+                last_message_sender_id=bindparam("b_sender_id"),
+                last_message_preview=bindparam("b_preview")
+            ),
+            [
+                {
+                    "b_conversation_id": conversation_id,
+                    "b_message_id": row["id"],
+                    "b_message_at": row["created_at"],
+                    "b_sender_id": row["sender_id"],
+                    "b_preview": row["content"][:crud.CHAT_PREVIEW_LENGTH]
+                }
+                for conversation_id, row in latest.items()
+            ]
+        )
+        db.commit()
+
+    if args.search_index:
+        print(f"rebuilding search index ({search.backend.name})")
+        with database.engine.begin() as connection:
+            search.backend.rebuild(connection)
+    print(f"seeded {args.messages} messages in {len(pairs)} conversations, {time.perf_counter() - began:.0f}s")
+
+def load_targets(sample):
+    """Случайные диалоги и десять самых больших - для прокрутки вглубь"""
+    from sqlalchemy import func
+
+    from app import database, models
+
+    database.init_engines()
+    with database.SessionLocal() as db:
+        conversation = models.Conversation
+        pairs = db.query(conversation.user_low_id, conversation.user_high_id).order_by(func.random()).limit(sample).all()
+        hot = (
+            db.query(conversation.user_low_id, conversation.user_high_id)
+            .join(models.Message, models.Message.conversation_id == conversation.id)
+            .group_by(conversation.id)
+            .order_by(func.count(models.Message.id).desc())
+            .limit(10)
+            .all()
+        )
+    return [tuple(pair) for pair in pairs], [tuple(pair) for pair in hot]
+
+class Tokens(dict):
+    def __missing__(self, user_id):
+        token = self[user_id] = make_token(user_id)
+        return token
+
+async def run_scenario(client, name, pairs, hot, args, tokens):
+    latencies, errors = [], 0
+    deadline = time.perf_counter() + args.duration
+
+    async def request(user_id, url, params=None):
+        nonlocal errors
+        began = time.perf_counter()
+        response = await client.get(url, params=params, headers={"Cookie": f"access_token={tokens[user_id]}"})
+        if response.status_code != 200:
+            errors += 1
+            return None
+        latencies.append(time.perf_counter() - began)
+        return response.json()
+
+    async def worker(rng):
+        while time.perf_counter() < deadline:
+            user_id, peer_id = rng.sample(rng.choice(hot if name == "scroll" else pairs), 2)
+            if name == "latest":
+                await request(user_id, f"/api/messages/{peer_id}", {"limit": args.page_size})
+            elif name == "chats":
+                await request(user_id, "/api/chats")
+            elif name == "search":
+                await request(user_id, "/api/search", {"q": rng.choice(WORDS), "limit": 20})
+            else:
+                cursor = None
+                for _ in range(args.pages):
+                    params = {"limit": args.page_size}
+                    if cursor:
+                        params["before"] = cursor
+                    page = await request(user_id, f"/api/messages/{peer_id}", params)
+                    cursor = page and page["next_cursor"]
+                    if not cursor or time.perf_counter() >= deadline:
+                        break
+
+    began = time.perf_counter()
+    await asyncio.gather(*(worker(random.Random(args.seed + i)) for i in range(args.concurrency)))
+    return dict(summarize(latencies, time.perf_counter() - began), scenario=name, errors=errors)
+
+async def run(args):
+    pairs, hot = load_targets(args.sample)
+    if not pairs:
+        raise SystemExit("no conversations in DATABASE_URL; run the seed command first")
+
+    tokens = Tokens()
+    limits = httpx.Limits(max_connections=args.concurrency)
+    results = []
+    print(f"{'scenario':<8} {'req/s':>9} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'errors':>7}")
+    async with httpx.AsyncClient(base_url=args.url, limits=limits, timeout=60) as client:
+        for name in args.scenarios:
+            result = await run_scenario(client, name, pairs, hot, args, tokens)
+            results.append(result)
+            print(
+                f"{name:<8} {result['throughput']:>9.1f} {result['p50_ms']:>9.2f} "
+                f"{result['p90_ms']:>9.2f} {result['p99_ms']:>9.2f} {result['errors']:>7}"
+            )
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    seed_parser = commands.add_parser("seed", help="fill DATABASE_URL with synthetic history")
+    seed_parser.add_argument("--messages", type=int, default=1_000_000)
+    seed_parser.add_argument("--conversations", type=int, default=20_000)
+    seed_parser.add_argument("--users", type=int, default=10_000)
+    seed_parser.add_argument("--first-user-id", type=int, default=100_000)
+    seed_parser.add_argument("--days", type=int, default=365)
+    seed_parser.add_argument("--zipf", type=float, default=1.1, help="conversation size skew")
+    seed_parser.add_argument("--chunk", type=int, default=20_000)
+    seed_parser.add_argument("--no-search-index", dest="search_index", action="store_false")
+    seed_parser.add_argument("--seed", type=int, default=1)
+
+    run_parser = commands.add_parser("run", help="benchmark a server running on the seeded database")
+    run_parser.add_argument("--url", default="http://localhost:8000")
+    run_parser.add_argument("--duration", type=float, default=20, help="seconds per scenario")
+    run_parser.add_argument("--concurrency", type=int, default=32)
+    run_parser.add_argument("--page-size", type=int, default=50)
+    run_parser.add_argument("--pages", type=int, default=50, help="pages per scroll session")
+    run_parser.add_argument("--sample", type=int, default=2000, help="random conversations to read")
+    run_parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    run_parser.add_argument("--seed", type=int, default=1)
+    add_report_argument(run_parser)
+
+    args = parser.parse_args()
+    if args.command == "seed":
+        seed(args)
+        return
+
+    results = asyncio.run(run(args))
+    from app import database
+
+    params = dict(vars(args), database=database.SQLALCHEMY_DATABASE_URL)
+    write_report(args.json, "history", params, results)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""Шторм логинов: задержка входа, доля 429 и отзывчивость event loop.
+
+Запуск против работающего сервера (python run.py), нужен httpx:
+
+    python benchmarks/login_storm.py --url http://localhost:8000 --users 200 --concurrency 200 --seed-users
+
+Все --users пользователей входят одновременно (не больше --concurrency
+запросов в полете). Параллельно зонд раз в --probe-interval мс запрашивает
+/stats: его задержка показывает, насколько bcrypt задерживает остальной
+трафик воркера. --seed-users создает пользователей прямо в DATABASE_URL
+сервера с паролем --password (хеш считается один раз, BCRYPT_ROUNDS из
+окружения).
+"""
+import argparse
+import asyncio
+import time
+
+import httpx
+
+from common import add_report_argument, open_database, summarize, write_report
+
+def seed_users(count, password):
+    from app import auth, models
+
+    database = open_database()
+    hashed_password = auth.get_password_hash(password)
+    with database.SessionLocal() as db:
+        existing = {
+            email for (email,) in db.query(models.User.email).filter(models.User.email.like("storm%@bench.local"))
+        }
+        db.add_all([
+            models.User(username=f"storm{i}", email=f"storm{i}@bench.local", hashed_password=hashed_password)
+            for i in range(count)
+            if f"storm{i}@bench.local" not in existing
+        ])
+        db.commit()
+
+async def login(client, semaphore, index, password, results):
+    async with semaphore:
+        began = time.perf_counter()
+        response = await client.post("/login", data={"email": f"storm{index}@bench.local", "password": password})
+        results.append((response.status_code, time.perf_counter() - began))
+
+async def probe(client, interval, stop, latencies):
+    while not stop.is_set():
+        began = time.perf_counter()
+        await client.get("/stats")
+        latencies.append(time.perf_counter() - began)
+        await asyncio.sleep(interval)
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--password", default="storm-password")
+    parser.add_argument("--probe-interval", type=float, default=50, help="ms")
+    parser.add_argument("--seed-users", action="store_true")
+    add_report_argument(parser)
+    args = parser.parse_args()
+
+    if args.seed_users:
+        seed_users(args.users, args.password)
+
+    limits = httpx.Limits(max_connections=args.concurrency + 1)
+    async with httpx.AsyncClient(base_url=args.url, limits=limits, timeout=120) as client, \
+            httpx.AsyncClient(base_url=args.url, timeout=120) as probe_client:
+        results, probe_latencies = [], []
+        stop = asyncio.Event()
+        probe_task = asyncio.create_task(probe(probe_client, args.probe_interval / 1000, stop, probe_latencies))
+
+        semaphore = asyncio.Semaphore(args.concurrency)
+        began = time.perf_counter()
+        await asyncio.gather(*(login(client, semaphore, i, args.password, results) for i in range(args.users)))
+        elapsed = time.perf_counter() - began
+        stop.set()
+        await probe_task
+
+    by_status = {}
+    for code, _ in results:
+        by_status[code] = by_status.get(code, 0) + 1
+    login_summary = dict(
+        summarize([latency for code, latency in results if code == 303], elapsed),
+        scenario="login",
+        rejected=by_status.get(429, 0),
+        errors=sum(count for code, count in by_status.items() if code not in (303, 429))
+    )
+    probe_summary = dict(summarize(probe_latencies), scenario="stats probe")
+
+    print(f"logins: {len(results)} in {elapsed:.2f}s, status: {dict(sorted(by_status.items()))}")
+    print(f"successful login  p50 {login_summary['p50_ms']:.0f} ms, p99 {login_summary['p99_ms']:.0f} ms")
+    print(
+        f"/stats probe      p50 {probe_summary['p50_ms']:.1f} ms, "
+        f"p99 {probe_summary['p99_ms']:.1f} ms, max {probe_summary['max_ms']:.1f} ms"
+    )
+    write_report(args.json, "login_storm", vars(args), [login_summary, probe_summary])
+
+if __name__ == "__main__":
+    asyncio.run(main())
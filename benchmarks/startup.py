@@ -0,0 +1,128 @@
+"""Время старта воркера: с прогревом и без, плюс шаг миграций деплоя.
+
+    python benchmarks/startup.py --runs 5 --seed-users
+
+Бенчмарк сам запускает сервер (uvicorn app.main:app на --port, с
+настройками из окружения и DATABASE_URL) --runs раз для каждого сценария:
+
+    warm - как в продакшене, прогрев в lifespan (WARMUP=true)
+    cold - WARMUP=false, пулы, шаблоны и кэши заполняются первыми запросами
+
+Меряются время от запуска процесса до первого принятого соединения
+(p50/p99_ms; uvicorn принимает соединения только после lifespan), время
+lifespan и прогрева по /stats воркера и первые запросы пользователя
+--user-id: страница /chats и /api/chats. Сценарий migrate - время
+python run.py migrate на уже обновленной схеме (проверка версии).
+"""
+import argparse
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+
+import httpx
+
+from common import ROOT, add_report_argument, make_token, open_database, seed_users, summarize, write_report
+
+SCENARIOS = (("warm", {"WARMUP": "true"}), ("cold", {"WARMUP": "false"}))
+
+def wait_for_port(port, process, timeout):
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"server exited with code {process.returncode}")
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.1):
+                return
+        except OSError:
+            time.sleep(0.005)
+    raise RuntimeError(f"server did not start in {timeout}s")
+
+def timed_get(client, path):
+    began = time.perf_counter()
+    response = client.get(path)
+    response.raise_for_status()
+    return time.perf_counter() - began, response
+
+def start_once(args, overrides):
+    env = dict(os.environ, **overrides)
+    command = [
+        sys.executable, "-m", "uvicorn", "app.main:app",
+        "--host", "127.0.0.1", "--port", str(args.port), "--log-level", "warning"
+    ]
+    began = time.perf_counter()
+    process = subprocess.Popen(command, cwd=ROOT, env=env)
+    try:
+        wait_for_port(args.port, process, args.timeout)
+        ready = time.perf_counter() - began
+        cookies = {"access_token": make_token(args.user_id)}
+        with httpx.Client(base_url=f"http://127.0.0.1:{args.port}", cookies=cookies) as client:
+            first_page, _ = timed_get(client, "/chats")
+            first_api, _ = timed_get(client, "/api/chats")
+            startup = client.get("/stats").json()["startup"]
+    finally:
+        process.terminate()
+        process.wait(30)
+    return {
+        "ready": ready,
+        "first_request": first_page,
+        "first_api": first_api,
+        "lifespan": startup["lifespan_seconds"],
+        "warmup": startup.get("warmup", {}).get("seconds", 0.0),
+    }
+
+def median_ms(samples, name):
+    return statistics.median(sample[name] for sample in samples) * 1000
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--port", type=int, default=8100, help="must be free: the benchmark starts its own server")
+    parser.add_argument("--user-id", type=int, default=1, help="user for the first requests")
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--seed-users", action="store_true", help="create bench users in DATABASE_URL")
+    add_report_argument(parser)
+    args = parser.parse_args()
+
+    if args.seed_users:
+        seed_users(args.user_id, 1)
+    else:
+        open_database()
+
+    print(
+        f"{'scenario':>8} {'runs':>5} {'ready p50':>10} {'ready p99':>10} {'lifespan':>9} "
+        f"{'warmup':>8} {'1st page':>9} {'1st api':>8}"
+    )
+    results = []
+    for scenario, overrides in SCENARIOS:
+        samples = [start_once(args, overrides) for _ in range(args.runs)]
+        result = dict(
+            summarize([sample["ready"] for sample in samples]),
+            scenario=scenario,
+            lifespan_ms=median_ms(samples, "lifespan"),
+            warmup_ms=median_ms(samples, "warmup"),
+            first_request_ms=median_ms(samples, "first_request"),
+            first_api_ms=median_ms(samples, "first_api")
+        )
+        results.append(result)
+        print(
+            f"{scenario:>8} {args.runs:>5} {result['p50_ms']:>10.1f} {result['p99_ms']:>10.1f} "
+            f"{result['lifespan_ms']:>9.1f} {result['warmup_ms']:>8.1f} "
+            f"{result['first_request_ms']:>9.2f} {result['first_api_ms']:>8.2f}"
+        )
+
+    migrate = []
+    for _ in range(args.runs):
+        began = time.perf_counter()
+        subprocess.run([sys.executable, "run.py", "migrate"], cwd=ROOT, check=True)
+        migrate.append(time.perf_counter() - began)
+    result = dict(summarize(migrate), scenario="migrate")
+    results.append(result)
+    print(f"{'migrate':>8} {args.runs:>5} {result['p50_ms']:>10.1f} {result['p99_ms']:>10.1f}")
+
+    write_report(args.json, "startup", vars(args), results)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""Весь набор бенчмарков против одного работающего сервера, отчеты - в каталог коммита.
+
+    python run.py &
+    python benchmarks/suite.py --url http://localhost:8000 --seed-users
+    # ... изменения, перезапуск сервера ...
+    python benchmarks/suite.py --url http://localhost:8000
+    python benchmarks/compare.py benchmarks/results/<база> benchmarks/results/<новый>
+
+Отчеты пишутся в --out/<коммит>/<бенчмарк>.json. startup запускает
+собственный сервер на отдельном порту (--startup-port). history запускается,
+только если сервер работает на засеянной базе (--history, см.
+benchmarks/history.py). --quick уменьшает объемы для проверки на ноутбуке.
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+from common import ROOT, current_commit
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+def scenarios(args):
+    ws_url = "ws" + args.url[len("http"):]
+    quick = args.quick
+    seed = ["--seed-users"] if args.seed_users else []
+    yield "swarm", [
+        "swarm.py", "--url", ws_url, "--users", "100" if quick else "1000",
+        "--rate", "200" if quick else "2000", "--duration", "10" if quick else "30", *seed
+    ]
+    yield "ws_throughput", [
+        "ws_throughput.py", "--url", ws_url, "--sockets", *(["100", "500"] if quick else ["1000", "5000"]), *seed
+    ]
+    yield "group_fanout", [
+        "group_fanout.py", "--url", ws_url, "--members", *(["10", "1000"] if quick else ["10", "1000", "10000"]), *seed
+    ]
+    yield "login_storm", [
+        "login_storm.py", "--url", args.url, "--users", "50" if quick else "200",
+        "--concurrency", "50" if quick else "200", *seed
+    ]
+    yield "startup", [
+        "startup.py", "--runs", "3" if quick else "10", "--port", str(args.startup_port), *seed
+    ]
+    if args.history:
+        yield "history", [
+            "history.py", "run", "--url", args.url, "--duration", "5" if quick else "20"
+        ]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--out", default=os.path.join(HERE, "results"))
+    parser.add_argument("--quick", action="store_true")
+    parser.add_argument("--history", action="store_true", help="server runs on a database seeded by history.py")
+    parser.add_argument("--seed-users", action="store_true", help="create bench users in DATABASE_URL first")
+    parser.add_argument("--startup-port", type=int, default=8100, help="free port for the startup benchmark server")
+    parser.add_argument("--only", nargs="+", help="run only these benchmarks")
+    args = parser.parse_args()
+
+    commit = current_commit() or "unknown"
+    directory = os.path.join(args.out, commit)
+    failed = []
+    for name, command in scenarios(args):
+        if args.only and name not in args.only:
+            continue
+        print(f"== {name}", flush=True)
+        report = os.path.join(directory, f"{name}.json")
+        result = subprocess.run([sys.executable, os.path.join(HERE, command[0]), *command[1:], "--json", report], cwd=ROOT)
+        if result.returncode:
+            failed.append(name)
+
+    print(f"reports in {directory}")
+    if failed:
+        print(f"failed: {', '.join(failed)}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+"""Рой WebSocket-клиентов: N пользователей с заданной общей частотой сообщений.
+
+Запуск против работающего сервера (python run.py):
+
+    python benchmarks/swarm.py --url ws://localhost:8000 --users 500 --rate 2000 --duration 30 --seed-users
+
+В отличие от ws_throughput.py нагрузка открытая: каждый клиент шлет
+сообщения случайным собеседникам из роя по расписанию (--rate сообщений
+в секунду на всех, с пуассоновскими интервалами) и не ждет подтверждения
+предыдущего. Так видно, как растут задержки, когда сервер не успевает.
+
+Измеряется:
+  ack      - от отправки до message_sent отправителю
+  delivery - от отправки до new_message у получателя (время отправки
+             зашито в текст сообщения, клиенты в одном процессе)
+Кадры error (лимиты частоты, перегрузка) считаются отдельно. Лимиты
+соединения по умолчанию - 10 сообщений/с: при --rate / --users выше
+поднимите WS_CONNECTION_RATE и WS_USER_RATE сервера.
+"""
+import argparse
+import asyncio
+import collections
+import json
+import random
+import time
+
+import websockets
+
+from common import add_report_argument, make_token, seed_users, summarize, write_report
+
+PREFIX = "swarm:"
+
+class Stats:
+    def __init__(self):
+        self.sent = 0
+        self.acked = 0
+        self.failed = 0
+        self.rejected = collections.Counter()
+        self.ack_latencies = []
+        self.delivery_latencies = []
+        self.connect_errors = 0
+
+async def run_client(url, user_id, peers, rate, start, stop, stats):
+    token = make_token(user_id)
+    try:
+        ws = await websockets.connect(f"{url}/ws?token={token}", open_timeout=60, max_queue=None)
+    except Exception:
+        stats.connect_errors += 1
+        return
+
+    # Время отправки неподтвержденных сообщений: сервер подтверждает по порядку
+    in_flight = collections.deque()
+
+    async def receive():
+        async for frame in ws:
+            event = json.loads(frame)
+            kind = event.get("type")
+            now = time.perf_counter()
+            if kind == "message_sent" and in_flight:
+                stats.acked += 1
+                stats.ack_latencies.append(now - in_flight.popleft())
+            elif kind == "message_failed" and in_flight:
+                stats.failed += 1
+                in_flight.popleft()
+            elif kind == "error":
+                stats.rejected[event.get("code")] += 1
+                if event.get("frame") == "message" and in_flight:
+                    in_flight.popleft()
+            elif kind == "new_message" and event.get("content", "").startswith(PREFIX):
+                stats.delivery_latencies.append(now - float(event["content"][len(PREFIX):]))
+
+    receiver = asyncio.create_task(receive())
+    try:
+        await start.wait()
+        while not stop.is_set():
+            await asyncio.sleep(random.expovariate(rate))
+            if stop.is_set():
+                break
+            sent_at = time.perf_counter()
+            in_flight.append(sent_at)
+            await ws.send(json.dumps({
+                "type": "message",
+                "content": f"{PREFIX}{sent_at!r}",
+                "receiver_id": random.choice(peers)
+            }))
+            stats.sent += 1
+        # Дожидаемся хвоста подтверждений
+        deadline = time.perf_counter() + 5
+        while in_flight and time.perf_counter() < deadline:
+            await asyncio.sleep(0.05)
+    finally:
+        receiver.cancel()
+        await ws.close()
+
+async def run(args):
+    user_ids = list(range(args.first_user_id, args.first_user_id + args.users))
+    per_client_rate = args.rate / args.users
+    start, stop = asyncio.Event(), asyncio.Event()
+    stats = Stats()
+
+    tasks = []
+    for i, user_id in enumerate(user_ids):
+        peers = [peer for peer in random.sample(user_ids, min(len(user_ids), 21)) if peer != user_id][:20]
+        tasks.append(asyncio.create_task(
+            run_client(args.url, user_id, peers or [user_id], per_client_rate, start, stop, stats)
+        ))
+        if (i + 1) % args.connect_batch == 0:
+            await asyncio.sleep(0.05)
+
+    await asyncio.sleep(1)
+    began = time.perf_counter()
+    start.set()
+    await asyncio.sleep(args.duration)
+    stop.set()
+    elapsed = time.perf_counter() - began
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+    ack = dict(summarize(stats.ack_latencies, elapsed), scenario="ack")
+    delivery = dict(summarize(stats.delivery_latencies, elapsed), scenario="delivery")
+    totals = {
+        "scenario": "totals",
+        "sent": stats.sent,
+        "acked": stats.acked,
+        "failed": stats.failed,
+        "rejected": sum(stats.rejected.values()),
+        "connect_errors": stats.connect_errors,
+        "offered_rate": args.rate,
+        "throughput": stats.acked / elapsed if elapsed else 0.0,
+    }
+    return [ack, delivery, totals], dict(stats.rejected)
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="ws://localhost:8000")
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--rate", type=float, default=1000, help="messages per second across the swarm")
+    parser.add_argument("--duration", type=float, default=30, help="seconds")
+    parser.add_argument("--first-user-id", type=int, default=1)
+    parser.add_argument("--connect-batch", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=1, help="random seed")
+    parser.add_argument("--seed-users", action="store_true", help="create bench users in DATABASE_URL")
+    add_report_argument(parser)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    if args.seed_users:
+        seed_users(args.first_user_id, args.users)
+
+    results, rejected = await run(args)
+    ack, delivery, totals = results
+    print(
+        f"sent {totals['sent']}, acked {totals['acked']} ({totals['throughput']:.1f} msg/s of "
+        f"{args.rate:.0f} offered), failed {totals['failed']}, rejected {rejected or 0}, "
+        f"connect errors {totals['connect_errors']}"
+    )
+    for result in (ack, delivery):
+        print(
+            f"{result['scenario']:<9} p50 {result['p50_ms']:.2f} ms, p90 {result['p90_ms']:.2f} ms, "
+            f"p99 {result['p99_ms']:.2f} ms, max {result['max_ms']:.2f} ms"
+        )
+    write_report(args.json, "swarm", vars(args), results)
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,97 @@
+"""Размер кадра и CPU на кодирование/декодирование для каждого кодека WebSocket.
+
+    python benchmarks/ws_codecs.py --frames 100000
+
+Для типичных событий (new_message, message_sent, sync с 20 сообщениями)
+печатает байты на кадр без сжатия и после permessage-deflate (zlib без
+переноса контекста между кадрами - худший случай), а также CPU-время
+process_time на --frames кодирований и декодирований.
+"""
+import argparse
+import os
+import sys
+import time
+import zlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import codecs
+
+def sample_events():
+    message = {
+        "id": 1048576,
+        "sender_id": 4211,
+        "content": "Привет! Встречаемся завтра в 10:00 у входа",
+        "created_at": "2026-01-15T10:21:33.184512",
+        "is_sent": False
+    }
+    return {
+        "new_message": {
+            "type": "new_message",
+            "message_id": 1048576,
+            "sender_id": 4211,
+            "content": message["content"],
+            "timestamp": message["created_at"]
+        },
+        "message_sent": {
+            "type": "message_sent",
+            "message_id": 1048576,
+            "timestamp": message["created_at"]
+        },
+        "sync": {
+            "type": "sync",
+            "conversations": [{
+                "conversation_id": 77,
+                "user_id": 4211,
+                "username": "alice",
+                "unread_count": 20,
+                "peer_unread_count": 0,
+                "last_message_id": 1048595,
+                "preview": message["content"],
+                "messages": [dict(message, id=message["id"] + i) for i in range(20)],
+                "next_cursor": None
+            }],
+            "truncated": False
+        },
+    }
+
+def deflated_size(frame) -> int:
+    if isinstance(frame, str):
+        frame = frame.encode()
+    compressor = zlib.compressobj(wbits=-15)
+    return len(compressor.compress(frame) + compressor.flush(zlib.Z_SYNC_FLUSH)) - 4
+
+def measure(codec, event, frames):
+    frame = codec.encode(event)
+    size = len(frame.encode() if isinstance(frame, str) else frame)
+
+    began = time.process_time()
+    for _ in range(frames):
+        codec.encode(event)
+    encode_time = time.process_time() - began
+
+    began = time.process_time()
+    for _ in range(frames):
+        codec.decode(frame)
+    decode_time = time.process_time() - began
+
+    assert codec.decode(frame) == event
+    return size, deflated_size(frame), encode_time, decode_time
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--frames", type=int, default=100000)
+    args = parser.parse_args()
+
+    print(f"orjson: {'yes' if codecs.orjson else 'no'}, msgpack: {'yes' if codecs.msgpack else 'no'}")
+    print(f"{'event':<14} {'codec':<14} {'bytes':>7} {'deflate':>8} {'encode s':>9} {'decode s':>9}")
+    for name, event in sample_events().items():
+        for codec in codecs.CODECS.values():
+            size, deflated, encode_time, decode_time = measure(codec, event, args.frames)
+            print(
+                f"{name:<14} {codec.name:<14} {size:>7} {deflated:>8} "
+                f"{encode_time:>9.3f} {decode_time:>9.3f}"
+            )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""Пропускная способность WebSocket-пути при 1k/5k/10k одновременных сокетах.
+
+Запуск против работающего сервера (python run.py):
+
+    python benchmarks/ws_throughput.py --url ws://localhost:8000 --sockets 1000 5000 10000
+
+Каждый клиент открывает /ws?token=..., после подключения всех сокетов
+отправляет --messages сообщений соседу и ждет подтверждения message_sent.
+Токены подписываются ключом из окружения (SECRET_KEY), как на сервере;
+--seed-users создает недостающих пользователей в DATABASE_URL сервера.
+Для 10k сокетов поднимите лимит дескрипторов: ulimit -n 65536.
+"""
+import argparse
+import asyncio
+import json
+import time
+
+import websockets
+
+from common import add_report_argument, make_token, seed_users, summarize, write_report
+
+async def run_client(url, user_id, peer_id, messages, start, latencies):
+    token = make_token(user_id)
+    async with websockets.connect(f"{url}/ws?token={token}", open_timeout=60, max_queue=None) as ws:
+        await start.wait()
+        for i in range(messages):
+            sent_at = time.perf_counter()
+            await ws.send(json.dumps({
+                "type": "message",
+                "content": f"bench {user_id}:{i}",
+                "receiver_id": peer_id
+            }))
+            # Входящие new_message от соседа пропускаем до своего подтверждения
+            while json.loads(await ws.recv())["type"] != "message_sent":
+                pass
+            latencies.append(time.perf_counter() - sent_at)
+
+async def run_level(url, sockets, messages, first_user_id, connect_batch):
+    start = asyncio.Event()
+    latencies = []
+    tasks = []
+    for i in range(sockets):
+        user_id = first_user_id + i
+        peer_id = first_user_id + (i + 1) % sockets
+        tasks.append(asyncio.create_task(
+            run_client(url, user_id, peer_id, messages, start, latencies)
+        ))
+        # Подключаемся пачками, чтобы не упереться в backlog accept
+        if (i + 1) % connect_batch == 0:
+            await asyncio.sleep(0.05)
+
+    await asyncio.sleep(1)
+    began = time.perf_counter()
+    start.set()
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    elapsed = time.perf_counter() - began
+
+    errors = sum(1 for result in results if isinstance(result, Exception))
+    return dict(
+        summarize(latencies, elapsed),
+        scenario=f"{sockets} sockets",
+        sockets=sockets,
+        errors=errors
+    )
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="ws://localhost:8000")
+    parser.add_argument("--sockets", type=int, nargs="+", default=[1000, 5000, 10000])
+    parser.add_argument("--messages", type=int, default=10, help="messages per socket")
+    parser.add_argument("--first-user-id", type=int, default=1)
+    parser.add_argument("--connect-batch", type=int, default=200)
+    parser.add_argument("--seed-users", action="store_true", help="create bench users in DATABASE_URL")
+    add_report_argument(parser)
+    args = parser.parse_args()
+
+    if args.seed_users:
+        seed_users(args.first_user_id, max(args.sockets))
+
+    print(f"{'sockets':>8} {'msgs':>8} {'errors':>7} {'msg/s':>10} {'p50 ms':>9} {'p99 ms':>9}")
+    results = []
+    for sockets in args.sockets:
+        result = await run_level(args.url, sockets, args.messages, args.first_user_id, args.connect_batch)
+        results.append(result)
+        print(
+            f"{result['sockets']:>8} {result['count']:>8} {result['errors']:>7} "
+            f"{result['throughput']:>10.1f} {result['p50_ms']:>9.2f} {result['p99_ms']:>9.2f}"
+        )
+    write_report(args.json, "ws_throughput", vars(args), results)
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,17 +1,44 @@
 import uvicorn
 import os
-from dotenv import load_dotenv
-
-load_dotenv()
+import sys
 
 if __name__ == "__main__":
+    # Импорт пакета app загружает .env до чтения настроек ниже
+    from app import logs, migrations
+
+    # Миграции схемы - отдельный шаг деплоя: python run.py migrate.
+    # Без аргумента применяются один раз здесь, до запуска воркеров
+    # (MIGRATE_ON_START=false - если деплой уже сделал это сам)
+    if sys.argv[1:] == ["migrate"]:
+        logs.configure()
+        migrations.main()
+        sys.exit(0)
+    if sys.argv[1:]:
+        print("Usage: python run.py [migrate]")
+        sys.exit(1)
+    if os.getenv("MIGRATE_ON_START", "True").lower() == "true":
+        logs.configure()
+        migrations.main()
+
     port = int(os.getenv("PORT", 8000))
     debug = os.getenv("DEBUG", "False").lower() == "true"
+    # Несколько воркеров требуют общей шины доставки (PUBSUB_URL=redis://...)
+    workers = int(os.getenv("WORKERS", 1))
+    # Сжатие WebSocket-кадров (permessage-deflate): меньше трафика ценой CPU
+    ws_deflate = os.getenv("WS_PER_MESSAGE_DEFLATE", "True").lower() == "true"
+    # Кадры больше лимита uvicorn отбрасывает (1009), не собирая их в памяти
+    ws_max_size = int(os.getenv("WS_MAX_FRAME_BYTES", 64 * 1024))
+    # Журнал доступа - синхронная запись на каждый запрос; время по маршрутам есть в /metrics
+    access_log = os.getenv("ACCESS_LOG", "False").lower() == "true"
     
     uvicorn.run(
         "app.main:app",
         host="0.0.0.0",
         port=port,
         reload=debug,
-        log_level="info"
-    )
\ No newline at end of file
+        workers=None if debug else workers,
+        ws_per_message_deflate=ws_deflate,
+        ws_max_size=ws_max_size,
+        access_log=access_log,
+        log_level=os.getenv("LOG_LEVEL", "info").lower()
+    )
@@ -0,0 +1,42 @@
+import os
+import sys
+import tempfile
+
+# Настройки читаются при импорте модулей app, поэтому окружение задается
+# до первого импорта: отдельная БД и каталог архива во временной папке
+TEST_DIR = tempfile.mkdtemp(prefix="void-tests-")
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(TEST_DIR, 'test.db')}"
+os.environ["MESSAGE_ARCHIVE_DIR"] = os.path.join(TEST_DIR, "archive")
+os.environ["MESSAGE_HOT_MONTHS"] = "6"
+os.environ["MESSAGE_RETENTION_MONTHS"] = "0"
+# Минимальная стоимость bcrypt: тестам нужна корректность, а не стойкость хеша
+os.environ["BCRYPT_ROUNDS"] = "4"
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import asyncio
+import shutil
+
+import pytest
+
+from app import archive, cache, database, migrations
+from app.message_cache import recent_messages
+
+@pytest.fixture
+def fresh_database():
+    """Пустая БД с актуальной схемой, пустой архив и кэши воркера"""
+    asyncio.run(database.dispose_engines())
+    path = database.SQLALCHEMY_DATABASE_URL[len("sqlite:///"):]
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    shutil.rmtree(archive.message_archive.directory, ignore_errors=True)
+    os.makedirs(archive.message_archive.directory)
+    archive.message_archive.refresh()
+    recent_messages.clear()
+    cache.user_cache.clear()
+    cache.group_cache.clear()
+    database.init_engines()
+    migrations.upgrade(database.engine)
+    yield database
+    asyncio.run(database.dispose_engines())
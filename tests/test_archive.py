@@ -0,0 +1,189 @@
+"""Архив сообщений не меняет того, что видит клиент.
+
+История из 6000 сообщений за 8 месяцев в личных диалогах и группе.
+Для каждого диалога страницы листаются назад от самой свежей и вперед от
+самой старой; результат сравнивается с тем, что было записано, - до
+переноса, после него, после прерванного переноса (файл месяца записан,
+строки удалены частично) и после повторного прохода, который сливает
+существующий файл месяца с оставшимися строками. Курсор прочтения,
+который остался на перенесенном сообщении, продолжает считать
+непрочитанные.
+"""
+import asyncio
+import random
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import func, select
+
+from app import archive, crud, database, models
+from app.message_cache import recent_messages
+
+NOW = datetime(2026, 9, 15, 12, 0)
+MESSAGES = 6000
+USERS = 12
+PAGE = 37
+
+def _seed(rng: random.Random) -> dict:
+    """Записать историю; возвращает ожидаемые сообщения по диалогам"""
+    with database.SessionLocal() as db:
+        db.add_all([
+            models.User(id=user_id, username=f"user{user_id}", email=f"user{user_id}@test.local", hashed_password="-")
+            for user_id in range(1, USERS + 1)
+        ])
+        db.commit()
+        group_id = crud.create_group(db, "archive", 1, list(range(2, USERS + 1))).id
+
+        # id растут вместе со временем, как у сообщений, принятых сервером
+        start = NOW - timedelta(days=240)
+        times = sorted(start + timedelta(seconds=rng.uniform(0, 240 * 86400)) for _ in range(MESSAGES))
+        first_id = crud.reserve_ids(db, "messages", MESSAGES)
+        rows = []
+        for offset, created_at in enumerate(times):
+            sender_id = rng.randint(1, USERS)
+            row = {
+                "id": first_id + offset,
+                "sender_id": sender_id,
+                "receiver_id": None,
+                "conversation_id": None,
+                "content": f"message {offset}",
+                "created_at": created_at.replace(microsecond=0),
+            }
+            if rng.random() < 0.2:
+                row["conversation_id"] = group_id
+            else:
+                # Несколько горячих пар и длинный хвост редких
+                receiver_id = rng.choice([1, 2, 3]) if rng.random() < 0.6 else rng.randint(1, USERS)
+                row["receiver_id"] = receiver_id if receiver_id != sender_id else sender_id % USERS + 1
+            rows.append(row)
+        for chunk in range(0, len(rows), 500):
+            crud.create_messages(db, rows[chunk:chunk + 500])
+
+        expected = {}
+        for message_id, conversation_id, created_at, content in db.execute(
+            select(models.Message.id, models.Message.conversation_id, models.Message.created_at, models.Message.content)
+        ):
+            expected.setdefault(conversation_id, []).append((created_at, message_id, content))
+    return {conversation_id: sorted(messages) for conversation_id, messages in expected.items()}
+
+def _walk(db, conversation) -> tuple:
+    """Все сообщения диалога: назад от свежей страницы и вперед от самой старой"""
+    backward = []
+    page, cursor = crud._conversation_page(db, conversation, None, None, PAGE)
+    backward[:0] = page
+    while cursor:
+        page, cursor = crud._conversation_page(db, conversation, crud.decode_cursor(cursor), None, PAGE)
+        assert page
+        backward[:0] = page
+
+    forward = backward[:1]
+    cursor = crud.encode_cursor(forward[0].id) if forward else None
+    while cursor:
+        page, cursor = crud._conversation_page(db, conversation, None, crud.decode_cursor(cursor), PAGE)
+        forward += page
+
+    def rows(messages):
+        return [(archive._naive_utc(message.created_at), message.id, message.content) for message in messages]
+    return rows(backward), rows(forward)
+
+def _assert_history(expected: dict):
+    # Кольца кэша помнят страницы до переноса - читаем мимо них
+    recent_messages.clear()
+    with database.SessionLocal() as db:
+        for conversation_id, messages in expected.items():
+            conversation = db.get(models.Conversation, conversation_id)
+            backward, forward = _walk(db, conversation)
+            assert backward == messages, f"backward pages of conversation {conversation_id}"
+            assert forward == messages, f"forward pages of conversation {conversation_id}"
+
+def _hot_count(before=None) -> int:
+    with database.SessionLocal() as db:
+        query = select(func.count(models.Message.id))
+        if before is not None:
+            query = query.where(models.Message.created_at < before)
+        return db.scalar(query)
+
+@pytest.fixture
+def history(monkeypatch, fresh_database):
+    # Без пауз, которые в продакшене ждут перечитывания каталога другими воркерами
+    monkeypatch.setattr(archive, "RESCAN_INTERVAL", 0.01)
+    return _seed(random.Random(7))
+
+@pytest.fixture
+def archiver():
+    return archive.MessageArchiver(archive.message_archive, hot_months=6)
+
+def test_pages_unchanged_after_archival(history, archiver):
+    _assert_history(history)
+
+    archived = asyncio.run(archiver.run_once(NOW))
+    cutoff = archiver.cutoff(NOW)
+    assert archived > 0
+    assert _hot_count(cutoff) == 0
+    assert _hot_count() == MESSAGES - archived
+    assert archive.message_archive.stats()["messages"] == archived
+    _assert_history(history)
+
+def test_pages_unchanged_after_interrupted_run(history, archiver):
+    # Архиватор идет от самого старого месяца, на нем и прерываемся
+    month = archive.month_start(archive.oldest_message_before(database.engine, archiver.cutoff(NOW)))
+    # Файл месяца записан, а процесс остановился до удаления строк:
+    # каждое сообщение месяца есть и в горячей таблице, и в архиве
+    count = archive.build_partition(database.engine, archive.message_archive.directory, month)
+    assert count > 0
+    archive.message_archive.refresh()
+    _assert_history(history)
+
+    # Удалена только старшая часть месяца - в том же порядке, что у архиватора
+    partition = next(partition for partition in archive.message_archive.partitions if partition.month == month)
+    ids = [entry[0] for _, entries in partition.blocks() for entry in entries]
+    with database.SessionLocal() as db:
+        assert archive.delete_archived(db, ids[:len(ids) // 2]) == len(ids) // 2
+    _assert_history(history)
+
+def test_rerun_merges_existing_partition(history, archiver):
+    cutoff = archiver.cutoff(NOW)
+    month = archive.month_start(archive.oldest_message_before(database.engine, cutoff))
+    archive.build_partition(database.engine, archive.message_archive.directory, month)
+    archive.message_archive.refresh()
+    partition = next(partition for partition in archive.message_archive.partitions if partition.month == month)
+    ids = [entry[0] for _, entries in partition.blocks() for entry in entries]
+    with database.SessionLocal() as db:
+        archive.delete_archived(db, ids[:len(ids) // 3])
+
+    # Повторный проход дописывает месяц: файл сливается с оставшимися строками
+    archived = asyncio.run(archiver.run_once(NOW))
+    assert _hot_count(cutoff) == 0
+    assert archive.message_archive.stats()["messages"] == MESSAGES - _hot_count()
+    assert archived == MESSAGES - _hot_count() - len(ids) // 3
+    merged = next(partition for partition in archive.message_archive.partitions if partition.month == month)
+    assert merged.messages == len(ids)
+    _assert_history(history)
+
+def _group_unread(db, user_id: int, group_id: int) -> tuple:
+    chats, _ = crud.get_chat_list(db, user_id)
+    changes, _ = crud.sync_conversations(db, user_id, {}, groups={group_id: 0})
+    return (
+        next(unread for chat, unread, *_ in chats if chat.id == group_id),
+        next(unread for chat, unread, *_ in changes if chat.id == group_id),
+    )
+
+def test_unread_count_from_archived_read_cursor(history, archiver):
+    with database.SessionLocal() as db:
+        group_id = db.scalar(select(models.Conversation.id).where(models.Conversation.is_group))
+        oldest_id = history[group_id][0][1]
+        # Один участник прочитал только первое сообщение группы, другой - все
+        assert crud.mark_group_read(db, 5, group_id, oldest_id) == (group_id, oldest_id)
+        crud.mark_group_read(db, 1, group_id)
+
+    asyncio.run(archiver.run_once(NOW))
+
+    with database.SessionLocal() as db:
+        assert db.get(models.Message, oldest_id) is None
+        # Курсор в архиве: непрочитана вся горячая часть группы, кроме своих сообщений
+        hot_unread = db.scalar(select(func.count(models.Message.id)).where(
+            models.Message.conversation_id == group_id, models.Message.sender_id != 5
+        ))
+        assert hot_unread > 0
+        assert _group_unread(db, 5, group_id) == (hot_unread, hot_unread)
+        assert _group_unread(db, 1, group_id) == (0, 0)
@@ -0,0 +1,37 @@
+"""Сообщение, отправленное с одного устройства, видят остальные устройства отправителя.
+
+Устройство-источник получает только подтверждение message_sent, второе
+устройство - new_message с receiver_id, получатель - обычное new_message.
+"""
+from fastapi.testclient import TestClient
+
+from app import auth, models
+from app.main import app
+
+def _connect(client: TestClient, user_id: int):
+    token = auth.create_access_token({"sub": str(user_id)})
+    return client.websocket_connect(f"/ws?token={token}")
+
+def test_outgoing_message_reaches_other_devices(fresh_database):
+    with fresh_database.SessionLocal() as db:
+        db.add_all([
+            models.User(id=user_id, username=f"user{user_id}", email=f"user{user_id}@example.com", hashed_password="-")
+            for user_id in (1, 2)
+        ])
+        db.commit()
+
+    with TestClient(app) as client:
+        with _connect(client, 1) as origin, _connect(client, 1) as other, _connect(client, 2) as receiver:
+            origin.send_json({"type": "message", "receiver_id": 2, "content": "hello"})
+
+            sent = origin.receive_json()
+            assert sent["type"] == "message_sent"
+
+            received = receiver.receive_json()
+            assert received["type"] == "new_message"
+            assert (received["message_id"], received["sender_id"], received["content"]) == (sent["message_id"], 1, "hello")
+
+            echoed = other.receive_json()
+            assert echoed["type"] == "new_message"
+            assert (echoed["message_id"], echoed["sender_id"], echoed["receiver_id"]) == (sent["message_id"], 1, 2)
+            assert echoed["content"] == "hello"
@@ -0,0 +1,61 @@
+"""Непрочитанные в группе считаются от курсора самого участника.
+
+Счетчик группы не хранится, а считается в списке чатов и sync по
+курсору прочтения участника; курсоры остальных участников на него не влияют.
+"""
+from datetime import datetime, timedelta
+
+from app import crud, models
+
+def _seed(db):
+    db.add_all([
+        models.User(id=user_id, username=f"user{user_id}", email=f"user{user_id}@test.local", hashed_password="-")
+        for user_id in range(1, 5)
+    ])
+    db.commit()
+    group_id = crud.create_group(db, "team", 1, [2, 3]).id
+    began = datetime(2026, 9, 1)
+    first_id = crud.reserve_ids(db, "messages", 4)
+    crud.create_messages(db, [
+        {
+            "id": first_id + offset,
+            "sender_id": 2,
+            "receiver_id": None,
+            "conversation_id": group_id,
+            "content": f"group {offset}",
+            "created_at": began + timedelta(minutes=offset),
+        }
+        for offset in range(3)
+    ] + [{
+        # Личный диалог: еще одна строка conversation_members со своим курсором
+        "id": first_id + 3,
+        "sender_id": 4,
+        "receiver_id": 1,
+        "content": "direct",
+        "created_at": began + timedelta(minutes=5),
+    }])
+    return group_id, first_id
+
+def _unread(db, user_id: int, group_id: int) -> dict:
+    chats, _ = crud.get_chat_list(db, user_id)
+    changes, _ = crud.sync_conversations(db, user_id, {}, groups={group_id: 0})
+    return {
+        "chats": next(unread for chat, unread, *_ in chats if chat.id == group_id),
+        "sync": next(unread for chat, unread, *_ in changes if chat.id == group_id),
+    }
+
+def test_group_read_clears_unread(fresh_database):
+    with fresh_database.SessionLocal() as db:
+        group_id, first_id = _seed(db)
+        assert _unread(db, 1, group_id) == {"chats": 3, "sync": 3}
+
+        assert crud.mark_group_read(db, 1, group_id) == (group_id, first_id + 2)
+        assert _unread(db, 1, group_id) == {"chats": 0, "sync": 0}
+        # Курсор одного участника не меняет счетчик другого
+        assert _unread(db, 3, group_id) == {"chats": 3, "sync": 3}
+
+        crud.mark_group_read(db, 3, group_id, first_id)
+        assert _unread(db, 3, group_id) == {"chats": 2, "sync": 2}
+        assert _unread(db, 1, group_id) == {"chats": 0, "sync": 0}
+        # Автор своих сообщений непрочитанными не видит
+        assert _unread(db, 2, group_id) == {"chats": 0, "sync": 0}
@@ -0,0 +1,30 @@
+"""Регистрация, которую опередил параллельный запрос с тем же email.
+
+Хеш пароля считается между проверкой email и INSERT; проигравший гонку
+запрос получает ту же страницу с ошибкой, а не 500.
+"""
+from fastapi.testclient import TestClient
+
+from app import crud_async, models
+from app.main import app
+
+def test_duplicate_email_registered_while_hashing(fresh_database, monkeypatch):
+    hash_password = crud_async.password_hasher.hash
+
+    async def hash_after_competitor(password: str) -> str:
+        with fresh_database.SessionLocal() as db:
+            db.add(models.User(username="first", email="same@example.com", hashed_password="-"))
+            db.commit()
+        return await hash_password(password)
+
+    monkeypatch.setattr(crud_async.password_hasher, "hash", hash_after_competitor)
+    with TestClient(app) as client:
+        response = client.post(
+            "/register",
+            data={"username": "second", "email": "same@example.com", "password": "secret"},
+            follow_redirects=False
+        )
+    assert response.status_code == 200
+    assert "Email already registered" in response.text
+    with fresh_database.SessionLocal() as db:
+        assert db.query(models.User).filter(models.User.email == "same@example.com").count() == 1